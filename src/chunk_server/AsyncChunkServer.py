@@ -0,0 +1,232 @@
+import asyncio
+import base64
+import os
+import zlib
+from typing import Optional
+from src.common import protocol, compression
+from src.common.protocol import LEGACY_VERSION
+from src.chunk_server.ChunkServer import ChunkServer
+from src.chunk_server.ChunkStore import ChunkStore
+from src.chunk_server.Volume import Volume
+from src.chunk_server.ChainForwarder import AsyncChainForwarder, ReplicaFailed, CHAIN_BLOCK_SIZE
+
+
+class AsyncChunkServer(ChunkServer):
+    '''
+    ChunkServer engine built on asyncio streams.
+
+    Every connection is a coroutine instead of a pool thread, so thousands of slow
+    readers can be served at once; disk I/O and blocking calls to other nodes run on
+    the bounded executor inherited from ChunkServer.
+    '''
+    def __init__(self, host='localhost', port=5000, max_workers=10, legacy_protocol=False, chunk_cache_mb=256, chunk_storage='segments',
+                 data_dirs=None, io_workers=4, scrub_mb_per_sec=8, backlog=1024):
+        super().__init__(host=host, port=port, max_workers=max_workers, legacy_protocol=legacy_protocol, chunk_cache_mb=chunk_cache_mb,
+                         chunk_storage=chunk_storage, data_dirs=data_dirs, io_workers=io_workers, scrub_mb_per_sec=scrub_mb_per_sec)
+        self.backlog = backlog
+
+
+    def start(self):
+        print('started chunk server (asyncio engine)')
+        self.connect_to_coordinator()
+        asyncio.run(self.serve())
+
+
+    async def serve(self):
+        self.server_socket.setblocking(False)
+        server = await asyncio.start_server(self.handle_connection, sock=self.server_socket, backlog=self.backlog)
+        async with server:
+            await server.serve_forever()
+
+
+    async def run_blocking(self, func, *args):
+        return await asyncio.get_running_loop().run_in_executor(self.executor, func, *args)
+
+
+    @staticmethod
+    async def run_on(volume: Volume, func, *args):
+        '''Run a disk operation on the I/O workers of the volume it touches'''
+        return await asyncio.wrap_future(volume.submit(func, *args))
+
+
+    async def handle_connection(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        print(f"connected to {writer.get_extra_info('peername')}")
+        self.load_stats.connection_opened()
+        try:
+            await protocol.serve_stream(reader, writer, lambda request, payload_len, framed:
+                                        self.dispatch_request_async(request, reader, writer, framed, payload_len))
+        except Exception as e:
+            print(f"Error handling request: {e}")
+        finally:
+            writer.close()
+            try:
+                await writer.wait_closed()
+            except Exception:
+                pass
+            self.load_stats.connection_closed()
+
+
+    async def dispatch_request_async(self, request, reader, writer, framed, payload_len):
+        '''Handle one request, returning False if the connection cannot carry another one'''
+        print('request', {key: value for key, value in request.items() if key != 'chunk_data'})
+
+        if request.get("request_type") == "UPLOAD_CHUNK":
+            return await self.upload_chunk_async(request, reader, writer, framed, payload_len)
+
+        elif request.get("request_type") == "DOWNLOAD_CHUNK":
+            return await self.download_chunk_async(request.get('chunk_id'), writer, framed, request.get('offset'), request.get('length'))
+
+        elif request.get("request_type") == "HEALTH_CHECK":
+            print(f'{self.id} received heartbeat')
+            self.known_chunk_servers = request.get('other_active_servers')
+            protocol.write_response(writer, {"status": "OK", "stats": self.health_stats()}, framed)
+
+        elif request.get("request_type") == "REPLICATE_CHUNK":
+            response = await self.run_blocking(
+                self.replicate_chunk,
+                request.get('chunk_id'),
+                request.get('chnk_srv_addr'),
+                request.get('chnk_srv_port'),
+                request.get('wire_protocol', LEGACY_VERSION)
+            )
+            protocol.write_response(writer, response, framed)
+
+        elif request.get("request_type") == "REBUILD_CHUNK":
+            response = await self.run_blocking(self.rebuild_chunk, request)
+            protocol.write_response(writer, response, framed)
+
+        else:
+            print(f"Unknown request type: {request.get('request_type')}")
+            return False
+        return True
+
+
+    async def upload_chunk_async(self, request, reader, writer, framed, payload_len):
+        payload_read = not framed or payload_len == 0
+        try:
+            chunk_id = os.path.basename(request.get("chunk_id"))  # Ensure chunk_id is a simple identifier
+            chunk_size = request.get("chunk_size")
+            targets = self.chain_targets(request)
+            forwarder = None
+
+            if framed:
+                if not chunk_id or not chunk_size or payload_len != chunk_size:
+                    raise ValueError("Invalid request received.")
+
+                print(f"Receiving chunk of chunk_id: {chunk_id} (Size: {chunk_size} bytes)")
+
+                if self.streams_to(targets):
+                    forwarder = await AsyncChainForwarder(targets, chunk_id, chunk_size, request.get('checksum'), request.get('codec')).open()
+                volume = self.volumes.pick(chunk_size)
+                chunk_writer = await self.run_on(volume, volume.chunk_store.open_writer, chunk_id, chunk_size, request.get('codec'))
+                try:
+                    await protocol.read_stream(reader, payload_len, self.chain_consumer_async(volume, chunk_writer, forwarder),
+                                               CHAIN_BLOCK_SIZE if forwarder else protocol.STREAM_BUFFER_SIZE)
+                    payload_read = True
+                    self.verify_upload(chunk_id, request.get('checksum'), chunk_writer.checksum)
+                    chunk = await self.run_on(volume, chunk_writer.commit)
+                except Exception:
+                    await self.run_on(volume, chunk_writer.abort)
+                    if forwarder:
+                        forwarder.abort()
+                    raise
+            else:
+                chunk_data_base64 = request.get("chunk_data")
+                if not chunk_id or not chunk_size or not chunk_data_base64:
+                    raise ValueError("Invalid request received.")
+                chunk_data = base64.b64decode(chunk_data_base64)
+                if request.get('checksum') is not None:
+                    self.verify_upload(chunk_id, request['checksum'], zlib.crc32(chunk_data))
+
+                print(f"Receiving chunk of chunk_id: {chunk_id} (Size: {chunk_size} bytes)")
+                volume = self.volumes.pick(len(chunk_data))
+                chunk = await self.run_on(volume, volume.chunk_store.write_chunk, chunk_id, chunk_data, request.get('codec'))
+
+            await self.run_blocking(self.volumes.add, volume, chunk)
+            self.chunk_cache.invalidate(chunk_id)
+            self.load_stats.record_bytes(chunk.size)
+            print(f"Chunk for chunk_id {chunk_id} saved successfully at {chunk.path}.")
+
+            # The ack waits until every server of the chain has stored the chunk
+            try:
+                if forwarder:
+                    stored_replicas = 1 + await forwarder.finish()
+                    self.load_stats.record_bytes(chunk.size)
+                else:
+                    stored_replicas = 1 + await self.run_blocking(self.replicate_chunk_on_upload, chunk, targets)
+            except ReplicaFailed:
+                # The client places the chunk again without the failed server, so this copy is not kept
+                await self.run_on(volume, volume.discard, chunk)
+                raise
+            self.chunk_reporter.report(chunk_id)
+            protocol.write_response(writer, {"status": "SUCCESS", "stored_replicas": stored_replicas}, framed)
+
+        except Exception as e:
+            print(f"Error uploading chunk: {e}")
+            protocol.write_response(writer, self.upload_failure(e), framed)
+            return payload_read
+
+        return True
+
+
+    def chain_consumer_async(self, volume: Volume, chunk_writer, forwarder: Optional[AsyncChainForwarder]):
+        if forwarder is None:
+            return lambda block: self.run_on(volume, chunk_writer.write, block)
+        async def consume(block):
+            # The next hop receives the block while it is written to disk
+            await asyncio.gather(forwarder.write(block), self.run_on(volume, chunk_writer.write, block))
+        return consume
+
+
+    async def download_chunk_async(self, chunk_id, writer, framed, offset=None, length=None):
+        try:
+            data, chunk = await self.run_blocking(self.read_cached, chunk_id)
+            if data is not None:
+                if framed:
+                    start, count = self.download_range(chunk, offset, length)
+                    writer.write(protocol.encode_header(self.download_response(chunk, start), count, protocol.FRAME_RESPONSE))
+                    writer.write(memoryview(data)[start:start + count])
+                else:
+                    data = await self.run_blocking(compression.decode, data, chunk.codec) # legacy clients know nothing of codecs
+                    count = len(data)
+                    writer.write(data)
+                self.load_stats.record_bytes(count)
+                print(f"Chunk with ID {chunk_id} sent successfully.")
+                return True
+
+            chunk = await self.run_blocking(self.find_chunk, chunk_id)
+            if not chunk:
+                response = {
+                    "status": "error",
+                    "error": f"Chunk {chunk_id} not found"
+                }
+                protocol.write_response(writer, response, framed)
+                return True
+
+            print(f"Sending chunk with ID {chunk_id} from {chunk.path}")
+
+            if not framed and chunk.codec:
+                data = await self.run_blocking(lambda: compression.decode(ChunkStore.read_chunk(chunk), chunk.codec))
+                writer.write(data)
+                self.load_stats.record_bytes(len(data))
+                print(f"Chunk with ID {chunk_id} sent successfully.")
+                return True
+
+            chunk_file = await self.run_blocking(open, chunk.path, "rb")
+            with chunk_file:
+                if framed:
+                    start, count = self.download_range(chunk, offset, length)
+                    writer.write(protocol.encode_header(self.download_response(chunk, start), count, protocol.FRAME_RESPONSE))
+                else:
+                    start, count = 0, chunk.size # legacy replies carry no range information
+                if count:
+                    await asyncio.get_running_loop().sendfile(writer.transport, chunk_file, chunk.offset + start, count)
+            self.load_stats.record_bytes(count)
+
+            print(f"Chunk with ID {chunk_id} sent successfully.")
+            return True
+
+        except Exception as e:
+            print(f"Error downloading chunk: {e}")
+            protocol.write_response(writer, {"status": "FAILURE", "error": str(e)}, framed)
+            return False # a partly sent chunk leaves the connection unusable
@@ -0,0 +1,161 @@
+import asyncio
+from src.common import protocol
+from src.common.ConnectionPool import ConnectionPool
+
+
+CHAIN_BLOCK_SIZE = 64 * 1024 # bytes received before they are passed down the chain
+CHAIN_BLOCK_TIMEOUT = 5.0 # seconds a server of the chain may take to accept a block or, per server after it, to ack
+
+
+def chain_request(chunk_id, chunk_size, rest, checksum=None, codec=None):
+    '''UPLOAD_CHUNK for the next server of a chain, which passes the chunk on to the rest'''
+    request = {
+        "request_type": "UPLOAD_CHUNK",
+        "chunk_id": chunk_id,
+        "chunk_size": chunk_size,
+        "replicate": bool(rest),
+        "replicas": rest,
+        "keep_alive": True
+    }
+    if checksum is not None:
+        request["checksum"] = checksum
+    if codec is not None:
+        request["codec"] = codec
+    return request
+
+
+class ReplicaFailed(RuntimeError):
+    '''A server of a replication chain failed to store a chunk; address is the (host, port) to leave out of the next chain'''
+    def __init__(self, address, error):
+        super().__init__(f'Replica {address[0]}:{address[1]} failed: {error}')
+        self.address = tuple(address)
+        self.error = error
+
+
+
+class ChainForwarder:
+    '''
+    Stream a chunk to the next ChunkServer of a replication chain while it is still being received.
+
+    A failing hop does not interrupt the upload: forwarding stops and ReplicaFailed is raised by
+    finish(), once the local copy is stored, so the client hears about it in its ack and can
+    place the chunk again without the failed server.
+
+    Every block must be taken within block_timeout seconds, so a hung replica fails the chain
+    quickly. The final ack may take block_timeout per server left in the chain, so a server
+    waiting on a hung server further down answers before its own upstream gives up on it.
+    '''
+    def __init__(self, pool: ConnectionPool, targets, chunk_id, chunk_size, checksum=None, codec=None, block_timeout=CHAIN_BLOCK_TIMEOUT):
+        self.pool = pool
+        self.address = tuple(targets[0][:2])
+        self.block_timeout = block_timeout
+        self.hops = len(targets)
+        self.error = None
+        self.failed_replica = None # reported by the next server when a server after it failed
+        self.sock = None
+        try:
+            self.sock = pool.borrow(self.address)
+            self.sock.settimeout(block_timeout)
+            self.sock.sendall(protocol.encode_header(chain_request(chunk_id, chunk_size, targets[1:], checksum, codec), chunk_size))
+        except Exception as e:
+            self.fail(e)
+
+
+    def write(self, data):
+        if self.error is None:
+            try:
+                self.sock.sendall(data)
+            except Exception as e:
+                self.fail(e)
+
+
+    def finish(self) -> int:
+        '''Wait for the rest of the chain to store the chunk, returning how many replicas it wrote'''
+        if self.error is None:
+            try:
+                self.sock.settimeout(self.block_timeout * self.hops)
+                message = protocol.recv_message(self.sock)
+                if message is None:
+                    raise ConnectionError('closed the connection without responding')
+                response, _ = message
+                if response.get('status') == 'SUCCESS':
+                    self.pool.release(self.address, self.sock)
+                    self.sock = None
+                    return response.get('stored_replicas', 1)
+                self.failed_replica = response.get('failed_replica')
+                raise RuntimeError(response.get('error'))
+            except Exception as e:
+                self.fail(e)
+        raise ReplicaFailed(self.failed_replica or self.address, self.error)
+
+
+    def fail(self, error):
+        self.error = error
+        self.abort()
+
+
+    def abort(self):
+        # A half sent chunk leaves the connection out of sync, never reuse it
+        if self.sock is not None:
+            self.pool.release(self.address, self.sock, reuse=False)
+            self.sock = None
+
+
+
+class AsyncChainForwarder:
+    '''asyncio counterpart of ChainForwarder, so waiting on the chain holds no executor thread'''
+    def __init__(self, targets, chunk_id, chunk_size, checksum=None, codec=None, block_timeout=CHAIN_BLOCK_TIMEOUT):
+        self.address = tuple(targets[0][:2])
+        self.request = chain_request(chunk_id, chunk_size, targets[1:], checksum, codec)
+        self.chunk_size = chunk_size
+        self.block_timeout = block_timeout
+        self.hops = len(targets)
+        self.error = None
+        self.failed_replica = None
+        self.reader = self.writer = None
+
+
+    async def open(self):
+        try:
+            self.reader, self.writer = await asyncio.wait_for(asyncio.open_connection(*self.address), self.block_timeout)
+            self.writer.write(protocol.encode_header(self.request, self.chunk_size))
+        except Exception as e:
+            self.fail(e)
+        return self
+
+
+    async def write(self, data):
+        if self.error is None:
+            try:
+                self.writer.write(data)
+                await asyncio.wait_for(self.writer.drain(), self.block_timeout)
+            except Exception as e:
+                self.fail(e)
+
+
+    async def finish(self) -> int:
+        if self.error is None:
+            try:
+                message = await asyncio.wait_for(protocol.read_request(self.reader), self.block_timeout * self.hops)
+                if message is None:
+                    raise ConnectionError('closed the connection without responding')
+                response, _, _ = message
+                if response.get('status') == 'SUCCESS':
+                    self.abort()
+                    return response.get('stored_replicas', 1)
+                self.failed_replica = response.get('failed_replica')
+                raise RuntimeError(response.get('error'))
+            except Exception as e:
+                self.fail(e)
+        raise ReplicaFailed(self.failed_replica or self.address, self.error)
+
+
+    def fail(self, error):
+        self.error = error
+        self.abort()
+
+
+    def abort(self):
+        if self.writer is not None:
+            self.writer.close()
+            self.writer = None
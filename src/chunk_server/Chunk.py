@@ -1,3 +1,12 @@
 class Chunk:
-    def __init__(self, id):
-        self.id = id
\ No newline at end of file
+    #a chunk stored on this ChunkServer
+    def __init__(self, id, path=None, size=0, checksum=None, offset=0, codec=None):
+        self.id = id
+        self.path = path # chunk file or segment file on disk
+        self.size = size # bytes
+        self.checksum = checksum # crc32 of the chunk data
+        self.offset = offset # where the chunk starts in its file
+        self.codec = codec # compression the client applied to the data, None if stored as sent
+
+    def __repr__(self):
+        return f'id: {self.id}, path: {self.path}, offset: {self.offset}, size: {self.size}, checksum: {self.checksum}, codec: {self.codec}'
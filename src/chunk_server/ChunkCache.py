@@ -0,0 +1,106 @@
+import collections
+import threading
+
+
+class ChunkCache:
+    '''
+    In-memory cache of chunk bytes with a byte budget, evicted by segmented LRU.
+
+    New chunks enter a probation segment and only move to the protected segment when they
+    are read again, so a one-off scan over many chunks evicts other probation entries
+    instead of the chunks that are actually popular. Entries carry the checksum of the
+    chunk they were read from and only serve reads while it is still the stored version.
+    '''
+    def __init__(self, max_bytes=256 * 1024 * 1024, protected_fraction=0.8, max_entry_fraction=0.125):
+        self.max_bytes = max_bytes
+        self.max_protected_bytes = int(max_bytes * protected_fraction)
+        self.max_entry_bytes = int(max_bytes * max_entry_fraction) # larger chunks are streamed from disk
+        self.lock = threading.Lock()
+        self.probation = collections.OrderedDict() # chunk_id -> (checksum, data), least recently used first
+        self.protected = collections.OrderedDict()
+        self.probation_bytes = 0
+        self.protected_bytes = 0
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+
+    def admits(self, size):
+        return 0 < size <= self.max_entry_bytes
+
+
+    def get(self, chunk_id, checksum):
+        with self.lock:
+            entry = self.protected.get(chunk_id)
+            if entry is not None and entry[0] == checksum:
+                self.protected.move_to_end(chunk_id)
+                self.hits += 1
+                return entry[1]
+
+            entry = self.probation.get(chunk_id)
+            if entry is not None and entry[0] == checksum:
+                # Second read: promote, demoting the coldest protected chunks back to probation
+                del self.probation[chunk_id]
+                self.probation_bytes -= len(entry[1])
+                self.protected[chunk_id] = entry
+                self.protected_bytes += len(entry[1])
+                while self.protected_bytes > self.max_protected_bytes:
+                    demoted_id, demoted = self.protected.popitem(last=False)
+                    self.protected_bytes -= len(demoted[1])
+                    self.probation[demoted_id] = demoted
+                    self.probation_bytes += len(demoted[1])
+                self.evict()
+                self.hits += 1
+                return entry[1]
+
+            if entry is not None or chunk_id in self.protected:
+                self.discard(chunk_id) # cached from a version that has since been overwritten
+            self.misses += 1
+            return None
+
+
+    def put(self, chunk_id, checksum, data):
+        if not self.admits(len(data)):
+            return
+        with self.lock:
+            self.discard(chunk_id)
+            self.probation[chunk_id] = (checksum, data)
+            self.probation_bytes += len(data)
+            self.evict()
+
+
+    def invalidate(self, chunk_id):
+        with self.lock:
+            self.discard(chunk_id)
+
+
+    def discard(self, chunk_id):
+        entry = self.probation.pop(chunk_id, None)
+        if entry is not None:
+            self.probation_bytes -= len(entry[1])
+        entry = self.protected.pop(chunk_id, None)
+        if entry is not None:
+            self.protected_bytes -= len(entry[1])
+
+
+    def evict(self):
+        while self.probation_bytes + self.protected_bytes > self.max_bytes:
+            segment = self.probation if self.probation else self.protected
+            _, entry = segment.popitem(last=False)
+            if segment is self.probation:
+                self.probation_bytes -= len(entry[1])
+            else:
+                self.protected_bytes -= len(entry[1])
+            self.evictions += 1
+
+
+    def stats(self):
+        with self.lock:
+            return {
+                'bytes': self.probation_bytes + self.protected_bytes,
+                'chunks': len(self.probation) + len(self.protected),
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions
+            }
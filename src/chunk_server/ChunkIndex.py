@@ -0,0 +1,163 @@
+import os
+import threading
+import time
+import zlib
+from typing import Dict
+from src.chunk_server.Chunk import Chunk
+from src.chunk_server.ChunkStore import ChunkStore
+
+
+class ChunkIndex:
+    '''
+    On-disk index of the chunks a ChunkServer holds: chunk id -> path, offset, size, checksum and codec.
+
+    Changes are appended to a tab separated log in the chunk directory, so startup only
+    reads that one file and lists the directory instead of opening every chunk. The
+    directory listing reconciles the index with whatever a crash left behind; a chunk
+    appended to a segment whose record was lost is dropped and re-replicated through the
+    block report.
+    '''
+    def __init__(self, chunk_store: ChunkStore):
+        self.chunk_store = chunk_store
+        self.index_path = chunk_store.chunk_path / 'chunk_index.log'
+        self.chunks: Dict[str, Chunk] = {}
+        self.lock = threading.Lock()
+        self.index_file = None
+
+
+    def load(self):
+        start = time.monotonic()
+        records = 0
+        torn = False
+        if self.index_path.exists():
+            with open(self.index_path, 'r') as index_file:
+                for line in index_file:
+                    if not line.endswith('\n'):
+                        print(f"Ignoring torn record at the end of {self.index_path}")
+                        torn = True
+                        break
+                    records += 1
+                    fields = line[:-1].split('\t')
+                    if fields[0] == '+':
+                        chunk_id, path, size, checksum = fields[1:5]
+                        offset = int(fields[5]) if len(fields) > 5 else 0 # records from before segments have none
+                        codec = (fields[6] or None) if len(fields) > 6 else None # uncompressed chunks have none
+                        self.chunks[chunk_id] = Chunk(chunk_id, path, int(size), int(checksum), offset, codec)
+                    elif fields[0] == '-':
+                        self.chunks.pop(fields[1], None)
+
+        # Chunks committed after their index record was lost, or removed behind the index's back
+        on_disk = set()
+        files = {}
+        with os.scandir(self.chunk_store.chunk_path) as entries:
+            for entry in entries:
+                if entry.name.startswith('.') and entry.name.endswith('.tmp'):
+                    os.remove(entry.path) # an upload that never committed
+                    continue
+                files[entry.name] = entry
+                chunk_id = self.chunk_store.chunk_id_from_name(entry.name)
+                if chunk_id is not None:
+                    on_disk.add(chunk_id)
+
+        missing = [chunk_id for chunk_id, chunk in self.chunks.items() if not self.stored(chunk, files)]
+        for chunk_id in missing:
+            del self.chunks[chunk_id]
+        unindexed = on_disk.difference(self.chunks)
+        for chunk_id in unindexed:
+            self.chunks[chunk_id] = self.scan_chunk(chunk_id)
+
+        if torn or missing or unindexed or records > 2 * len(self.chunks) + 1000:
+            self.compact()
+        self.index_file = open(self.index_path, 'a')
+
+        print(f"Loaded index of {len(self.chunks)} chunks in {time.monotonic() - start:.3f}s "
+              f"({len(unindexed)} recovered from disk, {len(missing)} missing)")
+        return self
+
+
+    def stored(self, chunk: Chunk, files):
+        entry = files.get(os.path.basename(chunk.path))
+        if entry is None:
+            return False
+        if chunk.offset == 0 and self.chunk_store.chunk_id_from_name(entry.name) == chunk.id:
+            return True # a file of its own
+        return chunk.offset + chunk.size <= entry.stat().st_size # a segment that was not cut short
+
+
+    def scan_chunk(self, chunk_id) -> Chunk:
+        path = self.chunk_store.chunk_file_path(chunk_id)
+        checksum = 0
+        size = 0
+        with open(path, 'rb') as chunk_file:
+            while block := chunk_file.read(1024 * 1024):
+                checksum = zlib.crc32(block, checksum)
+                size += len(block)
+        return Chunk(chunk_id, str(path), size, checksum)
+
+
+    def compact(self):
+        '''Rewrite the log with one record per chunk'''
+        temp_path = self.index_path.with_suffix('.tmp')
+        with open(temp_path, 'w') as index_file:
+            index_file.writelines(self.format_record(chunk) for chunk in self.chunks.values())
+            index_file.flush()
+            os.fsync(index_file.fileno())
+        os.replace(temp_path, self.index_path)
+
+
+    @staticmethod
+    def format_record(chunk: Chunk):
+        return f'+\t{chunk.id}\t{chunk.path}\t{chunk.size}\t{chunk.checksum}\t{chunk.offset}\t{chunk.codec or ""}\n'
+
+
+    def add(self, chunk: Chunk):
+        with self.lock:
+            self.chunks[chunk.id] = chunk
+            self.index_file.write(self.format_record(chunk))
+            self.index_file.flush()
+
+
+    def replace(self, old: Chunk, new: Chunk):
+        '''Point a chunk at its new location unless it was overwritten since old was read'''
+        with self.lock:
+            if self.chunks.get(old.id) is not old:
+                return False
+            self.chunks[new.id] = new
+            self.index_file.write(self.format_record(new))
+            self.index_file.flush()
+            return True
+
+
+    def remove(self, chunk_id):
+        with self.lock:
+            if self.chunks.pop(chunk_id, None) is not None:
+                self.index_file.write(f'-\t{chunk_id}\n')
+                self.index_file.flush()
+
+
+    def drop(self, chunk: Chunk):
+        '''Remove a chunk unless it was overwritten since chunk was read'''
+        with self.lock:
+            if self.chunks.get(chunk.id) is not chunk:
+                return False
+            del self.chunks[chunk.id]
+            self.index_file.write(f'-\t{chunk.id}\n')
+            self.index_file.flush()
+            return True
+
+
+    def get(self, chunk_id) -> Chunk:
+        return self.chunks.get(chunk_id)
+
+
+    def chunk_ids(self):
+        return list(self.chunks)
+
+
+    def snapshot(self):
+        with self.lock:
+            return list(self.chunks.values())
+
+
+    def __len__(self):
+        return len(self.chunks)
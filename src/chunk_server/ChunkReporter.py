@@ -0,0 +1,62 @@
+import threading
+import time
+
+
+class ChunkReporter:
+    '''
+    Coalesce chunk notifications into batches for the coordinator: CHUNKS_STORED for newly
+    stored chunks, or CHUNKS_CORRUPT for chunks dropped because they failed their checksum.
+
+    A batch is sent as soon as max_batch chunks are waiting, or flush_interval seconds
+    after the first chunk of a batch was reported, whichever comes first. Batches the
+    coordinator could not take are kept and sent again.
+    '''
+    def __init__(self, send, chunk_server_id, request_type='CHUNKS_STORED', max_batch=512, flush_interval=0.05, retry_interval=1.0):
+        self.send = send # sends a request to the coordinator and returns its response
+        self.chunk_server_id = chunk_server_id
+        self.request_type = request_type
+        self.max_batch = max_batch
+        self.flush_interval = flush_interval
+        self.retry_interval = retry_interval
+
+        self.pending = [] # chunk ids not yet reported
+        self.condition = threading.Condition()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+
+    def report(self, chunk_id):
+        with self.condition:
+            self.pending.append(chunk_id)
+            self.condition.notify()
+
+
+    def run(self):
+        while True:
+            with self.condition:
+                while not self.pending:
+                    self.condition.wait()
+                # Let the window fill unless a full batch is already waiting
+                deadline = time.monotonic() + self.flush_interval
+                while len(self.pending) < self.max_batch:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        break
+                    self.condition.wait(remaining)
+                batch, self.pending = self.pending[:self.max_batch], self.pending[self.max_batch:]
+            batch = list(dict.fromkeys(batch)) # a chunk stored again before the batch went out is reported once
+
+            try:
+                response = self.send({
+                    'request_type': self.request_type,
+                    'chunk_server_id': self.chunk_server_id,
+                    'chunk_ids': batch
+                })
+                if response is not None and response.get('status') != 'success':
+                    raise RuntimeError(response.get('message'))
+                print(f'Reported {len(batch)} chunks to coordinator ({self.request_type})')
+            except Exception as e:
+                print(f'Error reporting {len(batch)} chunks ({self.request_type}), will retry: {e}')
+                with self.condition:
+                    self.pending[:0] = batch
+                time.sleep(self.retry_interval)
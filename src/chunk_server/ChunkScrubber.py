@@ -0,0 +1,108 @@
+import os
+import threading
+import time
+import zlib
+from src.chunk_server.Chunk import Chunk
+
+
+class ChunkScrubber:
+    '''
+    Re-read the chunks of a volume in the background and check them against their checksums,
+    so a chunk that rots on disk is dropped and re-replicated before its other replicas are needed.
+
+    Reads are throttled to bytes_per_second. Every interval seconds a pass checks the chunks not
+    verified in the last reverify_interval seconds, least recently verified first. Chunks that
+    were just read and checked to fill the ChunkCache count as verified, so the budget goes to
+    cold chunks. Verification times are kept in memory, so the first passes after a restart
+    check everything.
+    '''
+    def __init__(self, volume, bytes_per_second=8 * 1024 * 1024, interval=60.0, reverify_interval=24 * 3600.0,
+                 block_size=1024 * 1024):
+        self.volume = volume
+        self.bytes_per_second = bytes_per_second
+        self.interval = interval
+        self.reverify_interval = reverify_interval
+        self.block_size = block_size
+
+        self.lock = threading.Lock()
+        self.verified_at = {} # chunk_id -> (chunk, time.monotonic() of its last verification)
+        self.scrubbed = 0 # bytes
+        self.corrupt = 0 # chunks
+        if bytes_per_second > 0:
+            self.thread = threading.Thread(target=self.run, daemon=True)
+            self.thread.start()
+
+
+    def verified(self, chunk: Chunk):
+        with self.lock:
+            self.verified_at[chunk.id] = (chunk, time.monotonic())
+
+
+    def run(self):
+        while not self.volume.failed:
+            time.sleep(self.interval)
+            try:
+                self.scrub()
+            except Exception as e:
+                print(f"Error scrubbing chunks in {self.volume.chunk_path}: {e}")
+
+
+    def due(self):
+        '''Chunks to verify this pass, least recently verified first'''
+        now = time.monotonic()
+        due = []
+        with self.lock:
+            verified_at = {}
+            for chunk in self.volume.chunk_index.snapshot():
+                entry = self.verified_at.get(chunk.id)
+                if entry is not None and entry[0] is chunk:
+                    verified_at[chunk.id] = entry
+                    if now - entry[1] < self.reverify_interval:
+                        continue
+                    due.append((entry[1], chunk))
+                elif chunk.checksum is not None:
+                    due.append((float('-inf'), chunk))
+            self.verified_at = verified_at # forgets chunks removed or overwritten since
+        due.sort(key=lambda entry: entry[0])
+        return [chunk for _, chunk in due]
+
+
+    def scrub(self):
+        checked = corrupt = 0
+        for chunk in self.due():
+            if self.volume.failed:
+                return
+            if self.volume.chunk_index.get(chunk.id) is not chunk:
+                continue # overwritten or moved since the pass started
+            try:
+                checksum = self.volume.guarded(self.checksum, chunk)
+            except FileNotFoundError:
+                continue # moved by compaction and already deleted
+            checked += 1
+            if checksum == chunk.checksum:
+                self.verified(chunk)
+            else:
+                corrupt += 1
+                self.corrupt += 1
+                self.volume.corrupt(chunk)
+        if checked:
+            print(f"Scrubbed {checked} chunks in {self.volume.chunk_path}, {corrupt} corrupt")
+
+
+    def checksum(self, chunk: Chunk):
+        '''crc32 of a chunk as it is on disk, None if the file ends before the chunk does'''
+        fd = os.open(chunk.path, os.O_RDONLY)
+        try:
+            checksum = 0
+            read = 0
+            while read < chunk.size:
+                block = os.pread(fd, min(self.block_size, chunk.size - read), chunk.offset + read)
+                if not block:
+                    return None
+                checksum = zlib.crc32(block, checksum)
+                read += len(block)
+                self.scrubbed += len(block)
+                time.sleep(len(block) / self.bytes_per_second)
+            return checksum
+        finally:
+            os.close(fd)
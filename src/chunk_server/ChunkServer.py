@@ -1,22 +1,47 @@
 from concurrent.futures import ThreadPoolExecutor
+from typing import Optional
 import socket
 import json
 import os
 import time
 import uuid
 import base64
+import zlib
 from pathlib import Path
+from src.common import protocol, compression
+from src.common.protocol import WIRE_VERSION, LEGACY_VERSION
+from src.common.ConnectionPool import ConnectionPool
+from src.common.ReedSolomon import rebuild_stripe_member
+from src.chunk_server.Chunk import Chunk
+from src.chunk_server.ChunkStore import ChunkStore
+from src.chunk_server.Volume import Volume, VolumeSet
+from src.chunk_server.ChunkReporter import ChunkReporter
+from src.chunk_server.LoadStats import LoadStats
+from src.chunk_server.ChunkCache import ChunkCache
+from src.chunk_server.ChainForwarder import ChainForwarder, ReplicaFailed, CHAIN_BLOCK_SIZE, CHAIN_BLOCK_TIMEOUT, chain_request
 
 
 class ChunkServer:
-    def __init__(self, host='localhost', port=5000, max_workers=10):
+    def __init__(self, host='localhost', port=5000, max_workers=10, legacy_protocol=False, chunk_cache_mb=256, chunk_storage='segments',
+                 data_dirs=None, io_workers=4, scrub_mb_per_sec=8):
         
-        self.chunk_map = {} #map chunk_ids to file paths
-        self.id = uuid.uuid4()
         # Networking & threading
         self.host = host
         self.port = port
+
+        # The identity and chunks survive restarts, so a restarted server picks up where it left off.
+        # Each data directory (normally one per disk) keeps its chunks in a subdirectory named after the server
+        data_dirs = [Path(data_dir).expanduser() for data_dir in data_dirs] if data_dirs else [Path.home() / '512_chunk_path']
+        self.storage_path = data_dirs[0]
+        self.id = self.get_server_id()
+        scrub_rate = int(scrub_mb_per_sec * 1024 * 1024) # bytes per second each disk is re-verified at
+        self.volumes = VolumeSet([Volume(data_dir / f'{self.id}', str(self.id)[:6], chunk_storage, io_workers, scrub_rate) for data_dir in data_dirs],
+                                 on_failure=self.on_volume_failure, on_corrupt=self.on_chunk_corrupt)
+        self.load_stats = LoadStats(self.volumes.free_disk) # reported with every heartbeat
+        self.chunk_cache = ChunkCache(chunk_cache_mb * 1024 * 1024) # bytes of recently read chunks
+        self.wire_protocol = LEGACY_VERSION if legacy_protocol else WIRE_VERSION
         self.server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM) #IPv4 over TCP
+        self.server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1) # rebind right after a restart
         self.server_socket.bind((self.host, self.port)) # Tells OS port is taken for incoming connections
         self.server_socket.listen(5) # Up to 5 concurrent connections, after 5, requests are queued
         self.executor = ThreadPoolExecutor(max_workers=max_workers) # create a managed thread pool
@@ -24,68 +49,85 @@ class ChunkServer:
         self.coord_host = 'localhost'
         self.coord_port = 6000
 
-        self.known_chunk_servers = []
+        self.known_chunk_servers = [] # [(addr, port, wire_protocol), ...] assigned by the coordinator heartbeat
+        self.pool = ConnectionPool() # persistent connections to the coordinator and other ChunkServers
+        self.chunk_reporter = ChunkReporter(self.send_to_coordinator, str(self.id)) # batches stored-chunk notifications
+        self.corrupt_reporter = ChunkReporter(self.send_to_coordinator, str(self.id), 'CHUNKS_CORRUPT')
+
+    def get_server_id(self) -> uuid.UUID:
+        '''Load the id this host and port registered with before, or create one'''
+        self.storage_path.mkdir(parents=True, exist_ok=True)
+        server_id_file = self.storage_path / f'chunk_server_{self.host}_{self.port}.id'
+        if server_id_file.exists():
+            server_id = uuid.UUID(server_id_file.read_text().strip())
+            print(f"Loaded chunk server id {server_id}")
+            return server_id
+
+        server_id = uuid.uuid4()
+        server_id_file.write_text(str(server_id))
+        print(f"Generated new chunk server id {server_id}")
+        return server_id
 
     def connect_to_coordinator(self):
         try:
-            coord_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-            coord_socket.connect((self.coord_host, self.coord_port))
-            print(f"Connected to coordinator at {self.coord_host}:{self.coord_port}")
-
             registration_data = {
                 "request_type": "REGISTER_CHUNK_SERVER",
                 "chunk_server_id": str(self.id),
                 "host": self.host,
-                "port": self.port
+                "port": self.port,
+                "wire_protocol": self.wire_protocol
             }
-            coord_socket.sendall(json.dumps(registration_data).encode())
-            response = coord_socket.recv(1024).decode()
+            response = self.send_to_coordinator(registration_data)
+            print(f"Connected to coordinator at {self.coord_host}:{self.coord_port}")
             print(f"Coordinator response: {response}")
+            self.send_block_report()
         except Exception as e:
             print(f"Failed to connect to coordinator: {e}")
 
+    def send_block_report(self):
+        '''Report every stored chunk in one request so the coordinator can reconcile its replica map'''
+        block_report = {
+            "request_type": "BLOCK_REPORT",
+            "chunk_server_id": str(self.id),
+            "chunk_ids": self.volumes.chunk_ids()
+        }
+        response = self.send_to_coordinator(block_report)
+        print(f"Reported {len(block_report['chunk_ids'])} chunks to coordinator: {response}")
+
+    def on_volume_failure(self, volume):
+        # Report the chunks still reachable, so the coordinator re-replicates the ones on the failed disk
+        self.executor.submit(self.send_block_report)
+
+    def on_chunk_corrupt(self, volume, chunk: Chunk):
+        # The coordinator drops this replica and copies the chunk back from a healthy one
+        self.chunk_cache.invalidate(chunk.id)
+        self.corrupt_reporter.report(chunk.id)
+
+    def send_to_coordinator(self, request):
+        '''Send a request to the coordinator, returning its response (None for legacy one-way requests)'''
+        if self.wire_protocol >= WIRE_VERSION:
+            response, _ = self.pool.call((self.coord_host, self.coord_port), request)
+            return response
+        with socket.create_connection((self.coord_host, self.coord_port)) as coord_socket:
+            coord_socket.sendall(json.dumps(request).encode())
+            if request.get('request_type') == 'REGISTER_CHUNK_SERVER':
+                return coord_socket.recv(1024).decode()
+            return None
+
     def start(self):
         print('started chunk server')
         self.connect_to_coordinator()
         while True:
             client_socket, addr = self.server_socket.accept()
             print(f"connected to {addr}")
+            self.load_stats.connection_opened()
             self.executor.submit(self.handle_request, client_socket)
 
 
     def handle_request(self, client_socket):
         try:
-            data = ""
-            while True:
-                part = client_socket.recv(1024).decode()
-                if not part:
-                    break
-                data += part
-                if "\n\n" in data:
-                    data = data.replace("\n\n", "")
-                    break
-
-            request = json.loads(data)
-            print('request', request)
-
-            if request.get("request_type") == "UPLOAD_CHUNK":
-                self.upload_chunk(request, client_socket)
-
-            elif request.get("request_type") == "DOWNLOAD_CHUNK":
-                chunk_id = request.get('chunk_id')
-                self.download_chunk(chunk_id, client_socket)
-
-            elif request.get("request_type") == "HEALTH_CHECK":
-                self.respond_health_check(request, client_socket)
-
-            elif request.get("request_type") == "REPLICATE_CHUNK":
-                chunk_id = request.get('chunk_id')
-                self.replicate_chunk_from_download(
-                    chunk_id, 
-                    request.get('chnk_srv_addr'), 
-                    request.get('chnk_srv_port'),
-                    client_socket
-                )
+            protocol.serve_connection(client_socket, lambda request, payload_len, framed:
+                                      self.dispatch_request(request, client_socket, framed, payload_len))
 
         except json.JSONDecodeError:
             print("Invalid JSON received")
@@ -95,166 +137,420 @@ class ChunkServer:
 
         finally:
             client_socket.close()
+            self.load_stats.connection_closed()
 
-    
-    def upload_chunk(self, request, client_socket):
-        try:
-            #Upload chunk to memory
-            chunk_id =  os.path.basename(request.get("chunk_id"))  # Ensure chunk_id is a simple identifier
-            chunk_size = request.get("chunk_size")
-            chunk_data_base64 = request.get("chunk_data")
 
-            if not chunk_id or not chunk_size or not chunk_data_base64:
-                raise ValueError("Invalid request received.")
+    def dispatch_request(self, request, client_socket, framed, payload_len):
+        '''Handle one request, returning False if the connection cannot carry another one'''
+        print('request', {key: value for key, value in request.items() if key != 'chunk_data'})
 
-            chunk_data = base64.b64decode(chunk_data_base64)
+        if request.get("request_type") == "UPLOAD_CHUNK":
+            return self.upload_chunk(request, client_socket, framed, payload_len)
 
-            print(f"Receiving chunk of chunk_id: {chunk_id} (Size: {chunk_size} bytes)")
+        elif request.get("request_type") == "DOWNLOAD_CHUNK":
+            chunk_id = request.get('chunk_id')
+            return self.download_chunk(chunk_id, client_socket, framed, request.get('offset'), request.get('length'))
 
-            self.chunk_path = Path.home() / '512_chunk_path' / f'{self.id}'
-            self.chunk_path.mkdir(parents=True, exist_ok=True)
-            chunk_file_path = self.chunk_path / f"{str(self.id)[:6]}_{chunk_id}.bin"  # Use .bin for a viewable binary file
+        elif request.get("request_type") == "HEALTH_CHECK":
+            self.respond_health_check(request, client_socket, framed)
 
-            with open(chunk_file_path, "wb") as chunk_file:
-                chunk_file.write(chunk_data)
+        elif request.get("request_type") == "REPLICATE_CHUNK":
+            chunk_id = request.get('chunk_id')
+            self.replicate_chunk_from_download(
+                chunk_id, 
+                request.get('chnk_srv_addr'), 
+                request.get('chnk_srv_port'),
+                client_socket,
+                framed,
+                request.get('wire_protocol', LEGACY_VERSION)
+            )
 
-            self.chunk_map[chunk_id] = str(chunk_file_path)
+        elif request.get("request_type") == "REBUILD_CHUNK":
+            protocol.send_response(client_socket, self.rebuild_chunk(request), framed)
 
-            print(f"Chunk for chunk_id {chunk_id} saved successfully at {chunk_file_path}.")
-            client_socket.send(json.dumps({"status": "SUCCESS"}).encode())
+        else:
+            print(f"Unknown request type: {request.get('request_type')}")
+            return False
+        return True
 
-            #Notify Coordinator that we successfully uploaded a chunk
-            coord_req = {
-                'request_type': 'CHUNK_UPLOAD_SUCCESS',
-                'chunk_id': chunk_id,
-                'chunk_server_id': str(self.id)
-            }
-            coord_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-            coord_socket.connect((self.coord_host, self.coord_port))
-            coord_socket.send(json.dumps(coord_req).encode())
-
-            #OPTIONAL: Replicate Chunk to other ChunkServers
-            replicate = request.get('replicate')
-            if not replicate or replicate is None:
-                return
-            chunk_server_request = {
-                'request_type': 'UPLOAD_CHUNK',
-                'chunk_id': chunk_id,
-                'chunk_size': chunk_size,
-                'chunk_data': chunk_data_base64,
-                'replicate': False
-            }
-            self.replicate_chunk_on_upload(chunk_server_request)
+    
+    def upload_chunk(self, request, client_socket, framed=False, payload_len=0):
+        payload_read = not framed or payload_len == 0
+        try:
+            #Upload chunk to memory
+            chunk_id =  os.path.basename(request.get("chunk_id"))  # Ensure chunk_id is a simple identifier
+            chunk_size = request.get("chunk_size")
+            targets = self.chain_targets(request)
+            forwarder = None
+
+            if framed:
+                if not chunk_id or not chunk_size or payload_len != chunk_size:
+                    raise ValueError("Invalid request received.")
+
+                print(f"Receiving chunk of chunk_id: {chunk_id} (Size: {chunk_size} bytes)")
+
+                # Stream the payload straight to disk instead of buffering the whole chunk, passing each
+                # block down the replication chain as soon as it arrives
+                if self.streams_to(targets):
+                    forwarder = ChainForwarder(self.pool, targets, chunk_id, chunk_size, request.get('checksum'), request.get('codec'))
+                volume = self.volumes.pick(chunk_size)
+                writer = volume.call(volume.chunk_store.open_writer, chunk_id, chunk_size, request.get('codec'))
+                try:
+                    protocol.recv_stream(client_socket, payload_len, self.chain_consumer(volume, writer, forwarder),
+                                         CHAIN_BLOCK_SIZE if forwarder else protocol.STREAM_BUFFER_SIZE)
+                    payload_read = True
+                    self.verify_upload(chunk_id, request.get('checksum'), writer.checksum)
+                    chunk = volume.call(writer.commit)
+                except Exception:
+                    volume.call(writer.abort)
+                    if forwarder:
+                        forwarder.abort()
+                    raise
+            else:
+                chunk_data_base64 = request.get("chunk_data")
+                if not chunk_id or not chunk_size or not chunk_data_base64:
+                    raise ValueError("Invalid request received.")
+                chunk_data = base64.b64decode(chunk_data_base64)
+                if request.get('checksum') is not None:
+                    self.verify_upload(chunk_id, request['checksum'], zlib.crc32(chunk_data))
+
+                print(f"Receiving chunk of chunk_id: {chunk_id} (Size: {chunk_size} bytes)")
+                volume = self.volumes.pick(len(chunk_data))
+                chunk = volume.call(volume.chunk_store.write_chunk, chunk_id, chunk_data, request.get('codec'))
+
+            self.volumes.add(volume, chunk)
+            self.chunk_cache.invalidate(chunk_id)
+            self.load_stats.record_bytes(chunk.size)
+            print(f"Chunk for chunk_id {chunk_id} saved successfully at {chunk.path}.")
+
+            # The ack waits until every server of the chain has stored the chunk
+            try:
+                if forwarder:
+                    stored_replicas = 1 + forwarder.finish()
+                    self.load_stats.record_bytes(chunk.size)
+                else:
+                    stored_replicas = 1 + self.replicate_chunk_on_upload(chunk, targets)
+            except ReplicaFailed:
+                # The client places the chunk again without the failed server, so this copy is not kept
+                volume.call(volume.discard, chunk)
+                raise
+            #Notify Coordinator that we stored a chunk, batched with other stored chunks
+            self.chunk_reporter.report(chunk_id)
+            protocol.send_response(client_socket, {"status": "SUCCESS", "stored_replicas": stored_replicas}, framed)
 
         except Exception as e:
             print(f"Error uploading chunk: {e}")
-            client_socket.send(json.dumps({"status": "FAILURE", "error": str(e)}).encode())
-            
-
-    def download_chunk(self, chunk_id, client_socket):
+            protocol.send_response(client_socket, self.upload_failure(e), framed)
+            return payload_read
+
+        return True
+
+
+    @staticmethod
+    def upload_failure(error):
+        response = {"status": "FAILURE", "error": str(error)}
+        if isinstance(error, ReplicaFailed):
+            # The servers before this one name the same replica, so they pass on only the cause
+            response["error"] = str(error.error)
+            response["failed_replica"] = list(error.address) # for the client to leave out of the next chain
+        return response
+
+
+    @staticmethod
+    def verify_upload(chunk_id, expected, checksum):
+        '''Reject an uploaded chunk whose crc32, computed while it streamed in, is not the sender's'''
+        if expected is not None and checksum != expected:
+            raise ValueError(f"Chunk {chunk_id} does not match its checksum, it was damaged in transit")
+
+
+    def chain_targets(self, request):
+        '''Servers still to store an uploaded chunk after this one, as [(addr, port, wire_protocol), ...]'''
+        if not request.get('replicate'):
+            return []
+        # Replica targets the Coordinator chose, or 2 other known ChunkServers
+        replicas = request.get('replicas')
+        if replicas is None:
+            replicas = self.known_chunk_servers[:2]
+        return [(replica[0], replica[1], replica[2] if len(replica) > 2 else LEGACY_VERSION) for replica in replicas]
+
+
+    def streams_to(self, targets):
+        '''Whether a chunk can be passed to the next server of the chain while it is being received'''
+        return bool(targets) and min(self.wire_protocol, targets[0][2]) >= WIRE_VERSION
+
+
+    @staticmethod
+    def chain_consumer(volume: Volume, writer, forwarder: Optional[ChainForwarder]):
+        if forwarder is None:
+            return lambda block: volume.call(writer.write, block)
+        def consume(block):
+            # The disk worker writes the block while it is passed down the chain
+            written = volume.submit(writer.write, block)
+            forwarder.write(block)
+            written.result()
+        return consume
+
+
+    def find_chunk(self, chunk_id) -> Optional[Chunk]:
+        _, chunk = self.volumes.find(chunk_id)
+        if chunk is None:
+            print(f"Chunk {chunk_id} not found in any data directory")
+        return chunk
+
+
+    @staticmethod
+    def chunk_range(chunk_size, offset=None, length=None):
+        '''Clamp a requested byte range to the chunk, returning (offset, length)'''
+        offset = min(max(offset or 0, 0), chunk_size)
+        if length is None:
+            return offset, chunk_size - offset
+        return offset, min(max(length, 0), chunk_size - offset)
+
+
+    def read_cached(self, chunk_id):
+        '''
+        A chunk's bytes and the chunk from the cache, reading and verifying it into the cache on a miss.
+        (None, None) if the chunk is unknown or too large to cache and should be streamed from disk
+        '''
+        volume, chunk = self.volumes.get(chunk_id)
+        if chunk is None or not self.chunk_cache.admits(chunk.size):
+            return None, None
+        data = self.chunk_cache.get(chunk_id, chunk.checksum)
+        if data is None:
+            try:
+                data = volume.call(ChunkStore.read_chunk, chunk)
+            except (FileNotFoundError, IOError):
+                return None, None # replaced while we read it, leave it to the disk path
+            if not volume.verify(chunk, data):
+                return None, None # dropped, so the download reports it missing and the client tries another replica
+            self.chunk_cache.put(chunk_id, chunk.checksum, data)
+        return data, chunk
+
+
+    def download_range(self, chunk: Chunk, offset=None, length=None):
+        if chunk.codec:
+            return 0, chunk.size # compressed chunks are sent whole, the client slices them after decompressing
+        return self.chunk_range(chunk.size, offset, length)
+
+
+    @staticmethod
+    def download_response(chunk: Chunk, offset):
+        # The checksum covers the whole stored chunk; the client checks it as the bytes arrive
+        response = {"status": "SUCCESS", "chunk_size": chunk.size}
+        if chunk.codec:
+            response["codec"] = chunk.codec # and no offset, as the range was not applied
+        else:
+            response["offset"] = offset
+        if chunk.checksum is not None:
+            response["checksum"] = chunk.checksum
+        return response
+
+
+    def download_chunk(self, chunk_id, client_socket, framed=False, offset=None, length=None):
         try:
-            file_path = self.chunk_map[chunk_id]
-            if not file_path or not os.path.exists(file_path):
-                prefixed_path = self.chunk_path / f"{str(self.id)[:6]}_{chunk_id}.bin"
-                if os.path.exists(prefixed_path):
-                    file_path = str(prefixed_path)
-                else: 
-                    print(f"Chunk file not found. Tried paths:\n- {file_path}\n- {prefixed_path}")
-                    response = {
-                        "status": "error",
-                        "error": f"Chunk {chunk_id} not found"
-                    }
-                    client_socket.sendall((json.dumps(response) + "\n\n").encode())
-                    return
-
-            print(f"Sending chunk with ID {chunk_id} from {file_path}")
-
-            with open(file_path, "rb") as chunk_file:
-                binary_data = chunk_file.read()
-
-            client_socket.sendall(binary_data)
+            data, chunk = self.read_cached(chunk_id)
+            if data is not None:
+                if framed:
+                    start, count = self.download_range(chunk, offset, length)
+                    response = self.download_response(chunk, start)
+                    protocol.send_message(client_socket, response, memoryview(data)[start:start + count], protocol.FRAME_RESPONSE)
+                else:
+                    data = compression.decode(data, chunk.codec) # legacy clients know nothing of codecs
+                    count = len(data)
+                    client_socket.sendall(data)
+                self.load_stats.record_bytes(count)
+                print(f"Chunk with ID {chunk_id} sent successfully.")
+                return True
+
+            chunk = self.find_chunk(chunk_id)
+            if not chunk:
+                response = {
+                    "status": "error",
+                    "error": f"Chunk {chunk_id} not found"
+                }
+                protocol.send_response(client_socket, response, framed)
+                return True
+
+            print(f"Sending chunk with ID {chunk_id} from {chunk.path}")
+
+            with open(chunk.path, "rb") as chunk_file:
+                if framed:
+                    # The size header lets the client preallocate; the kernel copies the file straight to the socket.
+                    # A ranged request gets only the slice it asked for.
+                    start, count = self.download_range(chunk, offset, length)
+                    response = self.download_response(chunk, start)
+                    protocol.send_file_message(client_socket, response, chunk_file, count, protocol.FRAME_RESPONSE, chunk.offset + start)
+                elif chunk.codec:
+                    data = compression.decode(ChunkStore.read_chunk(chunk), chunk.codec)
+                    count = len(data)
+                    client_socket.sendall(data)
+                else:
+                    # Legacy replies carry no range information, so always send the whole chunk
+                    count = chunk.size
+                    if count:
+                        client_socket.sendfile(chunk_file, chunk.offset, count)
+            self.load_stats.record_bytes(count)
 
             print(f"Chunk with ID {chunk_id} sent successfully.")
+            return True
 
         except Exception as e:
             print(f"Error downloading chunk: {e}")
-            client_socket.send(json.dumps({"status": "FAILURE", "error": str(e)}).encode()) 
-        pass
+            protocol.send_response(client_socket, {"status": "FAILURE", "error": str(e)}, framed)
+            return False # a partly sent chunk leaves the connection unusable
     
-    def respond_health_check(self, request, client_socket):
+    def respond_health_check(self, request, client_socket, framed=False):
         try:
             print(f'{self.id} received heartbeat')
             self.known_chunk_servers = request.get('other_active_servers')
-            response = {"status": "OK"}
-            client_socket.sendall((json.dumps(response) + '\n\n').encode())
+            response = {"status": "OK", "stats": self.health_stats()}
+            protocol.send_response(client_socket, response, framed)
         except Exception as e:
             print(f"Error sending health check response: {e}")
     
 
-    #Replicate chunk on upload to 2 other ChunkServers
-    def replicate_chunk_on_upload(self, chunk_server_req):
-        num_replications = 0
-        for other_chunk_server_addr, other_chunk_server_port in self.known_chunk_servers:
-            if num_replications >=2:
-                return
-            num_replications += 1
+    def health_stats(self):
+        return dict(self.load_stats.report(len(self.volumes)), cache=self.chunk_cache.stats())
+
+
+    def send_chunk(self, chnk_srv_addr, chnk_srv_port, wire_protocol, chunk: Chunk, replicas=None):
+        '''
+        Upload a stored chunk to another ChunkServer in the newest protocol both ends speak. Over the
+        binary protocol it passes the chunk on to replicas itself before acknowledging
+        '''
+        # A hung server fails the copy instead of holding it forever
+        timeout = CHAIN_BLOCK_TIMEOUT * (1 + len(replicas or []))
+        if min(self.wire_protocol, wire_protocol) >= WIRE_VERSION:
+            request = chain_request(chunk.id, chunk.size, replicas or [], chunk.checksum, chunk.codec)
+            with open(chunk.path, 'rb') as chunk_file, self.pool.connection((chnk_srv_addr, chnk_srv_port)) as s:
+                s.settimeout(timeout)
+                protocol.send_file_message(s, request, chunk_file, chunk.size, offset=chunk.offset)
+                message = protocol.recv_message(s)
+                if message is None:
+                    raise ConnectionError(f'{chnk_srv_addr}:{chnk_srv_port} closed the connection without responding')
+                response, _ = message
+        else:
+            request = {
+                "request_type": "UPLOAD_CHUNK",
+                "chunk_id": chunk.id,
+                "chunk_size": chunk.size,
+                'replicate': False,
+                'checksum': chunk.checksum,
+                'codec': chunk.codec,
+                'chunk_data': base64.b64encode(ChunkStore.read_chunk(chunk)).decode('utf-8')
+            }
+            with socket.create_connection((chnk_srv_addr, chnk_srv_port), timeout=timeout) as s:
+                response, _ = protocol.call(s, request, framed=False)
+        self.load_stats.record_bytes(chunk.size)
+        return response
+
+    def replicate_chunk_on_upload(self, chunk: Chunk, targets):
+        '''
+        Copy a stored chunk down the chain when it could not be streamed as it arrived (a legacy
+        upload or a legacy next hop), returning how many replicas were written
+        '''
+        stored_replicas = 0
+        while targets:
+            (other_chunk_server_addr, other_chunk_server_port, wire_protocol), rest = targets[0], targets[1:]
+            streams = self.streams_to(targets)
             try:
-                with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
-                    s.connect((other_chunk_server_addr, other_chunk_server_port))
-                    s.sendall((json.dumps(chunk_server_req) + "\n\n").encode())
-                    print(f'Replicated {chunk_server_req["chunk_id"]} to other chunk server')
+                response = self.send_chunk(other_chunk_server_addr, other_chunk_server_port, wire_protocol, chunk,
+                                           rest if streams else None)
             except Exception as e:
-                print(f'Error replicate chunk: {e}')
+                raise ReplicaFailed((other_chunk_server_addr, other_chunk_server_port), e)
+            if response.get("status") != "SUCCESS":
+                raise ReplicaFailed(response.get('failed_replica') or (other_chunk_server_addr, other_chunk_server_port), response.get('error'))
+            print(f'Replicated {chunk.id} to other chunk server')
+            if streams:
+                return stored_replicas + response.get('stored_replicas', 1) # that server took care of the rest
+            stored_replicas += 1
+            targets = rest # legacy servers do not pass chunks on
+        return stored_replicas
 
     #Replicate a chunk by request of Coordinator
-    def replicate_chunk_from_download(self, chunk_id, chnk_srv_addr, chnk_srv_port, client_socket):
+    def replicate_chunk_from_download(self, chunk_id, chnk_srv_addr, chnk_srv_port, client_socket, framed=False, wire_protocol=LEGACY_VERSION):
+        response = self.replicate_chunk(chunk_id, chnk_srv_addr, chnk_srv_port, wire_protocol)
+        protocol.send_response(client_socket, response, framed)
+        return response["status"] == "success"
+
+    def replicate_chunk(self, chunk_id, chnk_srv_addr, chnk_srv_port, wire_protocol=LEGACY_VERSION):
+        '''Copy a stored chunk to another ChunkServer, returning the response for the Coordinator'''
         try:
             #Download data to replicate
-            file_path = self.chunk_map[chunk_id]
-            print(file_path, 'THIS IS FILE PATH')
-            if not file_path or not os.path.exists(file_path):
+            chunk = self.find_chunk(chunk_id)
+            if not chunk:
                 raise ValueError(f"Chunk with ID {chunk_id} not found.")
 
-            print(f"Sending chunk with ID {chunk_id} from {file_path}")
-
-            with open(file_path, "rb") as chunk_file:
-                binary_data = chunk_file.read()
-
-            #Send downloaded data to ChunkServer
-            with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
-                    s.connect((chnk_srv_addr, chnk_srv_port))
-                    chunk_data_base64 = base64.b64encode(binary_data).decode('utf-8')
-
-                    request = {
-                        "request_type": "UPLOAD_CHUNK",
-                        "chunk_id": chunk_id,
-                        "chunk_size": len(binary_data),
-                        "chunk_data": chunk_data_base64,
-                        'replicate': False
-                    }
-                    s.sendall((json.dumps(request) + "\n\n").encode())
-
-                    data = ""
-                    while True:
-                        part = s.recv(1024).decode()
-                        if not part:
-                            break
-                        data += part
-                        if "\n\n" in data:
-                            data = data.replace("\n\n", "")
-                            break
-
-                    response = json.loads(data) 
-
-                    if response.get("status") == "SUCCESS":
-                        print(f"Chunk ID {chunk_id} successfully uploaded to ChunkServer at {chnk_srv_port}:{chnk_srv_addr}")
-                        client_socket.send((json.dumps({"status": "success"}) + '\n\n').encode())
-                        return True
-                    elif response.get("status") == "FAILURE":
-                        client_socket.send((json.dumps({"status": "error", "message": "Replication failed"}) + '\n\n').encode())
-                        print(f"Replication failed for {chunk_id}.")
+            print(f"Sending chunk with ID {chunk_id} from {chunk.path}")
+
+            #Send stored data to ChunkServer
+            response = self.send_chunk(chnk_srv_addr, chnk_srv_port, wire_protocol, chunk)
+
+            if response.get("status") == "SUCCESS":
+                print(f"Chunk ID {chunk_id} successfully uploaded to ChunkServer at {chnk_srv_port}:{chnk_srv_addr}")
+                return {"status": "success"}
+            else:
+                print(f"Replication failed for {chunk_id}.")
+                return {"status": "error", "message": "Replication failed"}
 
         except Exception as e:
             print(f"Error downloading chunk: {e}")
-            client_socket.sendall((json.dumps({"status": "error", "message": str(e)}) + "\n\n").encode())
-            return False
\ No newline at end of file
+            return {"status": "error", "message": str(e)}
+
+
+    def rebuild_chunk(self, request):
+        '''Decode a lost chunk of an erasure coded file from the rest of its stripe and store it, by request of the Coordinator'''
+        chunk_id = os.path.basename(request.get('chunk_id'))
+        try:
+            stripe = request['stripe']
+            index = next(position for position, member in enumerate(stripe['members'])
+                         if member is not None and member['chunk_id'] == chunk_id)
+            data = rebuild_stripe_member(stripe, index, self.fetch_stripe_member)
+            volume = self.volumes.pick(len(data))
+            chunk = volume.call(volume.chunk_store.write_chunk, chunk_id, data)
+            self.volumes.add(volume, chunk)
+            self.chunk_cache.invalidate(chunk_id)
+            self.chunk_reporter.report(chunk_id)
+            print(f"Chunk {chunk_id} rebuilt from its stripe and saved at {chunk.path}")
+            return {"status": "success"}
+
+        except Exception as e:
+            print(f"Error rebuilding chunk {chunk_id}: {e}")
+            return {"status": "error", "message": str(e)}
+
+
+    def fetch_stripe_member(self, member):
+        '''The uncompressed bytes of a chunk of a stripe, from this server or any holder, None if no intact copy is reachable'''
+        volume, chunk = self.volumes.get(member['chunk_id'])
+        if chunk is not None:
+            try:
+                data = volume.call(ChunkStore.read_chunk, chunk)
+                if volume.verify(chunk, data):
+                    return compression.decode(data, chunk.codec)
+            except (FileNotFoundError, IOError):
+                pass
+
+        request = {"request_type": "DOWNLOAD_CHUNK", "chunk_id": member['chunk_id']}
+        for location in member['chunk_server_locations']:
+            address = (location['chnk_srv_addr'], location['chnk_srv_port'])
+            try:
+                if min(self.wire_protocol, location.get('wire_protocol', LEGACY_VERSION)) >= WIRE_VERSION:
+                    response, data = self.pool.call(address, request)
+                    if response.get('status') != 'SUCCESS':
+                        continue
+                    if response.get('checksum') is not None and zlib.crc32(data) != response['checksum']:
+                        print(f"Chunk {member['chunk_id']} from {address} does not match its checksum")
+                        continue
+                    data = compression.decode(data, response.get('codec'))
+                else:
+                    # Legacy servers send the raw chunk and close the connection
+                    with socket.create_connection(address) as s:
+                        s.sendall((json.dumps(request) + "\n\n").encode())
+                        data = b''.join(iter(lambda: s.recv(64 * 1024), b''))
+                    if not data or data.startswith(b'{"status"'):
+                        continue
+                self.load_stats.record_bytes(len(data))
+                return data
+            except Exception as e:
+                print(f"Error fetching chunk {member['chunk_id']} from {address}: {e}")
+        return None
@@ -0,0 +1,94 @@
+import os
+import uuid
+import zlib
+from pathlib import Path
+from src.chunk_server.Chunk import Chunk
+
+
+class ChunkWriter:
+    '''
+    Write a chunk to a temporary file in the chunk directory; commit() makes it durable
+    and atomically renames it to its final name so readers never see a partial chunk
+    '''
+    def __init__(self, chunk_id, final_path: Path, codec=None):
+        self.chunk_id = chunk_id
+        self.codec = codec
+        self.final_path = final_path
+        self.temp_path = final_path.with_name(f'.{final_path.name}.{uuid.uuid4().hex[:8]}.tmp')
+        self.file = open(self.temp_path, 'wb')
+        self.size = 0
+        self.checksum = 0 # running crc32, computed while the data passes through
+
+    def write(self, data):
+        self.file.write(data)
+        self.size += len(data)
+        self.checksum = zlib.crc32(data, self.checksum)
+
+    def commit(self) -> Chunk:
+        self.file.flush()
+        os.fsync(self.file.fileno())
+        self.file.close()
+        os.replace(self.temp_path, self.final_path)
+        return Chunk(self.chunk_id, str(self.final_path), self.size, self.checksum, codec=self.codec)
+
+    def abort(self):
+        self.file.close()
+        try:
+            os.remove(self.temp_path)
+        except FileNotFoundError:
+            pass
+
+
+class ChunkStore:
+    '''Lay out chunk files in a single directory owned by one ChunkServer'''
+    def __init__(self, chunk_path: Path, prefix: str):
+        self.chunk_path = chunk_path
+        self.prefix = prefix
+        self.chunk_path.mkdir(parents=True, exist_ok=True)
+
+    def chunk_file_path(self, chunk_id) -> Path:
+        return self.chunk_path / f"{self.prefix}_{chunk_id}.bin"  # Use .bin for a viewable binary file
+
+    def chunk_id_from_name(self, file_name):
+        '''Chunk id of a chunk file name, None for anything else in the directory'''
+        head, suffix = f'{self.prefix}_', '.bin'
+        if file_name.startswith(head) and file_name.endswith(suffix):
+            return file_name[len(head):-len(suffix)]
+        return None
+
+    def open_writer(self, chunk_id, size=None, codec=None) -> ChunkWriter:
+        return ChunkWriter(chunk_id, self.chunk_file_path(chunk_id), codec)
+
+    def write_chunk(self, chunk_id, chunk_data, codec=None) -> Chunk:
+        writer = self.open_writer(chunk_id, len(chunk_data), codec)
+        try:
+            writer.write(chunk_data)
+            return writer.commit()
+        except Exception:
+            writer.abort()
+            raise
+
+    def discard(self, chunk: Chunk):
+        '''Delete a superseded chunk that has a file of its own; space in shared files is left to compaction'''
+        if chunk.offset == 0 and self.chunk_id_from_name(os.path.basename(chunk.path)) == chunk.id:
+            try:
+                os.remove(chunk.path)
+            except FileNotFoundError:
+                pass
+
+    @staticmethod
+    def read_chunk(chunk: Chunk) -> bytes:
+        '''The bytes of a stored chunk, read with pread from wherever it lives in its file'''
+        fd = os.open(chunk.path, os.O_RDONLY)
+        try:
+            parts = []
+            read = 0
+            while read < chunk.size:
+                part = os.pread(fd, chunk.size - read, chunk.offset + read)
+                if not part:
+                    raise IOError(f"{chunk.path} ends {chunk.size - read} bytes into chunk {chunk.id}")
+                parts.append(part)
+                read += len(part)
+            return b''.join(parts)
+        finally:
+            os.close(fd)
@@ -0,0 +1,42 @@
+import threading
+import time
+
+
+class LoadStats:
+    '''Load counters a ChunkServer reports to the coordinator with every heartbeat'''
+    def __init__(self, free_disk):
+        self.free_disk = free_disk # returns the free bytes left for chunks
+        self.lock = threading.Lock()
+        self.active_connections = 0
+        self.bytes_moved = 0 # chunk bytes received and sent since the last report
+        self.last_report = time.monotonic()
+
+
+    def connection_opened(self):
+        with self.lock:
+            self.active_connections += 1
+
+
+    def connection_closed(self):
+        with self.lock:
+            self.active_connections -= 1
+
+
+    def record_bytes(self, n):
+        with self.lock:
+            self.bytes_moved += n
+
+
+    def report(self, chunk_count):
+        with self.lock:
+            now = time.monotonic()
+            throughput = self.bytes_moved / max(now - self.last_report, 1e-6)
+            self.bytes_moved = 0
+            self.last_report = now
+            active_connections = self.active_connections
+        return {
+            'free_disk': self.free_disk(),
+            'chunk_count': chunk_count,
+            'active_connections': active_connections,
+            'throughput': int(throughput)
+        }
@@ -0,0 +1,81 @@
+import collections
+import os
+import threading
+import time
+import zlib
+from typing import Callable
+from src.chunk_server.Chunk import Chunk
+from src.chunk_server.ChunkIndex import ChunkIndex
+from src.chunk_server.SegmentStore import SegmentStore
+
+
+class SegmentCompactor:
+    '''
+    Reclaim the space of superseded and aborted chunks in sealed segments.
+
+    Every interval seconds, sealed segments whose live chunks fill less than min_live_fraction
+    of the file have those chunks appended to the active segment and repointed in the index.
+    The emptied segment is deleted one pass later, so reads that looked a chunk up just
+    before it moved can still finish.
+    '''
+    def __init__(self, chunk_store: SegmentStore, chunk_index: ChunkIndex, on_corrupt: Callable[[Chunk], None],
+                 interval=60.0, min_live_fraction=0.5):
+        self.chunk_store = chunk_store
+        self.chunk_index = chunk_index
+        self.on_corrupt = on_corrupt # called with chunks whose bytes no longer match their checksum
+        self.interval = interval
+        self.min_live_fraction = min_live_fraction
+
+        self.retired = [] # segment files waiting out one pass before they are deleted
+        self.reclaimed = 0 # bytes
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+
+    def run(self):
+        while True:
+            time.sleep(self.interval)
+            try:
+                self.compact()
+            except Exception as e:
+                print(f"Error compacting segments: {e}")
+
+
+    def compact(self):
+        chunks_by_segment = collections.defaultdict(list)
+        for chunk in self.chunk_index.snapshot():
+            chunks_by_segment[chunk.path].append(chunk)
+
+        # Chunks committed to a segment after it was picked are moved too before it goes
+        retired, self.retired = self.retired, []
+        for path in retired:
+            if chunks_by_segment.get(path):
+                self.move_chunks(chunks_by_segment[path])
+                self.retired.append(path)
+                continue
+            size = os.path.getsize(path)
+            os.remove(path)
+            self.reclaimed += size
+            print(f"Removed compacted segment {os.path.basename(path)} ({size} bytes)")
+
+        for path in self.chunk_store.sealed_segments():
+            size = os.path.getsize(path)
+            live = sum(chunk.size for chunk in chunks_by_segment.get(path, ()))
+            if size and live >= size * self.min_live_fraction:
+                continue
+            moved = self.move_chunks(chunks_by_segment.get(path, ()))
+            print(f"Compacting segment {os.path.basename(path)}: moved {moved} live chunks ({live} of {size} bytes)")
+            self.chunk_store.retire(path)
+            self.retired.append(path)
+
+
+    def move_chunks(self, chunks):
+        moved = 0
+        for chunk in chunks:
+            data = self.chunk_store.read_chunk(chunk)
+            if zlib.crc32(data) != chunk.checksum:
+                self.on_corrupt(chunk) # not copied, so it goes when the segment does
+                continue
+            if self.chunk_index.replace(chunk, self.chunk_store.write_chunk(chunk.id, data, chunk.codec)):
+                moved += 1
+        return moved
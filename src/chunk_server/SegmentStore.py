@@ -0,0 +1,137 @@
+import os
+import threading
+import zlib
+from pathlib import Path
+from src.chunk_server.Chunk import Chunk
+from src.chunk_server.ChunkStore import ChunkStore
+
+
+class Segment:
+    #an append-only file holding many chunks
+    def __init__(self, path: Path, writable=False):
+        self.path = path
+        self.tail = os.path.getsize(path) if path.exists() else 0 # next free byte
+        self.pending = 0 # writers still filling space reserved in this segment
+        self.fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o644) if writable else None
+
+
+
+class SegmentWriter:
+    '''
+    Fill the space a chunk reserved in a segment. commit() makes it durable; the space of an
+    aborted chunk is left for compaction, as readers only ever find committed chunks
+    '''
+    def __init__(self, store: 'SegmentStore', segment: Segment, chunk_id, offset, size, codec=None):
+        self.store = store
+        self.codec = codec
+        self.segment = segment
+        self.chunk_id = chunk_id
+        self.offset = offset
+        self.reserved = size
+        self.size = 0
+        self.checksum = 0 # running crc32, computed while the data passes through
+        self.released = False
+
+    def write(self, data):
+        if self.size + len(data) > self.reserved:
+            raise ValueError(f"Chunk {self.chunk_id} is larger than the {self.reserved} bytes reserved for it")
+        view = memoryview(data)
+        while view:
+            written = os.pwrite(self.segment.fd, view, self.offset + self.size)
+            view = view[written:]
+            self.size += written
+        self.checksum = zlib.crc32(data, self.checksum)
+
+    def commit(self) -> Chunk:
+        try:
+            if self.size != self.reserved:
+                raise ValueError(f"Chunk {self.chunk_id} is {self.size} bytes, {self.reserved} were reserved")
+            os.fsync(self.segment.fd)
+        finally:
+            self.release()
+        return Chunk(self.chunk_id, str(self.segment.path), self.size, self.checksum, self.offset, self.codec)
+
+    def abort(self):
+        self.release()
+
+    def release(self):
+        if not self.released:
+            self.released = True
+            self.store.release(self.segment)
+
+
+
+class SegmentStore(ChunkStore):
+    '''
+    Append chunks into large segment files instead of creating a file per chunk.
+
+    A writer reserves the chunk's extent at the tail of the active segment up front, so
+    concurrent uploads stream into the same segment side by side with pwrite. A segment is
+    sealed once it reaches segment_size and a new one becomes active. Chunk files written
+    by the one-file-per-chunk layout stay readable.
+    '''
+    def __init__(self, chunk_path: Path, prefix: str, segment_size=256 * 1024 * 1024):
+        super().__init__(chunk_path, prefix)
+        self.segment_size = segment_size
+        self.lock = threading.Lock()
+        self.segments = {} # path -> Segment, sealed ones included
+        for path in sorted(self.chunk_path.glob('segment_*.seg')):
+            self.segments[str(path)] = Segment(path)
+        numbers = [self.segment_number(path) for path in self.segments]
+        self.next_number = max(numbers, default=0) + 1
+        if self.segments:
+            last = self.segments[max(self.segments, key=self.segment_number)]
+            last.fd = os.open(last.path, os.O_RDWR)
+            self.active = last
+        else:
+            self.active = self.new_segment()
+
+
+    @staticmethod
+    def segment_number(path):
+        return int(Path(path).stem.split('_')[1])
+
+
+    def new_segment(self) -> Segment:
+        segment = Segment(self.chunk_path / f'segment_{self.next_number:08d}.seg', writable=True)
+        self.next_number += 1
+        self.segments[str(segment.path)] = segment
+        return segment
+
+
+    def open_writer(self, chunk_id, size=None, codec=None) -> SegmentWriter:
+        if size is None:
+            raise ValueError("Chunks need their size up front to be placed in a segment")
+        with self.lock:
+            if self.active.tail and self.active.tail + size > self.segment_size:
+                sealed, self.active = self.active, self.new_segment()
+                self.close_if_idle(sealed)
+            segment = self.active
+            offset = segment.tail
+            segment.tail += size
+            segment.pending += 1
+        return SegmentWriter(self, segment, chunk_id, offset, size, codec)
+
+
+    def release(self, segment: Segment):
+        with self.lock:
+            segment.pending -= 1
+            self.close_if_idle(segment)
+
+
+    def close_if_idle(self, segment: Segment):
+        if segment is not self.active and segment.pending == 0 and segment.fd is not None:
+            os.close(segment.fd)
+            segment.fd = None
+
+
+    def sealed_segments(self):
+        '''Segments no longer written to, the ones compaction may rewrite'''
+        with self.lock:
+            return [path for path, segment in self.segments.items() if segment is not self.active and segment.pending == 0]
+
+
+    def retire(self, path):
+        '''Forget a segment whose live chunks have been moved out; the file is removed later'''
+        with self.lock:
+            self.segments.pop(path, None)
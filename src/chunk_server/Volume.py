@@ -0,0 +1,193 @@
+import errno
+import os
+import random
+import shutil
+import threading
+import zlib
+from concurrent.futures import Future, ThreadPoolExecutor
+from pathlib import Path
+from typing import Callable, List, Optional, Tuple
+from src.chunk_server.Chunk import Chunk
+from src.chunk_server.ChunkIndex import ChunkIndex
+from src.chunk_server.ChunkStore import ChunkStore
+from src.chunk_server.SegmentStore import SegmentStore
+from src.chunk_server.SegmentCompactor import SegmentCompactor
+from src.chunk_server.ChunkScrubber import ChunkScrubber
+
+
+# Errors that mean the disk itself is gone or broken, not that one request was bad
+DISK_FAILURE_ERRNOS = {errno.EIO, errno.EROFS, errno.ENODEV, errno.ENXIO}
+
+
+class Volume:
+    '''
+    One data directory of a ChunkServer, normally one disk: its chunk store, index, scrubber and
+    a small pool of I/O workers of its own, so a slow disk only holds up requests for its chunks
+    '''
+    def __init__(self, chunk_path: Path, prefix, chunk_storage='segments', io_workers=4, scrub_bytes_per_second=8 * 1024 * 1024):
+        self.chunk_path = chunk_path
+        self.failed = False
+        self.executor = ThreadPoolExecutor(max_workers=io_workers, thread_name_prefix=f'io-{chunk_path.parent.name}')
+        self.on_failure: Optional[Callable[['Volume'], None]] = None
+        self.on_corrupt: Optional[Callable[['Volume', Chunk], None]] = None
+        self.chunk_store = self.chunk_index = None
+        try:
+            if chunk_storage == 'segments':
+                self.chunk_store = SegmentStore(chunk_path, prefix) # chunks appended into large segment files
+            else:
+                self.chunk_store = ChunkStore(chunk_path, prefix) # one file per chunk
+            self.chunk_index = ChunkIndex(self.chunk_store).load() #map chunk_ids to stored chunks
+            if chunk_storage == 'segments':
+                self.segment_compactor = SegmentCompactor(self.chunk_store, self.chunk_index, self.corrupt)
+            self.scrubber = ChunkScrubber(self, scrub_bytes_per_second)
+        except OSError as e:
+            print(f"Data directory {chunk_path} is unusable, leaving it out: {e}")
+            self.failed = True
+
+
+    def submit(self, func, *args) -> Future:
+        '''Run a disk operation on this volume's I/O workers'''
+        return self.executor.submit(self.guarded, func, *args)
+
+
+    def call(self, func, *args):
+        return self.submit(func, *args).result()
+
+
+    def guarded(self, func, *args):
+        try:
+            return func(*args)
+        except OSError as e:
+            if e.errno in DISK_FAILURE_ERRNOS:
+                self.fail(e)
+            raise
+
+
+    def fail(self, error):
+        if self.failed:
+            return
+        self.failed = True
+        print(f"Data directory {self.chunk_path} failed, no longer using it: {error}")
+        if self.on_failure is not None:
+            self.on_failure(self)
+
+
+    def verify(self, chunk: Chunk, data) -> bool:
+        '''Check bytes just read from a chunk, dropping the chunk if they do not match its checksum'''
+        if chunk.checksum is None:
+            return True
+        if zlib.crc32(data) == chunk.checksum:
+            self.scrubber.verified(chunk)
+            return True
+        self.corrupt(chunk)
+        return False
+
+
+    def discard(self, chunk: Chunk) -> bool:
+        '''Forget and delete a stored chunk, unless it was overwritten since'''
+        if not self.chunk_index.drop(chunk):
+            return False
+        self.chunk_store.discard(chunk)
+        return True
+
+
+    def corrupt(self, chunk: Chunk):
+        '''Forget a chunk whose bytes no longer match its checksum, so it is re-replicated'''
+        if not self.discard(chunk):
+            return # overwritten since it was read
+        print(f"Chunk {chunk.id} in {self.chunk_path} does not match its checksum, dropping it")
+        if self.on_corrupt is not None:
+            self.on_corrupt(self, chunk)
+
+
+    def free_disk(self):
+        return shutil.disk_usage(self.chunk_path).free
+
+
+
+class VolumeSet:
+    '''
+    The data directories of a ChunkServer. New chunks go to a healthy volume picked at random
+    in proportion to its free space; lookups search every healthy volume.
+    '''
+    def __init__(self, volumes: List[Volume], on_failure: Optional[Callable[[Volume], None]] = None,
+                 on_corrupt: Optional[Callable[[Volume, Chunk], None]] = None):
+        self.volumes = volumes
+        self.lock = threading.Lock()
+        for volume in volumes:
+            volume.on_failure = on_failure
+            volume.on_corrupt = on_corrupt
+        if not self.healthy():
+            raise IOError("No usable data directory")
+
+
+    def healthy(self) -> List[Volume]:
+        return [volume for volume in self.volumes if not volume.failed]
+
+
+    def pick(self, size=0) -> Volume:
+        candidates = []
+        weights = []
+        for volume in self.healthy():
+            try:
+                free_disk = volume.free_disk()
+            except OSError as e:
+                volume.fail(e)
+                continue
+            if free_disk > size:
+                candidates.append(volume)
+                weights.append(free_disk)
+        if not candidates:
+            raise IOError(f"No data directory has room for {size} more bytes")
+        return random.choices(candidates, weights=weights)[0]
+
+
+    def get(self, chunk_id) -> Tuple[Optional[Volume], Optional[Chunk]]:
+        for volume in self.healthy():
+            chunk = volume.chunk_index.get(chunk_id)
+            if chunk is not None:
+                return volume, chunk
+        return None, None
+
+
+    def find(self, chunk_id) -> Tuple[Optional[Volume], Optional[Chunk]]:
+        '''A stored chunk whose file is still there, including chunk files the index does not know'''
+        volume, chunk = self.get(chunk_id)
+        if chunk is not None and os.path.exists(chunk.path):
+            return volume, chunk
+        for volume in self.healthy():
+            prefixed_path = volume.chunk_store.chunk_file_path(chunk_id)
+            if os.path.exists(prefixed_path):
+                return volume, Chunk(chunk_id, str(prefixed_path), os.path.getsize(prefixed_path))
+        return None, None
+
+
+    def add(self, volume: Volume, chunk: Chunk):
+        '''Index a newly stored chunk, dropping any older copy another volume holds'''
+        with self.lock:
+            volume.chunk_index.add(chunk)
+            for other in self.healthy():
+                if other is not volume:
+                    old = other.chunk_index.get(chunk.id)
+                    if old is not None:
+                        other.chunk_index.remove(chunk.id)
+                        other.submit(other.chunk_store.discard, old)
+
+
+    def chunk_ids(self):
+        return list({chunk_id for volume in self.healthy() for chunk_id in volume.chunk_index.chunk_ids()})
+
+
+    def free_disk(self):
+        free_by_device = {} # directories sharing a filesystem share its free space
+        for volume in self.healthy():
+            try:
+                free_by_device[os.stat(volume.chunk_path).st_dev] = volume.free_disk()
+            except OSError as e:
+                # A dead disk must not fail the heartbeat and take the whole server down with it
+                volume.fail(e)
+        return sum(free_by_device.values())
+
+
+    def __len__(self):
+        return sum(len(volume.chunk_index) for volume in self.healthy())
@@ -1,8 +1,11 @@
 # src/cli.py
 import argparse
+from src.common.compression import CODECS
 from src.client.Client import Client
 from src.coordinator.Coordinator import Coordinator
+from src.coordinator.PlacementPolicy import PLACEMENT_POLICIES
 from src.chunk_server.ChunkServer import ChunkServer
+from src.chunk_server.AsyncChunkServer import AsyncChunkServer
 
 def start_service():
     parser = argparse.ArgumentParser(description="Distributed File System CLI")
@@ -14,29 +17,71 @@ def start_service():
                         help="Specify the coordinator's host address (only for client).")
     parser.add_argument("--coordinator_port", type=int, default=6000,
                         help="Specify the coordinator's port number (only for client).")
+    parser.add_argument("--chunk_size_mb", type=int, default=1,
+                        help="Specify the size of uploaded chunks in MB (only for client).")
+    parser.add_argument("--compression", choices=["off"] + sorted(CODECS), default="off",
+                        help="Specify the codec for compressing uploaded chunks that compress well (only for client).")
+    parser.add_argument("--erasure_coding", type=int, nargs=2, metavar=("DATA", "PARITY"),
+                        help="Store uploads Reed-Solomon coded in stripes of DATA chunks plus PARITY parity chunks "
+                             "instead of replicating them (only for client).")
     
     # Host and port for the coordinator and chunk server
     parser.add_argument("--host", default="localhost", help="Specify the host address.")
     parser.add_argument("--port", type=int, help="Specify the port number (required for coordinator and chunk_server).")
     parser.add_argument("--max_workers", type=int, default=10,
                         help="Specify the maximum number of worker threads (only for coordinator and chunk_server).")
+    parser.add_argument("--metadata_dir", default=None,
+                        help="Specify where the coordinator keeps its metadata log and snapshots (only for coordinator).")
+    parser.add_argument("--heartbeat_interval", type=float, default=10.0,
+                        help="Specify the seconds between heartbeats to chunk servers (only for coordinator).")
+    parser.add_argument("--heartbeat_timeout", type=float, default=3.0,
+                        help="Specify the seconds a chunk server has to answer a heartbeat (only for coordinator).")
+    parser.add_argument("--max_missed_heartbeats", type=int, default=3,
+                        help="Specify how many heartbeats in a row a chunk server may miss before it is declared failed (only for coordinator).")
+    parser.add_argument("--placement_policy", choices=sorted(PLACEMENT_POLICIES), default="power_of_two",
+                        help="Specify how the coordinator places new chunks on chunk servers (only for coordinator).")
+    parser.add_argument("--engine", choices=["threaded", "asyncio"], default="threaded",
+                        help="Specify the request handling engine (only for chunk_server).")
+    parser.add_argument("--chunk_cache_mb", type=int, default=256,
+                        help="Specify the memory in MB for caching recently read chunks, 0 to disable (only for chunk_server).")
+    parser.add_argument("--chunk_storage", choices=["segments", "files"], default="segments",
+                        help="Specify whether chunks are appended into segment files or kept one file each (only for chunk_server).")
+    parser.add_argument("--data_dirs", nargs="+", default=None,
+                        help="Specify the directories, normally one per disk, to store chunks in; defaults to ~/512_chunk_path (only for chunk_server).")
+    parser.add_argument("--io_workers", type=int, default=4,
+                        help="Specify the disk I/O threads for each data directory (only for chunk_server).")
+    parser.add_argument("--scrub_mb_per_sec", type=float, default=8,
+                        help="Specify the MB per second each data directory is re-read at to find corrupt chunks, 0 to disable (only for chunk_server).")
+    parser.add_argument("--legacy_protocol", action="store_true",
+                        help="Speak the legacy base64 JSON protocol instead of the binary wire protocol (client and chunk_server).")
 
     args = parser.parse_args()
 
     # Check required arguments based on service type
     if args.service == "client":
         # Initialize Client and pass coordinator's host and port
-        Client(coordinator_host=args.coordinator_host, coordinator_port=args.coordinator_port).start()
+        Client(coordinator_host=args.coordinator_host, coordinator_port=args.coordinator_port,
+               legacy_protocol=args.legacy_protocol, chunk_size_mb=args.chunk_size_mb,
+               compression=None if args.compression == "off" else args.compression,
+               erasure=tuple(args.erasure_coding) if args.erasure_coding else None).start()
     elif args.service == "coordinator":
         # Ensure --port is specified for the coordinator
         if args.port is None:
             parser.error("--port is required for the coordinator")
-        Coordinator(host=args.host, port=args.port, max_workers=args.max_workers).start()
+        Coordinator(host=args.host, port=args.port, max_workers=args.max_workers,
+                    metadata_dir=args.metadata_dir, heartbeat_interval=args.heartbeat_interval,
+                    heartbeat_timeout=args.heartbeat_timeout,
+                    max_missed_heartbeats=args.max_missed_heartbeats,
+                    placement_policy=args.placement_policy).start()
     elif args.service == "chunk_server":
         # Ensure --port is specified for the chunk server
         if args.port is None:
             parser.error("--port is required for the chunk_server")
-        ChunkServer(host=args.host, port=args.port, max_workers=args.max_workers).start()
+        engine = AsyncChunkServer if args.engine == "asyncio" else ChunkServer
+        engine(host=args.host, port=args.port, max_workers=args.max_workers,
+               legacy_protocol=args.legacy_protocol, chunk_cache_mb=args.chunk_cache_mb,
+               chunk_storage=args.chunk_storage, data_dirs=args.data_dirs, io_workers=args.io_workers,
+               scrub_mb_per_sec=args.scrub_mb_per_sec).start()
 
 if __name__ == "__main__":
     start_service()
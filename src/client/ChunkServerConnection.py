@@ -1,33 +1,101 @@
 from typing import *
+import contextlib
 import socket
+import threading
 import json
 from concurrent.futures import ThreadPoolExecutor, as_completed
 import time
 
 import base64
+from src.common import protocol, compression
+from src.common.protocol import WIRE_VERSION, LEGACY_VERSION
+from src.common.ConnectionPool import ConnectionPool
+
+
+class CancelToken:
+    '''Lets another thread abort a request in flight by shutting down its socket'''
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.cancelled = False
+        self.sock = None
+
+    def attach(self, sock):
+        with self.lock:
+            if self.cancelled:
+                raise ConnectionAbortedError("Request cancelled")
+            self.sock = sock
+
+    def detach(self):
+        with self.lock:
+            self.sock = None
+            return self.cancelled
+
+    def cancel(self):
+        with self.lock:
+            self.cancelled = True
+            if self.sock is not None:
+                try:
+                    self.sock.shutdown(socket.SHUT_RDWR)
+                except OSError:
+                    pass
 
 
 class ChunkServerConnection:
-    def __init__(self, user_id, chnk_srv_addr, chnk_srv_port, chnk_srv_id, max_workers=4, max_retries=3):
+    def __init__(self, user_id, chnk_srv_addr, chnk_srv_port, chnk_srv_id, max_workers=4, max_retries=3, wire_protocol=LEGACY_VERSION,
+                 pool: Optional[ConnectionPool] = None, timeout=30.0, block_timeout=5.0):
         self.chnk_srv_addr = chnk_srv_addr
         self.chnk_srv_port = chnk_srv_port
         self.user_id = user_id
         self.chunk_server_id = chnk_srv_id
         self.max_workers = max_workers
         self.max_retries = max_retries
+        self.framed = wire_protocol >= WIRE_VERSION # speak the binary protocol if the server supports it
+        self.pool = pool or ConnectionPool()
+        self.timeout = timeout # seconds a download may wait on the server for any single read
+        self.block_timeout = block_timeout # seconds an upload may wait on each block, and on each server of the chain to ack
         
 
 
-    def upload_chunk(self, chunk_id, chunk_object, chunk_index, file_id) -> bool:
+    @contextlib.contextmanager
+    def connection(self, timeout=None):
+        # Pooled keep-alive connection for the binary protocol, a one-shot socket for legacy servers
+        if self.framed:
+            with self.pool.connection((self.chnk_srv_addr, self.chnk_srv_port)) as s:
+                s.settimeout(timeout) # pooled sockets carry the timeout of their last use
+                yield s
+        else:
+            with socket.create_connection((self.chnk_srv_addr, self.chnk_srv_port), timeout=timeout) as s:
+                yield s
+
+
+    @staticmethod
+    @contextlib.contextmanager
+    def cancellable(sock, cancel: Optional[CancelToken]):
+        if cancel is None:
+            yield
+            return
+        cancel.attach(sock)
+        try:
+            yield
+        finally:
+            cancelled = cancel.detach()
+        if cancelled:
+            # Raising here makes the pool discard the socket, which the canceller may have shut down
+            raise ConnectionAbortedError("Request cancelled")
+
+
+    def upload_chunk(self, chunk_id, chunk_object, chunk_index, file_id, replicas=None, checksum=None, codec=None) -> Tuple[bool, Optional[Tuple[str, int]]]:
+        '''
+        Upload a chunk through this server and the replicas after it. Returns (True, None) once every
+        server stored it, or (False, (host, port)) of a server that failed, for the caller to place the
+        chunk again without it instead of retrying the same chain
+        '''
+        # A hung server fails the upload within seconds; the ack waits for every server of the chain in turn
+        ack_timeout = self.block_timeout * (2 + (len(replicas) if replicas is not None else 2))
         attempt = 0
         while attempt <= self.max_retries:
             try:
-                with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
-                    s.connect((self.chnk_srv_addr, self.chnk_srv_port))
-
-                    # Encode chunk data (binary) to Base64
-                    chunk_data_base64 = base64.b64encode(chunk_object).decode('utf-8')
-
+                with self.connection(self.block_timeout if self.framed else self.timeout) as s:
                     # Create JSON request
                     request = {
                         "request_type": "UPLOAD_CHUNK",
@@ -36,30 +104,32 @@ class ChunkServerConnection:
                         "chunk_size": len(chunk_object),
                         "user_id": self.user_id,
                         "file_id": file_id,
-                        "chunk_data": chunk_data_base64,
                         'replicate': True
                     }
-
-                    # Append delimiter and send
-                    s.sendall((json.dumps(request) + "\n\n").encode())
+                    if replicas is not None:
+                        request['replicas'] = replicas # [(addr, port, wire_protocol), ...] chosen by the Coordinator
+                    if checksum is not None:
+                        request['checksum'] = checksum # crc32 every server of the chain checks the chunk against
+                    if codec is not None:
+                        request['codec'] = codec # chunk_object is compressed; servers store it that way
+
+                    if self.framed:
+                        # Raw chunk bytes follow the framed header
+                        request['keep_alive'] = True
+                        response, _ = protocol.call(s, request, payload=chunk_object, response_timeout=ack_timeout)
+                    else:
+                        # Encode chunk data (binary) to Base64
+                        request["chunk_data"] = base64.b64encode(chunk_object).decode('utf-8')
+                        response, _ = protocol.call(s, request, framed=False)
                     print("Chunk upload request sent to server.")
 
-                    # Receive and parse server response
-                    data = ""
-                    while True:
-                        part = s.recv(1024).decode()
-                        if not part:
-                            break
-                        data += part
-                        if "\n\n" in data:
-                            data = data.replace("\n\n", "")
-                            break
-
-                    response = json.loads(data)  # Parse JSON response
-
                     if response.get("status") == "SUCCESS":
                         print(f"Chunk ID {chunk_id} successfully uploaded to ChunkServer at {self.chnk_srv_port}:{self.chnk_srv_addr}")
-                        return True
+                        return True, None
+                    elif response.get("status") == "FAILURE" and response.get("failed_replica"):
+                        failed = tuple(response["failed_replica"])
+                        print(f"Replica {failed[0]}:{failed[1]} failed during chunk upload for {chunk_id}: {response.get('error')}")
+                        return False, failed
                     elif response.get("status") == "FAILURE":
                         attempt += 1
                         print(f"Server error during chunk upload for {chunk_id}. Retry attempt {attempt}/{self.max_retries}. Error: {response.get('error')}")
@@ -67,47 +137,96 @@ class ChunkServerConnection:
                     else:
                         print("Error parsing status")
 
+            except socket.timeout:
+                print(f"ChunkServer at {self.chnk_srv_addr}:{self.chnk_srv_port} timed out on the upload of {chunk_id}")
+                return False, (self.chnk_srv_addr, self.chnk_srv_port)
+
             except Exception as e:
                 attempt += 1
                 print(f"Connection error during chunk upload for {chunk_id}: {e}. Retry attempt {attempt}/{self.max_retries}")
                 time.sleep(1 ** attempt)
 
         print(f"Failed to upload chunk {chunk_id} after {self.max_retries} attempts.")
-        return False
+        return False, (self.chnk_srv_addr, self.chnk_srv_port)
 
 
     
-    def download_chunk(self, chunk_id):
+    def download_chunk(self, chunk_id, offset=None, length=None, cancel: Optional[CancelToken] = None):
+        '''Download a chunk, or only length bytes of it from offset when a range is given'''
         try:
-            with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
-                s.connect((self.chnk_srv_addr, self.chnk_srv_port))
-
+            with self.connection(self.timeout) as s, self.cancellable(s, cancel):
                 # Prepare and send the download request
                 request = {
                     "request_type": "DOWNLOAD_CHUNK",
                     "chunk_id": chunk_id,
                 }
+                if self.framed:
+                    if offset is not None or length is not None:
+                        request['offset'] = offset or 0
+                        request['length'] = length
+                    request['keep_alive'] = True
+                    protocol.send_message(s, request)
+                    print("Chunk download request sent to server.")
+                    message = protocol.recv_message(s)
+                    if message is None:
+                        raise ConnectionError("Server closed the connection without responding")
+                    response, payload_len = message
+                    if response.get("status") != "SUCCESS":
+                        print(f"Error downloading chunk: {response.get('error')}")
+                        return None
+                    # Size is known up front, so receive straight into one preallocated buffer
+                    data, checksum = protocol.recv_checksummed(s, payload_len)
+                    if response.get('checksum') is not None and response.get('offset', 0) == 0 and payload_len == response.get('chunk_size') \
+                            and checksum != response['checksum']:
+                        print(f"Chunk ID {chunk_id} does not match its checksum, discarding it.")
+                        return None
+                    data = compression.decode(data, response.get('codec'))
+                    print(f"Chunk ID {chunk_id} successfully downloaded.")
+                    if 'offset' in request and 'offset' not in response:
+                        return self.slice_range(data, offset, length) # the server sent the whole chunk
+                    return data
+
                 s.sendall((json.dumps(request) + "\n\n").encode())  # Add delimiter for message clarity
                 print("Chunk download request sent to server.")
 
-                # Buffer to collect incoming  binary data
-                data = b""
+                # Legacy servers send no size, so collect parts until the connection closes
+                parts = []
                 while True:
-                    part = s.recv(4096)  # Read in 4KB chunks
+                    part = s.recv(64 * 1024)
                     if not part:  # Break if the connection is closed
                         break
-                    data += part
-                  
+                    parts.append(part)
+                data = b"".join(parts)
+                if data.startswith(b'{"status"') and self.legacy_error(data):
+                    return None
 
                 print(f"Chunk ID {chunk_id} successfully downloaded.")
-                return data  
-                #else:
-                    #print(f"Error downloading chunk: {response.get('error')}")
-                    #return None, None
+                return self.slice_range(data, offset, length) # legacy servers always send the whole chunk
 
         except Exception as e:
             print(f"Error during chunk download: {e}")
-            return None, None
+            return None
+
+
+    @staticmethod
+    def legacy_error(data):
+        '''Whether a legacy reply is an error response rather than chunk bytes'''
+        try:
+            response = json.loads(data)
+        except ValueError:
+            return False
+        if not isinstance(response, dict) or response.get("status") == "SUCCESS":
+            return False
+        print(f"Error downloading chunk: {response.get('error') or response.get('message')}")
+        return True
+
+
+    @staticmethod
+    def slice_range(data, offset=None, length=None):
+        if offset is None and length is None:
+            return data
+        start = offset or 0
+        return data[start:] if length is None else data[start:start + length]
 
     
     
@@ -6,25 +6,31 @@ import json
 from src.client.CoordinatorConnection import CoordinatorConnection
 from src.client.UploadManager import UploadManager
 from src.client.DownloadManager import DownloadManager
+from src.common.protocol import WIRE_VERSION, LEGACY_VERSION
+from src.common.ConnectionPool import ConnectionPool
 import uuid
 
 class Client:
-    def __init__(self, coordinator_host, coordinator_port):
+    def __init__(self, coordinator_host, coordinator_port, legacy_protocol=False, chunk_size_mb=1, compression=None, erasure=None):
         self.cache_path = Path.home() / '512_dfs_cache'
         self.cache_path.mkdir(parents=True, exist_ok=True)
+        self.chunk_size_mb = chunk_size_mb
+        self.erasure = erasure # (data chunks, parity chunks) per stripe to erasure code uploads, None to replicate them
         self.file_metadata = self.load_metadata() # get clients file information
 
-        self.coordinator_connection = CoordinatorConnection(coordinator_host, coordinator_port)
+        wire_protocol = LEGACY_VERSION if legacy_protocol else WIRE_VERSION
+        self.pool = ConnectionPool() # keep-alive connections shared by the coordinator and chunk server connections
+        self.coordinator_connection = CoordinatorConnection(coordinator_host, coordinator_port, wire_protocol, self.pool)
         self.id = self.get_client_id() # get or create client ID
 
-        self.upload_manager = UploadManager(self.coordinator_connection, self.id)
-        self.download_manager = DownloadManager(self.coordinator_connection, self.id)
+        self.upload_manager = UploadManager(self.coordinator_connection, self.id, pool=self.pool, compression=compression)
+        self.download_manager = DownloadManager(self.coordinator_connection, self.id, pool=self.pool)
 
 
     
     def start(self):
-        print("Would you like to (1) upload a file or (2) download a file?")
-        choice = input("Enter 1 to upload or 2 to download: ").strip()
+        print("Would you like to (1) upload a file, (2) download a file, (3) resume an upload or (4) resume a download?")
+        choice = input("Enter 1 to upload, 2 to download, 3 or 4 to resume: ").strip()
 
         if choice == '1':
             file_location = input("Please enter the file location to upload: ").strip()
@@ -33,16 +39,25 @@ class Client:
                 return
             file_name = input("Please enter a name for this file: ")
             
-            self.upload_manager.upload_file(file_location, 1, f"{file_name}_{str(uuid.uuid4())}") # 10 mg chunks
+            self.upload_manager.upload_file(file_location, self.chunk_size_mb, f"{file_name}_{str(uuid.uuid4())}", erasure=self.erasure)
 
         elif choice == '2':
             # Prompt for file ID to download
             file_id = input("Please enter the file ID to download: ").strip()
+            output_path = input("Please enter where to save the file (default output.pdf): ").strip() or 'output.pdf'
             # Proceed to download
-            self.download_manager.download_file(file_id)
+            self.download_manager.download_file(file_id, output_path)
+
+        elif choice == '3':
+            file_id = input("Please enter the file ID of the interrupted upload: ").strip()
+            self.upload_manager.resume_upload(file_id)
+
+        elif choice == '4':
+            file_id = input("Please enter the file ID of the interrupted download: ").strip()
+            self.download_manager.resume_download(file_id)
 
         else:
-            print("Invalid input. Please enter 1 or 2 to proceed.")
+            print("Invalid input. Please enter 1, 2, 3 or 4 to proceed.")
             self.start()  # Retry if input is invalid
 
 
@@ -1,29 +1,39 @@
 from typing import *
 import socket
 import json
+from src.common import protocol
+from src.common.protocol import WIRE_VERSION
+from src.common.ConnectionPool import ConnectionPool
 
 class CoordinatorConnection:
     # handle connection with coordinator
-    def __init__(self, coord_addr, coord_port):
+    def __init__(self, coord_addr, coord_port, wire_protocol=WIRE_VERSION, pool: Optional[ConnectionPool] = None):
         self.coord_addr = coord_addr
         self.coord_port = coord_port
+        self.wire_protocol = wire_protocol
+        self.pool = pool or ConnectionPool()
+
+
+    def request(self, request):
+        """Send a request to the Coordinator and return its parsed response"""
+        if self.wire_protocol >= WIRE_VERSION:
+            response, _ = self.pool.call((self.coord_addr, self.coord_port), request)
+            return response
+        with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
+            s.connect((self.coord_addr, self.coord_port))
+            response, _ = protocol.call(s, request, framed=False)
+            return response
 
 
     def get_client_id(self) -> Optional[int]:
         # Request a unique client ID from the server
         try:
-            with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
-                s.connect((self.coord_addr, self.coord_port))
-
-                request = {"request_type": "GET_CLIENT_ID"}
-                s.sendall(json.dumps(request).encode())
-                print("Client ID request sent to Coordinator server")
-
-                data = s.recv(1024).decode()
-                response = json.loads(data)  # Parse JSON response
-                client_id = response.get("client_id")
-                print(f"Received ID {client_id} from Coordinator server")
-                return client_id
+            request = {"request_type": "GET_CLIENT_ID"}
+            response = self.request(request)
+            print("Client ID request sent to Coordinator server")
+            client_id = response.get("client_id")
+            print(f"Received ID {client_id} from Coordinator server")
+            return client_id
             
         except Exception as e:
             print(f"Error getting client ID: {e}")
@@ -32,78 +42,75 @@ class CoordinatorConnection:
     def get_chunk_servers(self):
         """Get a list of Chunk Servers to upload to"""
         try:
-            with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
-                s.connect((self.coord_addr, self.coord_port))
-                request = {"request_type": "GET_CHUNK_SERVERS"}
-                s.sendall(json.dumps(request).encode())
-                print("Requested Chunk Server locations from Coordinator")
-
-                # Collect response data until we reach the end of the message
-                data = ""
-                while True:
-                    part = s.recv(1024).decode()
-                    if not part:
-                        break
-                    data += part
-                    if "\n\n" in data:
-                        data = data.replace("\n\n", "")
-                        break
-
-                response = json.loads(data)
-                chunk_servers = response.get("chunk_servers", [])  # form [{chnk_srv_addr, chnk_srv_port, chnk_srv_id}, ...]
-                chunk_servers = [json.loads(server) for server in chunk_servers]
-                
-                if not chunk_servers:
-                    print("No Chunk Servers available from Coordinator.")
-                
-                return chunk_servers
+            request = {"request_type": "GET_CHUNK_SERVERS"}
+            response = self.request(request)
+            print("Requested Chunk Server locations from Coordinator")
+
+            chunk_servers = response.get("chunk_servers", [])  # form [{chnk_srv_addr, chnk_srv_port, chnk_srv_id, wire_protocol}, ...]
+            chunk_servers = [json.loads(server) for server in chunk_servers]
+            
+            if not chunk_servers:
+                print("No Chunk Servers available from Coordinator.")
+            
+            return chunk_servers
 
         except Exception as e:
             print(f"Error getting Chunk Servers: {e}")
             return []
     
 
+    def get_placement(self, num_chunks, chunk_size, replication=3, exclude=None):
+        """Get the Chunk Servers and a placement plan ([primary id, replica ids...] per chunk) for an upload, leaving out the (host, port) in exclude"""
+        try:
+            request = {"request_type": "GET_CHUNK_SERVERS", "num_chunks": num_chunks, "chunk_size": chunk_size, "replication": replication}
+            if exclude:
+                request["exclude"] = [list(location) for location in exclude]
+            response = self.request(request)
+            print("Requested chunk placement from Coordinator")
+
+            chunk_servers = [json.loads(server) for server in response.get("chunk_servers", [])]
+            if not chunk_servers:
+                print("No Chunk Servers available from Coordinator.")
+
+            return chunk_servers, response.get("placement") # no plan from Coordinators that predate placement
+
+        except Exception as e:
+            print(f"Error getting chunk placement: {e}")
+            return [], None
+
+
     def get_chunk_locations(self, file_id):
         """Get the raw JSON object of Chunk Servers holding pieces of the file"""
         try:
-            with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
-                s.connect((self.coord_addr, self.coord_port))
-                request = {"request_type": "GET_FILE_DATA", "file_id": file_id}
-                s.sendall((json.dumps(request) + "\n\n").encode())  # Add delimiter
-                print("Requested Chunk locations from Coordinator")
-                print("Request:", request)
-
-                # Buffer to collect response data
-                data = ""
-                while True:
-                    part = s.recv(1024).decode()
-                    if not part:  # Connection closed
-                        break
-                    data += part
-                    if "\n\n" in data:  # End of message
-                        data = data.replace("\n\n", "")  # Remove delimiter
-                        break
-
-                response = json.loads(data)  # Parse the raw JSON response
-                print("Raw Response:", response)
-
-                return response  # Return the raw JSON object directly
+            request = {"request_type": "GET_FILE_DATA", "file_id": file_id}
+            print("Requested Chunk locations from Coordinator")
+            print("Request:", request)
+            response = self.request(request)  # Parse the raw JSON response
+            print("Raw Response:", response)
+
+            return response  # Return the raw JSON object directly
 
         except Exception as e:
             print(f"Error getting chunk locations: {e}")
             return None
 
 
-    def register_new_file(self, file_id, chunk_metadata):
+    def register_new_file(self, file_id, chunk_metadata, erasure=None):
         req = {
             'request_type': 'REGISTER_NEW_FILE',
             'file_id': file_id,
             'chunk_metadata': chunk_metadata
         }
+        if erasure:
+            req['erasure'] = erasure # {data_shards, parity_shards, parity: [[chunk_id, ...] per stripe]}
         try:
             serialized_req = json.dumps(req)  # Serialize request to check for issues
             print(f"Serialized Request: {serialized_req}")  # Debug log
             
+            if self.wire_protocol >= WIRE_VERSION:
+                self.request(req)
+                return
+
             with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
                 s.connect((self.coord_addr, self.coord_port))
                 s.sendall(serialized_req.encode())  # Send JSON to the server
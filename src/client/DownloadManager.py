@@ -1,10 +1,21 @@
 from typing import *
+import collections
+import io
+import itertools
 import os
 from pathlib import Path
 import json
-from concurrent.futures import ThreadPoolExecutor, as_completed
-from src.client.ChunkServerConnection import ChunkServerConnection
+from concurrent.futures import ThreadPoolExecutor, as_completed, wait, FIRST_COMPLETED
+import time
+import zlib
+from src.client.ChunkServerConnection import ChunkServerConnection, CancelToken
 from src.client.CoordinatorConnection import CoordinatorConnection
+from src.client.FileStream import FileStream
+from src.client.ReplicaSelector import ReplicaSelector
+from src.client.TransferJournal import TransferJournal
+from src.common.protocol import LEGACY_VERSION
+from src.common.ConnectionPool import ConnectionPool
+from src.common.ReedSolomon import rebuild_stripe_member
 
 
 class DownloadManager:
@@ -12,67 +23,344 @@ class DownloadManager:
         Handle downloading, reassembling and writing files
     '''
 
-    def __init__(self, coordinator_connection: CoordinatorConnection, user_id):
+    def __init__(self, coordinator_connection: CoordinatorConnection, user_id, pool: Optional[ConnectionPool] = None):
         self.coordinator_connection = coordinator_connection
+        self.pool = pool or coordinator_connection.pool
         self.user_id = user_id
+        self.replica_selector = ReplicaSelector() # per-server latency and error history, shared by all reads
+        self.hedge_executor = ThreadPoolExecutor(max_workers=32) # runs the (possibly racing) per-replica requests
         self.cache_path = Path.home() / '512_dfs_cache'
         self.cache_path.mkdir(parents=True, exist_ok=True)
 
     
-    def download_file(self, file_id):
-        chunk_server_info = self.coordinator_connection.get_chunk_locations(file_id) # form [file_id: file_id, chunks: [{chunk_id, chunk_index, chunk_server_locations],...]
-        print(chunk_server_info)
-        chunks = chunk_server_info['chunks']
+    def download_file(self, file_id, output_path='output.pdf', max_workers=8):
+        """
+        Download a file to output_path, writing it under a .part name until every chunk is in place.
+        Chunks written are journaled, so if the download fails the .part file is kept for resume_download
+        """
+        partial_path = f'{output_path}.part'
+        journal = None
+        try:
+            chunks = self.get_sorted_chunks(file_id)
+            if all(chunk.get('chunk_size') is not None for chunk in chunks):
+                journal = TransferJournal.create(self.cache_path, 'download', file_id, {
+                    'output_path': os.path.abspath(output_path),
+                    'file_size': sum(chunk['chunk_size'] for chunk in chunks)
+                })
+                self.write_chunks_in_place(chunks, partial_path, max_workers, journal)
+            else:
+                # Without chunk sizes the offsets are unknown, so append chunks in order
+                with open(partial_path, 'wb') as output_file:
+                    for data in self.stream_chunks(chunks, read_ahead=max_workers):
+                        output_file.write(data)
+        except Exception as e:
+            print(f"Failed to download file {file_id}: {e}")
+            if journal is not None:
+                journal.close()
+                print(f"Kept {partial_path} with {len(journal.completed)} chunks, run resume_download to fetch the rest.")
+            elif os.path.exists(partial_path):
+                os.remove(partial_path)
+            return False
 
+        os.replace(partial_path, output_path)
+        if journal is not None:
+            journal.finish()
+        print(f"File {file_id} downloaded to {output_path} successfully.")
+        return True
 
-        futures = []
-        downloaded_chunks = {}
 
-        # Set up parallel downloads
-        with ThreadPoolExecutor() as executor:
+    def resume_download(self, file_id, output_path=None, max_workers=8):
+        """
+        Finish a download that failed part way: chunks the journal records as written are verified
+        against their checksums in the .part file and only the missing or damaged ones are fetched
+        """
+        journal = TransferJournal.load(self.cache_path, 'download', file_id)
+        if journal is None:
+            print(f"No interrupted download of {file_id} to resume, downloading it in full.")
+            return self.download_file(file_id, output_path or 'output.pdf', max_workers)
+        output_path = output_path or journal.info['output_path']
+        partial_path = f'{output_path}.part'
+
+        try:
+            chunks = self.get_sorted_chunks(file_id)
+            if not os.path.exists(partial_path) or os.path.getsize(partial_path) != journal.info['file_size'] or \
+                    sum(chunk.get('chunk_size') or 0 for chunk in chunks) != journal.info['file_size']:
+                journal.close()
+                print(f"Partial download of {file_id} is missing or the file has changed, downloading it in full.")
+                return self.download_file(file_id, output_path, max_workers)
+
+            offsets = itertools.accumulate((chunk['chunk_size'] for chunk in chunks), initial=0)
+            written = set()
+            with open(partial_path, 'rb') as partial_file:
+                for chunk, offset in zip(chunks, offsets):
+                    record = journal.completed.get(chunk['chunk_index'])
+                    if record is None or record.get('chunk_id') != chunk['chunk_id']:
+                        continue
+                    partial_file.seek(offset)
+                    if zlib.crc32(partial_file.read(chunk['chunk_size'])) == record.get('checksum'):
+                        written.add(chunk['chunk_index'])
+
+            print(f"Resuming download of {file_id}: {len(written)} chunks already written, {len(chunks) - len(written)} to go.")
+            self.write_chunks_in_place(chunks, partial_path, max_workers, journal, written)
+        except Exception as e:
+            journal.close()
+            print(f"Failed to resume download of file {file_id}: {e}")
+            return False
+
+        os.replace(partial_path, output_path)
+        journal.finish()
+        print(f"File {file_id} downloaded to {output_path} successfully.")
+        return True
+
+
+    def write_chunks_in_place(self, chunks: List[Dict], path, max_workers=8, journal: Optional[TransferJournal] = None, written=()):
+        """
+        Preallocate the file and have each worker write its chunk at the chunk's offset as soon as it
+        arrives, so memory holds at most max_workers chunks whatever the file size. Chunks whose index
+        is in written are already in an existing file at path and are skipped
+        """
+        offsets = list(itertools.accumulate((chunk['chunk_size'] for chunk in chunks), initial=0))
+        if written:
+            fd = os.open(path, os.O_WRONLY)
+        else:
+            fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+        try:
+            if offsets[-1] and not written:
+                try:
+                    os.posix_fallocate(fd, 0, offsets[-1]) # reserve the blocks up front
+                except (AttributeError, OSError):
+                    os.ftruncate(fd, offsets[-1])
+            executor = ThreadPoolExecutor(max_workers=max_workers)
+            futures = [executor.submit(self.fetch_and_write, fd, chunk, offset, journal)
+                       for chunk, offset in zip(chunks, offsets) if chunk['chunk_index'] not in written]
+            try:
+                for future in as_completed(futures):
+                    future.result()
+            finally:
+                # On failure skip the chunks not started yet, but let running writers finish before fd is closed
+                for future in futures:
+                    future.cancel()
+                executor.shutdown(wait=True)
+        finally:
+            os.close(fd)
+
+
+    def fetch_and_write(self, fd, chunk: Dict, offset, journal: Optional[TransferJournal] = None):
+        chunk_index, data = self.fetch_chunk(chunk)
+        if data is None:
+            raise IOError(f"Failed to download chunk {chunk_index} from all replicas")
+        if len(data) != chunk['chunk_size']:
+            raise IOError(f"Chunk {chunk_index} is {len(data)} bytes, expected {chunk['chunk_size']}")
+        view = memoryview(data)
+        position = offset
+        while view:
+            count = os.pwrite(fd, view, position)
+            view = view[count:]
+            position += count
+        if journal is not None:
+            journal.record(chunk_index, chunk_id=chunk['chunk_id'], checksum=zlib.crc32(data))
+
+
+    def get_sorted_chunks(self, file_id) -> List[Dict]:
+        chunk_server_info = self.coordinator_connection.get_chunk_locations(file_id) # form [file_id: file_id, chunks: [{chunk_id, chunk_index, chunk_size, chunk_server_locations],...]
+        if not chunk_server_info or 'chunks' not in chunk_server_info:
+            raise FileNotFoundError(f"No chunk locations for file {file_id}")
+        return self.sorted_chunks(chunk_server_info)
+
+
+    @staticmethod
+    def sorted_chunks(chunk_server_info) -> List[Dict]:
+        """The chunks of a file by index, each with its stripe when the file is erasure coded"""
+        chunks = sorted(chunk_server_info['chunks'], key=lambda chunk: chunk['chunk_index'])
+        erasure = chunk_server_info.get('erasure')
+        if erasure:
             for chunk in chunks:
-                chunk_id = chunk["chunk_id"]
-                chunk_index = chunk["chunk_index"]
-                servers = chunk['chunk_server_locations']
-                # Only schedule a download if there are servers for the chunk
-                if len(servers) > 0:
-                    # Attempt download from each server replica 
-                    future = executor.submit(self.download_chunk_from_servers, chunk_id, chunk_index, servers)
-                    futures.append(future)
-
-            # Process download results
+                chunk['stripe'] = erasure['stripes'][chunk['chunk_index'] // erasure['data_shards']]
+        return chunks
+
+
+    def stream_file(self, file_id, offset=0, read_ahead=4) -> Iterator[bytes]:
+        """Yield the bytes of a file in order from offset as soon as each chunk arrives"""
+        return self.stream_chunks(self.get_sorted_chunks(file_id), offset, read_ahead)
+
+
+    def open_file(self, file_id, read_ahead=4) -> io.BufferedReader:
+        """Open a file for streaming, seekable reads"""
+        return io.BufferedReader(FileStream(self, file_id, read_ahead))
+
+
+    def stream_chunks(self, chunks: List[Dict], offset=0, read_ahead=4) -> Iterator[bytes]:
+        """
+        Yield the bytes of the given chunks (sorted by index) from offset, with at most
+        read_ahead chunk fetches in flight ahead of the consumer
+        """
+        if all(chunk.get('chunk_size') is not None for chunk in chunks):
+            file_size = sum(chunk['chunk_size'] for chunk in chunks)
+            slices = self.covering_slices(chunks, offset, max(file_size - offset, 0))
+            skip = 0
+        else:
+            # Without chunk sizes the offset can only be found by reading up to it
+            slices = [(chunk, None, None) for chunk in chunks]
+            skip = offset
+
+        executor = ThreadPoolExecutor(max_workers=read_ahead)
+        pending = collections.deque()
+        remaining = iter(slices)
+        try:
+            for chunk, chunk_offset, slice_length in itertools.islice(remaining, read_ahead):
+                pending.append(self.submit_slice(executor, chunk, chunk_offset, slice_length))
+
+            while pending:
+                chunk_index, data = pending.popleft().result()
+                if data is None:
+                    raise IOError(f"Failed to download chunk {chunk_index} from all replicas")
+                # Refill the window before handing the data over, so fetching overlaps consumption
+                for chunk, chunk_offset, slice_length in itertools.islice(remaining, 1):
+                    pending.append(self.submit_slice(executor, chunk, chunk_offset, slice_length))
+
+                if skip:
+                    skipped = min(skip, len(data))
+                    data = data[skipped:]
+                    skip -= skipped
+                if data:
+                    yield data
+        finally:
+            for future in pending:
+                future.cancel()
+            executor.shutdown(wait=False)
+
+
+    def submit_slice(self, executor, chunk, chunk_offset, slice_length):
+        return executor.submit(self.fetch_chunk, chunk, chunk_offset, slice_length)
+
+
+    def read_range(self, file_id, offset, length) -> Optional[bytes]:
+        """Read length bytes of a file from offset, fetching only the slices of the chunks that cover them"""
+        if offset < 0 or length < 0:
+            raise ValueError("offset and length must not be negative")
+        chunk_server_info = self.coordinator_connection.get_chunk_locations(file_id)
+        if not chunk_server_info or 'chunks' not in chunk_server_info:
+            print(f"No chunk locations for file {file_id}")
+            return None
+        chunks = self.sorted_chunks(chunk_server_info)
+
+        if any(chunk.get('chunk_size') is None for chunk in chunks):
+            # Files registered before chunk sizes were recorded cannot be mapped to a range, fetch them whole
+            print(f"File {file_id} has no chunk sizes recorded, downloading every chunk")
+            slices = [(chunk, None, None) for chunk in chunks]
+        else:
+            slices = self.covering_slices(chunks, offset, length)
+
+        parts = {}
+        with ThreadPoolExecutor() as executor:
+            futures = [executor.submit(self.fetch_chunk, chunk, chunk_offset, slice_length)
+                       for chunk, chunk_offset, slice_length in slices]
             for future in as_completed(futures):
                 chunk_index, chunk_data = future.result()
-                print('\n chunk_index', chunk_index)
+                if chunk_data is None:
+                    print(f"Failed to read range {offset}+{length} of file {file_id}")
+                    return None
+                parts[chunk_index] = chunk_data
+
+        data = b''.join(parts[index] for index in sorted(parts))
+        if slices and slices[0][1] is None:
+            return data[offset:offset + length]
+        return data
+
+
+    @staticmethod
+    def covering_slices(chunks: List[Dict], offset, length):
+        """(chunk, offset in chunk, length in chunk) for every chunk overlapping [offset, offset + length)"""
+        slices = []
+        end = offset + length
+        chunk_start = 0
+        for chunk in chunks:
+            chunk_end = chunk_start + chunk['chunk_size']
+            if chunk_start >= end:
+                break
+            if chunk_end > offset:
+                slice_start = max(offset, chunk_start)
+                slices.append((chunk, slice_start - chunk_start, min(end, chunk_end) - slice_start))
+            chunk_start = chunk_end
+        return slices
+
+
+    def fetch_chunk(self, chunk: Dict, offset=None, length=None):
+        """
+        Download a chunk, or a range of it, from its replicas. A chunk of an erasure coded file that no
+        server can send is rebuilt from the rest of its stripe instead
+        """
+        chunk_index, data = self.download_chunk_from_servers(chunk['chunk_id'], chunk['chunk_index'], chunk['chunk_server_locations'],
+                                                             offset, length)
+        stripe = chunk.get('stripe')
+        if data is None and stripe:
+            print(f"Rebuilding chunk {chunk['chunk_id']} from the rest of its stripe")
+            index = next(position for position, member in enumerate(stripe['members'])
+                         if member is not None and member['chunk_id'] == chunk['chunk_id'])
+            try:
+                data = rebuild_stripe_member(stripe, index, self.fetch_stripe_member)
+            except IOError as e:
+                print(f"Failed to rebuild chunk {chunk['chunk_id']}: {e}")
+                return chunk_index, None
+            data = ChunkServerConnection.slice_range(data, offset, length)
+        return chunk_index, data
+
+
+    def fetch_stripe_member(self, member: Dict) -> Optional[bytes]:
+        return self.download_chunk_from_servers(member['chunk_id'], None, member['chunk_server_locations'])[1]
+
+
+    def download_chunk_from_servers(self, chunk_id: str, chunk_index: int, servers: List[Dict], offset=None, length=None):
+        """
+        Download a chunk, or a range of it, trying the fastest healthy replica first. If it has not
+        answered by the hedge deadline the next replica is asked as well and the slower one is cancelled.
+        """
+        candidates = iter(self.replica_selector.rank(servers))
+        attempts = {} # future -> CancelToken
+
+        def launch():
+            server_info = next(candidates, None)
+            if server_info is None:
+                return False
+            cancel = CancelToken()
+            attempts[self.hedge_executor.submit(self.fetch_from_server, chunk_id, server_info, offset, length, cancel)] = cancel
+            return True
+
+        exhausted = not launch()
+        while attempts:
+            # At most two requests race; once every replica has been asked just wait for them
+            timeout = self.replica_selector.hedge_delay() if len(attempts) < 2 and not exhausted else None
+            done, _ = wait(attempts, timeout=timeout, return_when=FIRST_COMPLETED)
+            if not done:
+                print(f"Hedging read of chunk {chunk_id} to another replica")
+                exhausted = not launch()
+                continue
+
+            for future in done:
+                del attempts[future]
+                chunk_data = future.result()
                 if chunk_data is not None:
-                    downloaded_chunks[chunk_index] = chunk_data
-                else:
-                    print("Failed to download one or more chunks.")
-                    return False
-
-        # Reassemble file 
-        self.assemble_file(file_id, downloaded_chunks, 'output.pdf') #replace file name
-        print(f"File {file_id} downloaded and assembled successfully.")
-        return True
-        
-    
-    def download_chunk_from_servers(self, chunk_id: str, chunk_index: int, servers: List[Dict]):
-        """Attempt to download a chunk from the list of servers in order"""
-        for server_info in servers:
-            server = ChunkServerConnection(self.user_id, server_info["chnk_srv_addr"], server_info["chnk_srv_port"], server_info["chnk_srv_id"])
-            chunk_data = server.download_chunk(chunk_id)
-            if chunk_data is not None:
-                print(f"Downloaded chunk {chunk_id} from server {server.chunk_server_id}")
-                return chunk_index, chunk_data
+                    for cancel in attempts.values():
+                        cancel.cancel()
+                    return chunk_index, chunk_data
+            if not exhausted:
+                exhausted = not launch() # replace the failed request right away
+
         print(f"Failed to download chunk {chunk_id} from all replicas.")
         return chunk_index, None
 
 
-    def assemble_file(self, file_id: str, downloaded_chunks: Dict[int, bytes], output_file_name):
-        print('\ndownloaded chunks', downloaded_chunks)
-        indexes = downloaded_chunks.keys()
-        sorted_indexes = sorted(indexes)
-        with open(output_file_name, 'wb') as output_file:
-            for index in sorted_indexes:
-                binary_data = downloaded_chunks[index]
-                output_file.write(binary_data)
\ No newline at end of file
+    def fetch_from_server(self, chunk_id, server_info, offset, length, cancel: CancelToken):
+        wire_protocol = min(self.coordinator_connection.wire_protocol, server_info.get("wire_protocol", LEGACY_VERSION))
+        server = ChunkServerConnection(self.user_id, server_info["chnk_srv_addr"], server_info["chnk_srv_port"], server_info["chnk_srv_id"], wire_protocol=wire_protocol, pool=self.pool)
+        start = time.monotonic()
+        chunk_data = server.download_chunk(chunk_id, offset, length, cancel)
+        latency = time.monotonic() - start
+        if cancel.cancelled:
+            # Lost the race: the time until the cancel understates how slow the server is and it is not an error,
+            # so it is not recorded at all
+            return None
+        self.replica_selector.record(server.chunk_server_id, latency, ok=chunk_data is not None)
+        if chunk_data is not None:
+            print(f"Downloaded chunk {chunk_id} from server {server.chunk_server_id}")
+        return chunk_data
@@ -0,0 +1,84 @@
+from typing import *
+import io
+
+
+class FileStream(io.RawIOBase):
+    '''
+    Read-only, seekable file object over a DFS file.
+
+    Reads are served from DownloadManager.stream_chunks, which keeps a bounded window of
+    chunk fetches in flight ahead of the reader. Seeking restarts the stream at the new
+    position, fetching only the part of the first chunk that is needed.
+    '''
+    def __init__(self, download_manager, file_id, read_ahead=4):
+        super().__init__()
+        self.download_manager = download_manager
+        self.file_id = file_id
+        self.read_ahead = read_ahead
+        self.chunks = download_manager.get_sorted_chunks(file_id)
+        self.position = 0
+        self.stream: Optional[Iterator[bytes]] = None
+        self.buffer = memoryview(b'') # unread part of the current chunk
+
+
+    def readable(self):
+        return True
+
+
+    def seekable(self):
+        return True
+
+
+    def size(self):
+        if any(chunk.get('chunk_size') is None for chunk in self.chunks):
+            raise io.UnsupportedOperation(f'File {self.file_id} has no chunk sizes recorded')
+        return sum(chunk['chunk_size'] for chunk in self.chunks)
+
+
+    def readinto(self, b):
+        if not self.buffer:
+            if self.stream is None:
+                self.stream = self.download_manager.stream_chunks(self.chunks, self.position, self.read_ahead)
+            try:
+                self.buffer = memoryview(next(self.stream))
+            except StopIteration:
+                return 0
+        n = min(len(b), len(self.buffer))
+        b[:n] = self.buffer[:n]
+        self.buffer = self.buffer[n:]
+        self.position += n
+        return n
+
+
+    def tell(self):
+        return self.position
+
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        if whence == io.SEEK_SET:
+            position = offset
+        elif whence == io.SEEK_CUR:
+            position = self.position + offset
+        elif whence == io.SEEK_END:
+            position = self.size() + offset
+        else:
+            raise ValueError(f'Invalid whence {whence}')
+        if position < 0:
+            raise ValueError(f'Negative seek position {position}')
+
+        if position != self.position:
+            self.close_stream()
+            self.position = position
+        return self.position
+
+
+    def close_stream(self):
+        if self.stream is not None:
+            self.stream.close() # cancels the fetches still in flight
+            self.stream = None
+        self.buffer = memoryview(b'')
+
+
+    def close(self):
+        self.close_stream()
+        super().close()
@@ -0,0 +1,62 @@
+from typing import *
+import collections
+import random
+import threading
+
+
+class ReplicaSelector:
+    '''
+    Track how each ChunkServer has been serving reads and order replicas by it.
+
+    Keeps an exponentially weighted moving average of latency and of the error rate per
+    server, plus a window of recent latencies whose high percentile becomes the deadline
+    after which a read is hedged to another replica.
+    '''
+    def __init__(self, alpha=0.2, error_penalty=10.0, hedge_percentile=0.95, min_hedge_delay=0.01,
+                 default_hedge_delay=1.0, min_samples=20, window=512):
+        self.alpha = alpha # weight of the newest sample in the averages
+        self.error_penalty = error_penalty # how much an error rate of 1 multiplies a server's latency
+        self.hedge_percentile = hedge_percentile
+        self.min_hedge_delay = min_hedge_delay # seconds
+        self.default_hedge_delay = default_hedge_delay # used until min_samples latencies have been seen
+        self.min_samples = min_samples
+
+        self.lock = threading.Lock()
+        self.latency = {} # chnk_srv_id -> EWMA of read latency in seconds
+        self.errors = collections.defaultdict(float) # chnk_srv_id -> EWMA of failed reads (0 to 1)
+        self.recent = collections.deque(maxlen=window) # latencies of recent reads from any server
+
+
+    def record(self, server_id, latency, ok=True):
+        with self.lock:
+            if ok:
+                self.recent.append(latency)
+            else:
+                # A failure costs at least a hedge delay, so a server that only ever fails is not scored as instant.
+                # Kept out of recent, where it would stretch the hedge deadline for every read
+                latency = max(latency, self.default_hedge_delay)
+            previous = self.latency.get(server_id)
+            self.latency[server_id] = latency if previous is None else previous + self.alpha * (latency - previous)
+            self.errors[server_id] += self.alpha * ((0.0 if ok else 1.0) - self.errors[server_id])
+
+
+    def score(self, server_id):
+        # Servers never read from score 0 so they get tried and measured
+        return self.latency.get(server_id, 0.0) * (1 + self.error_penalty * self.errors[server_id])
+
+
+    def rank(self, servers: List[Dict]) -> List[Dict]:
+        '''Replicas ordered fastest and healthiest first, ties in random order'''
+        servers = list(servers)
+        random.shuffle(servers)
+        with self.lock:
+            return sorted(servers, key=lambda server: self.score(server['chnk_srv_id']))
+
+
+    def hedge_delay(self):
+        '''Seconds to wait on a read before asking another replica as well'''
+        with self.lock:
+            if len(self.recent) < self.min_samples:
+                return self.default_hedge_delay
+            latencies = sorted(self.recent)
+        return max(latencies[min(int(len(latencies) * self.hedge_percentile), len(latencies) - 1)], self.min_hedge_delay)
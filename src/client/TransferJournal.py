@@ -0,0 +1,69 @@
+from typing import *
+import json
+import os
+import threading
+from pathlib import Path
+
+
+class TransferJournal:
+    '''
+    Local record of an upload or download in progress, kept in ~/512_dfs_cache/transfers so a
+    transfer that fails part way can be resumed. The first line describes the transfer and every
+    later line records one chunk that finished, with its checksum.
+    '''
+    def __init__(self, path: Path, info: dict, completed: Optional[Dict[int, dict]] = None):
+        self.path = path
+        self.info = info
+        self.completed = completed or {} # chunk_index -> record of the finished chunk
+        self.lock = threading.Lock()
+        self.file = open(path, 'a')
+
+
+    @staticmethod
+    def journal_path(cache_path: Path, kind, file_id) -> Path:
+        transfers_path = cache_path / 'transfers'
+        transfers_path.mkdir(parents=True, exist_ok=True)
+        return transfers_path / f"{kind}_{file_id.replace(os.sep, '_')}.journal"
+
+
+    @classmethod
+    def create(cls, cache_path: Path, kind, file_id, info: dict) -> 'TransferJournal':
+        path = cls.journal_path(cache_path, kind, file_id)
+        info = dict(info, kind=kind, file_id=file_id)
+        with open(path, 'w') as journal_file:
+            journal_file.write(json.dumps(info) + '\n')
+        return cls(path, info)
+
+
+    @classmethod
+    def load(cls, cache_path: Path, kind, file_id) -> Optional['TransferJournal']:
+        path = cls.journal_path(cache_path, kind, file_id)
+        if not path.exists():
+            return None
+        completed = {}
+        with open(path, 'r') as journal_file:
+            info = json.loads(journal_file.readline())
+            for line in journal_file:
+                if not line.endswith('\n'):
+                    break # torn by a crash while recording, that chunk is simply redone
+                record = json.loads(line)
+                completed[record['chunk_index']] = record
+        return cls(path, info, completed)
+
+
+    def record(self, chunk_index, **details):
+        with self.lock:
+            record = dict(details, chunk_index=chunk_index)
+            self.completed[chunk_index] = record
+            self.file.write(json.dumps(record) + '\n')
+            self.file.flush()
+
+
+    def close(self):
+        self.file.close()
+
+
+    def finish(self):
+        '''The transfer completed, the journal is no longer needed'''
+        self.close()
+        self.path.unlink(missing_ok=True)
@@ -1,76 +1,381 @@
 from typing import *
 import uuid
+import os
+import threading
 from concurrent.futures import ThreadPoolExecutor, as_completed
 from pathlib import Path
 import json
+import zlib
 from src.client.CoordinatorConnection import CoordinatorConnection
 from src.client.ChunkServerConnection import ChunkServerConnection
+from src.client.TransferJournal import TransferJournal
+from src.common import compression
+from src.common.ReedSolomon import ReedSolomon
+from src.common.protocol import LEGACY_VERSION
+from src.common.ConnectionPool import ConnectionPool
 
 
 class UploadManager:
     '''Read, chunk and upload file''' 
     
-    def __init__(self, coordinator_connection: CoordinatorConnection, user_id, max_workers=10):
-        self.max_workers = 10
+    def __init__(self, coordinator_connection: CoordinatorConnection, user_id, max_workers=10, pool: Optional[ConnectionPool] = None,
+                 compression: Optional[str] = None):
+        self.max_workers = max_workers
+        self.compression = compression # codec for chunks that compress well, None to upload every chunk as is
+        self.pool = pool or coordinator_connection.pool
         self.user_id = user_id
         self.chunk_server_map = {}
+        self.max_placements = 3 # chains tried for a chunk, each without the servers that failed the ones before
         self.coordinator_connection = coordinator_connection
         self.cache_path = Path.home() / '512_dfs_cache'
         self.cache_path.mkdir(parents=True, exist_ok=True)
 
 
-    def upload_file(self, file_location, chunk_size_mb, file_id):
-        chunk_server_info = self.coordinator_connection.get_chunk_servers() # form [{chnk_srv_addr, chnk_srv_port, chnk_srv_id}, ...]
-        print(chunk_server_info)
-        self.chunk_servers = [
-            ChunkServerConnection(self.user_id, server['chnk_srv_addr'], server['chnk_srv_port'], server['chnk_srv_id'])
-            for server in chunk_server_info
-        ]
+    def upload_file(self, file_location, chunk_size_mb, file_id, max_in_flight=None, max_in_flight_bytes=None, erasure=None):
+        '''
+        Upload a file in chunks. At most max_in_flight chunks (default max_workers), or as many as fit
+        in max_in_flight_bytes, are read or uploading at once; the next chunk is only queued when one of
+        them finishes, and each worker reads its own chunk with os.pread, so memory stays bounded
+        whatever the file size. Finished chunks are journaled so a failed upload can be finished with
+        resume_upload.
 
+        erasure=(data_shards, parity_shards) stores the file erasure coded instead of replicated: every
+        data_shards consecutive chunks form a stripe, stored once each together with parity_shards
+        parity chunks, and any data_shards chunks of a stripe are enough to rebuild the others
+        '''
         chunk_size_bytes = chunk_size_mb * 1024 * 1024
-        futures = []
-        all_success = True  
+        stat = os.stat(file_location)
+        file_size = stat.st_size
+        num_chunks = -(-file_size // chunk_size_bytes)
+
+        chunks = []
+        for chunk_index in range(num_chunks):
+            offset = chunk_index * chunk_size_bytes
+            chunks.append({"chunk_id": f"{file_id}_{uuid.uuid4()}", "chunk_index": chunk_index,
+                           "offset": offset, "chunk_size": min(chunk_size_bytes, file_size - offset)})
+
+        info = {
+            'file_location': os.path.abspath(file_location),
+            'file_size': file_size,
+            'mtime_ns': stat.st_mtime_ns,
+            'chunk_size': chunk_size_bytes,
+            'chunks': chunks
+        }
+        parity_chunks = []
+        if erasure:
+            data_shards, parity_shards = erasure
+            ReedSolomon(data_shards, parity_shards) # rejects unsupported codes before anything is sent
+            for stripe in range(-(-num_chunks // data_shards)):
+                # Parity chunks are as large as the stripe's largest data chunk; journaled after the data chunks
+                shard_size = min(chunk_size_bytes, file_size - stripe * data_shards * chunk_size_bytes)
+                for position in range(parity_shards):
+                    parity_chunks.append({"chunk_id": f"{file_id}_{uuid.uuid4()}", "chunk_index": num_chunks + stripe * parity_shards + position,
+                                          "stripe": stripe, "chunk_size": shard_size})
+            info['erasure'] = [data_shards, parity_shards]
+            info['parity_chunks'] = parity_chunks
+
+        journal = TransferJournal.create(self.cache_path, 'upload', file_id, info)
+        return self.upload_chunks(journal, chunks, max_in_flight, max_in_flight_bytes, parity_chunks)
+
+
+    def resume_upload(self, file_id, max_in_flight=None, max_in_flight_bytes=None):
+        '''
+        Finish an upload that failed part way: chunks the journal records as uploaded are checked
+        against the local file and only the missing or changed ones are sent before registering the file
+        '''
+        journal = TransferJournal.load(self.cache_path, 'upload', file_id)
+        if journal is None:
+            print(f"No interrupted upload of {file_id} to resume.")
+            return False
+        info = journal.info
+        file_location = info['file_location']
+        try:
+            stat = os.stat(file_location)
+        except OSError as e:
+            print(f"Cannot resume upload of {file_id}: {e}")
+            journal.close()
+            return False
+        if stat.st_size != info['file_size']:
+            print(f"Cannot resume upload of {file_id}: {file_location} changed size since the upload started.")
+            journal.close()
+            return False
+
+        # Anything uploaded from data that has changed since must be sent again
+        missing = []
+        fd = os.open(file_location, os.O_RDONLY)
+        try:
+            for chunk in info['chunks']:
+                record = journal.completed.get(chunk['chunk_index'])
+                if record is None or record.get('chunk_id') != chunk['chunk_id'] or \
+                        zlib.crc32(self.read_chunk(fd, chunk['offset'], chunk['chunk_size'])) != record.get('checksum'):
+                    missing.append(chunk)
+        finally:
+            os.close(fd)
+
+        # Parity is recomputed for every stripe with a data chunk to send, in case that chunk changed
+        missing_parity = []
+        if info.get('erasure'):
+            stale_stripes = {chunk['chunk_index'] // info['erasure'][0] for chunk in missing}
+            for parity in info['parity_chunks']:
+                record = journal.completed.get(parity['chunk_index'])
+                if record is None or record.get('chunk_id') != parity['chunk_id'] or parity['stripe'] in stale_stripes:
+                    missing_parity.append(parity)
+
+        print(f"Resuming upload of {file_id}: {len(info['chunks']) - len(missing)} chunks already uploaded, {len(missing)} to go.")
+        return self.upload_chunks(journal, missing, max_in_flight, max_in_flight_bytes, missing_parity)
+
+
+    def upload_chunks(self, journal: TransferJournal, chunks: List[Dict], max_in_flight=None, max_in_flight_bytes=None, parity_chunks=None):
+        '''Upload the given chunks of a journaled upload and register the file once every chunk is stored'''
+        info = journal.info
+        file_id = info['file_id']
+        chunk_size_bytes = info['chunk_size']
+        all_success = True
+
+        if info.get('erasure'):
+            all_success = self.upload_stripes(journal, chunks, parity_chunks or [], max_in_flight, max_in_flight_bytes)
+
+        elif chunks:
+            # The Coordinator picks a primary and replica targets for every chunk
+            chunk_server_info, placement = self.coordinator_connection.get_placement(len(chunks), chunk_size_bytes) # form [{chnk_srv_addr, chnk_srv_port, chnk_srv_id, wire_protocol}, ...]
+            print(chunk_server_info)
+            self.chunk_servers = [
+                self.connect(server)
+                for server in chunk_server_info
+            ]
+            servers_by_id = {server.chunk_server_id: server for server in self.chunk_servers}
+            peers_by_id = {server['chnk_srv_id']: (server['chnk_srv_addr'], server['chnk_srv_port'], server.get('wire_protocol', LEGACY_VERSION))
+                           for server in chunk_server_info}
+
+            futures = []
+            server_count = len(self.chunk_servers)
+
+            if max_in_flight_bytes is not None:
+                max_in_flight = max(max_in_flight_bytes // chunk_size_bytes, 1)
+            max_in_flight = max_in_flight or self.max_workers
+            window = threading.BoundedSemaphore(max_in_flight) # chunks queued, being read or uploading
+
+            fd = os.open(info['file_location'], os.O_RDONLY)
+            try:
+                with ThreadPoolExecutor(max_workers=min(self.max_workers, max_in_flight)) as executor:
+                    for position, chunk in enumerate(chunks):
+                        if placement:
+                            primary_id, *replica_ids = placement[position % len(placement)]
+                            server = servers_by_id[primary_id]
+                            replicas = [peers_by_id[replica_id] for replica_id in replica_ids]
+                        else:
+                            server = self.chunk_servers[position % server_count]
+                            replicas = None # the ChunkServer picks replica targets itself
+
+                        # Backpressure: wait for a slot before queuing another chunk
+                        window.acquire()
+                        future = executor.submit(self.read_and_upload, fd, chunk['offset'], chunk['chunk_size'], server,
+                                                 chunk['chunk_id'], chunk['chunk_index'], file_id, replicas, journal)
+                        future.add_done_callback(lambda _: window.release())
+                        futures.append(future)
+
+                    # Process upload results
+                    for future in as_completed(futures):
+                        success = future.result()
+                        if not success:
+                            print("One or more chunks failed to upload after retries.")
+                            all_success = False
+            finally:
+                os.close(fd)
+
+        if not all_success:
+            journal.close()
+            print(f"File {file_id} upload encountered errors, run resume_upload to send the missing chunks.")
+            return False
+
+        #client is keeping track of the chunks and which chunkservers are storing them...!
         chunk_metadata = []
-        server_count = len(self.chunk_servers)
+        for chunk in info['chunks']:
+            record = journal.completed[chunk['chunk_index']]
+            chunk_metadata.append({"chunk_id": chunk['chunk_id'], "chunk_index": chunk['chunk_index'], "chunk_size": chunk['chunk_size'],
+                                   'chunk_server_id': record['chunk_server_id'], 'chunk_server_addr': record['chunk_server_addr'],
+                                   'chunk_server_port': record['chunk_server_port']})
+
+        erasure = None
+        if info.get('erasure'):
+            data_shards, parity_shards = info['erasure']
+            parity = [[] for _ in range(-(-len(info['chunks']) // data_shards))]
+            for parity_chunk in info['parity_chunks']:
+                parity[parity_chunk['stripe']].append(parity_chunk['chunk_id'])
+            erasure = {'data_shards': data_shards, 'parity_shards': parity_shards, 'parity': parity}
+
+        print(f"File {file_id} uploaded successfully in {len(chunk_metadata)} chunks.")
+        self.save_metadata(file_id, chunk_metadata)
+        self.coordinator_connection.register_new_file(file_id, chunk_metadata, erasure)
+        journal.finish()
+        return True
 
-        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
-            with open(file_location, 'rb') as file:
-                chunk_index = 0
 
-                while True:
-                    chunk = file.read(chunk_size_bytes)
-                    if not chunk:
-                        break
+    def upload_stripes(self, journal: TransferJournal, chunks: List[Dict], parity_chunks: List[Dict], max_in_flight=None,
+                       max_in_flight_bytes=None) -> bool:
+        '''
+        Upload the given data and parity chunks of an erasure coded file, a stripe at a time. Every chunk
+        is stored once, on a ChunkServer of its own within the stripe when there are enough of them
+        '''
+        info = journal.info
+        data_shards, parity_shards = info['erasure']
+        stripe_width = data_shards + parity_shards
+        stripes = sorted({chunk['chunk_index'] // data_shards for chunk in chunks} | {parity['stripe'] for parity in parity_chunks})
+        if not stripes:
+            return True
+
+        # One placement entry per stripe: the ChunkServers for its data chunks, then for its parity chunks
+        chunk_server_info, placement = self.coordinator_connection.get_placement(len(stripes), info['chunk_size'], replication=stripe_width)
+        if not chunk_server_info:
+            return False
+        if len(chunk_server_info) < stripe_width:
+            print(f"Only {len(chunk_server_info)} ChunkServers for stripes of {stripe_width} chunks, "
+                  f"losing one ChunkServer may lose more than {parity_shards} chunks of a stripe.")
+        servers = [
+            self.connect(server)
+            for server in chunk_server_info
+        ]
+        servers_by_id = {server.chunk_server_id: server for server in servers}
 
-                    chunk_id = f"{file_id}_{uuid.uuid4()}"
-                    server = self.chunk_servers[chunk_index % server_count]
+        # A stripe's data chunks are all held in memory to compute its parity
+        if max_in_flight_bytes is not None:
+            max_in_flight = max(max_in_flight_bytes // (info['chunk_size'] * data_shards), 1)
+        max_in_flight = max_in_flight or max(self.max_workers // stripe_width, 1)
+        window = threading.BoundedSemaphore(max_in_flight) # stripes queued, being read or uploading
 
-                    future = executor.submit(server.upload_chunk, chunk_id, chunk, chunk_index, file_id)
+        all_success = True
+        futures = []
+        fd = os.open(info['file_location'], os.O_RDONLY)
+        try:
+            with ThreadPoolExecutor(max_workers=min(self.max_workers, max_in_flight)) as executor:
+                for position, stripe in enumerate(stripes):
+                    if placement:
+                        targets = [servers_by_id[server_id] for server_id in placement[position % len(placement)]]
+                    else:
+                        targets = [servers[(position * stripe_width + member) % len(servers)] for member in range(stripe_width)]
+                    members = [targets[member % len(targets)] for member in range(stripe_width)]
+
+                    window.acquire()
+                    future = executor.submit(self.upload_stripe, fd, journal, stripe, members,
+                                             [chunk for chunk in chunks if chunk['chunk_index'] // data_shards == stripe],
+                                             [parity for parity in parity_chunks if parity['stripe'] == stripe])
+                    future.add_done_callback(lambda _: window.release())
                     futures.append(future)
 
-                    #client is keeping track of the chunks and which chunkservers are storing them...!
-                    chunk_metadata.append({"chunk_id": chunk_id, "chunk_index": chunk_index, 'chunk_server_id': server.chunk_server_id, 'chunk_server_addr': server.chnk_srv_addr, 'chunk_server_port': server.chnk_srv_port})
+                for future in as_completed(futures):
+                    if not future.result():
+                        print("One or more stripes failed to upload after retries.")
+                        all_success = False
+        finally:
+            os.close(fd)
+        return all_success
+
 
-                    chunk_index += 1
+    def upload_stripe(self, fd, journal: TransferJournal, stripe, members: List[ChunkServerConnection], chunks: List[Dict],
+                      parity_chunks: List[Dict]) -> bool:
+        '''Send the given data chunks of a stripe, then the given parity chunks computed from all its data chunks'''
+        info = journal.info
+        data_shards, parity_shards = info['erasure']
+        stripe_chunks = info['chunks'][stripe * data_shards:(stripe + 1) * data_shards]
+        try:
+            data = [self.read_chunk(fd, chunk['offset'], chunk['chunk_size']) for chunk in stripe_chunks]
+        except OSError as e:
+            print(f"Failed to read stripe {stripe} of {info['file_id']}: {e}")
+            return False
 
-            # Process upload results
-            for future in as_completed(futures):
-                success = future.result()
-                if not success:
-                    print("One or more chunks failed to upload after retries.")
-                    all_success = False
+        sending = {chunk['chunk_index'] for chunk in chunks}
+        for member, chunk in enumerate(stripe_chunks):
+            if chunk['chunk_index'] in sending and not self.upload(members[member], chunk['chunk_id'], chunk['chunk_index'],
+                                                                   data[member], info['file_id'], [], journal):
+                return False
 
-        if all_success:
-            print(f"File {file_id} uploaded successfully in {chunk_index} chunks.")
-            self.save_metadata(file_id, chunk_metadata)
-            self.coordinator_connection.register_new_file(file_id, chunk_metadata)
+        if parity_chunks:
+            # Data chunks past the end of the file count as zeros
+            shard_size = max(len(shard) for shard in data)
+            shards = [shard.ljust(shard_size, b'\0') for shard in data] + [bytes(shard_size)] * (data_shards - len(data))
+            parity = ReedSolomon(data_shards, parity_shards).encode(shards)
+            for parity_chunk in parity_chunks:
+                position = parity_chunk['chunk_index'] - len(info['chunks']) - stripe * parity_shards
+                if not self.upload(members[data_shards + position], parity_chunk['chunk_id'], parity_chunk['chunk_index'],
+                                   parity[position], info['file_id'], [], journal, compress=False):
+                    return False
+        return True
 
-        else:
-            print(f"File {file_id} upload encountered errors.")
 
-        return all_success
+    def read_and_upload(self, fd, offset, size, server: ChunkServerConnection, chunk_id, chunk_index, file_id, replicas,
+                        journal: TransferJournal) -> bool:
+        try:
+            chunk = self.read_chunk(fd, offset, size)
+        except OSError as e:
+            print(f"Failed to read chunk {chunk_index} of {file_id}: {e}")
+            return False
+        return self.upload(server, chunk_id, chunk_index, chunk, file_id, replicas, journal)
+
+
+    def upload(self, server: ChunkServerConnection, chunk_id, chunk_index, chunk, file_id, replicas, journal: TransferJournal,
+               compress=True) -> bool:
+        '''Compress a chunk if it pays, upload it with its checksum and journal it once it is stored'''
+        checksum = zlib.crc32(chunk)
+        payload, codec = compression.encode(chunk, self.compression if compress else None)
+        excluded = set()
+        while True:
+            stored, failed = server.upload_chunk(chunk_id, payload, chunk_index, file_id, replicas,
+                                                 zlib.crc32(payload) if codec else checksum, codec)
+            if stored:
+                break
+            if failed is None:
+                return False
+            excluded.add(failed)
+            if len(excluded) >= self.max_placements:
+                print(f"Chunk {chunk_index} of {file_id} failed on {len(excluded)} chains, giving up")
+                return False
+            # Place the chunk again without the server that failed rather than retrying the same chain
+            chain = self.place_chunk(len(payload), 1 + len(replicas) if replicas is not None else 3, excluded)
+            if chain is None:
+                print(f"No ChunkServers left for chunk {chunk_index} of {file_id} without {sorted(excluded)}")
+                return False
+            server, replicas = chain
+            print(f"Retrying chunk {chunk_index} of {file_id} on {server.chnk_srv_addr}:{server.chnk_srv_port} without {failed[0]}:{failed[1]}")
+        journal.record(chunk_index, chunk_id=chunk_id, checksum=checksum, chunk_server_id=server.chunk_server_id,
+                       chunk_server_addr=server.chnk_srv_addr, chunk_server_port=server.chnk_srv_port)
+        return True
+
+
+    def place_chunk(self, chunk_size, replication, excluded) -> Optional[Tuple[ChunkServerConnection, List]]:
+        '''A new primary and replica peers for one chunk from the Coordinator, none of them at an excluded (host, port)'''
+        chunk_server_info, placement = self.coordinator_connection.get_placement(1, chunk_size, replication, exclude=excluded)
+        if not placement or not placement[0]:
+            return None
+        servers_by_id = {server['chnk_srv_id']: server for server in chunk_server_info}
+        primary_id, *replica_ids = placement[0]
+        replicas = [(servers_by_id[replica_id]['chnk_srv_addr'], servers_by_id[replica_id]['chnk_srv_port'],
+                     servers_by_id[replica_id].get('wire_protocol', LEGACY_VERSION)) for replica_id in replica_ids]
+        return self.connect(servers_by_id[primary_id]), replicas
+
+
+    def connect(self, server) -> ChunkServerConnection:
+        '''A connection to a ChunkServer as listed by the Coordinator, speaking the newest protocol both ends support'''
+        return ChunkServerConnection(self.user_id, server['chnk_srv_addr'], server['chnk_srv_port'], server['chnk_srv_id'],
+                                     wire_protocol=min(self.coordinator_connection.wire_protocol, server.get('wire_protocol', LEGACY_VERSION)),
+                                     pool=self.pool)
+
+
+    @staticmethod
+    def read_chunk(fd, offset, size) -> bytes:
+        '''Read size bytes at offset without touching the shared file position, so workers read in parallel'''
+        chunk = os.pread(fd, size, offset)
+        if len(chunk) == size:
+            return chunk
+        parts = [chunk]
+        read = len(chunk)
+        while read < size:
+            part = os.pread(fd, size - read, offset + read)
+            if not part:
+                raise OSError(f"File ended {size - read} bytes early, was it truncated during the upload?")
+            parts.append(part)
+            read += len(part)
+        return b''.join(parts)
 
-        
 
     def save_metadata(self, file_id, chunk_metadata):
         """Save chunk metadata to a cache file"""
@@ -0,0 +1,175 @@
+import asyncio
+import collections
+import contextlib
+import select
+import socket
+import threading
+import time
+from typing import Dict
+from src.common import protocol
+
+
+class ConnectionPool:
+    '''
+    Thread-safe pool of persistent framed connections keyed by (host, port).
+
+    Requests sent through the pool ask the server to keep the connection open
+    (keep_alive), so consecutive requests to the same server reuse one TCP
+    connection instead of paying a handshake and an ephemeral port each time.
+    '''
+    def __init__(self, max_idle=4, max_per_host=16, idle_timeout=2.0, connect_timeout=5.0, borrow_timeout=30.0):
+        self.max_idle = max_idle # idle connections kept per host
+        self.max_per_host = max_per_host # open (idle + borrowed) connections allowed per host
+        self.idle_timeout = idle_timeout # must stay below the servers' keep-alive timeout
+        self.connect_timeout = connect_timeout
+        self.borrow_timeout = borrow_timeout
+
+        self.condition = threading.Condition()
+        self.idle = collections.defaultdict(collections.deque) # (host, port) -> deque of (socket, last used time)
+        self.open_count = collections.Counter() # (host, port) -> open connections
+
+
+    def borrow(self, address) -> socket.socket:
+        address = tuple(address)
+        deadline = time.monotonic() + self.borrow_timeout
+        with self.condition:
+            while True:
+                idle = self.idle[address]
+                while idle:
+                    sock, last_used = idle.pop() # most recently used first, the others can age out
+                    if time.monotonic() - last_used < self.idle_timeout and self.is_healthy(sock):
+                        return sock
+                    self._close(address, sock)
+
+                if self.open_count[address] < self.max_per_host:
+                    self.open_count[address] += 1
+                    break
+
+                remaining = deadline - time.monotonic()
+                if remaining <= 0 or not self.condition.wait(remaining):
+                    raise TimeoutError(f'No connection to {address[0]}:{address[1]} available')
+
+        try:
+            sock = socket.create_connection(address, timeout=self.connect_timeout)
+            sock.settimeout(None)
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            return sock
+        except Exception:
+            with self.condition:
+                self.open_count[address] -= 1
+                self.condition.notify()
+            raise
+
+
+    def release(self, address, sock, reuse=True):
+        address = tuple(address)
+        with self.condition:
+            if reuse and len(self.idle[address]) < self.max_idle:
+                self.idle[address].append((sock, time.monotonic()))
+            else:
+                self._close(address, sock)
+            self.condition.notify()
+
+
+    @contextlib.contextmanager
+    def connection(self, address):
+        '''Borrow a connection for one exchange; it is discarded if the exchange fails part way'''
+        sock = self.borrow(address)
+        try:
+            yield sock
+        except BaseException:
+            self.release(address, sock, reuse=False)
+            raise
+        self.release(address, sock)
+
+
+    def call(self, address, request, payload=b''):
+        '''Send a framed request over a pooled connection, returning (response, payload)'''
+        with self.connection(address) as sock:
+            return protocol.call(sock, dict(request, keep_alive=True), payload=payload)
+
+
+    def close(self):
+        with self.condition:
+            for address, idle in self.idle.items():
+                while idle:
+                    sock, _ = idle.pop()
+                    self._close(address, sock)
+
+
+    @staticmethod
+    def is_healthy(sock):
+        # An idle connection should have nothing to read; readable means EOF or a stray reply
+        try:
+            readable, _, _ = select.select([sock], [], [], 0)
+            return not readable
+        except (OSError, ValueError):
+            return False
+
+
+    def _close(self, address, sock):
+        self.open_count[address] -= 1
+        try:
+            sock.close()
+        except OSError:
+            pass
+
+
+
+class AsyncConnectionPool:
+    '''asyncio counterpart of ConnectionPool for servers running on an event loop'''
+    def __init__(self, max_idle=4, max_per_host=16, idle_timeout=2.0, connect_timeout=5.0):
+        self.max_idle = max_idle
+        self.max_per_host = max_per_host
+        self.idle_timeout = idle_timeout
+        self.connect_timeout = connect_timeout
+
+        self.idle = collections.defaultdict(collections.deque) # (host, port) -> deque of (reader, writer, last used time)
+        self.limits: Dict[tuple, asyncio.Semaphore] = {} # (host, port) -> open connections allowed
+
+
+    async def call(self, address, request, payload=b'', framed=True):
+        '''
+        Send a request and return (response, payload). Framed requests reuse a kept-alive
+        connection; legacy requests get a connection of their own.
+        '''
+        address = tuple(address)
+        limit = self.limits.setdefault(address, asyncio.Semaphore(self.max_per_host))
+        async with limit:
+            if not framed:
+                reader, writer = await asyncio.wait_for(asyncio.open_connection(*address), self.connect_timeout)
+                try:
+                    return await protocol.call_stream(reader, writer, request, framed=False)
+                finally:
+                    writer.close()
+
+            reader, writer = await self.borrow(address)
+            try:
+                result = await protocol.call_stream(reader, writer, dict(request, keep_alive=True), payload=payload)
+            except BaseException:
+                writer.close()
+                raise
+            if len(self.idle[address]) < self.max_idle:
+                self.idle[address].append((reader, writer, time.monotonic()))
+            else:
+                writer.close()
+            return result
+
+
+    async def borrow(self, address):
+        idle = self.idle[address]
+        while idle:
+            reader, writer, last_used = idle.pop()
+            if time.monotonic() - last_used < self.idle_timeout and not reader.at_eof() and not writer.is_closing():
+                return reader, writer
+            writer.close()
+        reader, writer = await asyncio.wait_for(asyncio.open_connection(*address), self.connect_timeout)
+        writer.get_extra_info('socket').setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        return reader, writer
+
+
+    def close(self):
+        for idle in self.idle.values():
+            while idle:
+                _, writer, _ = idle.pop()
+                writer.close()
@@ -0,0 +1,175 @@
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from typing import Callable, Dict, List, Optional
+
+try:
+    import numpy as np
+except ImportError: # the pure Python path is slower but needs nothing installed
+    np = None
+
+
+# GF(2^8) arithmetic over the polynomial x^8 + x^4 + x^3 + x^2 + 1
+GF_EXP = [0] * 512
+GF_LOG = [0] * 256
+value = 1
+for power in range(255):
+    GF_EXP[power] = value
+    GF_LOG[value] = power
+    value <<= 1
+    if value & 0x100:
+        value ^= 0x11d
+for power in range(255, 512):
+    GF_EXP[power] = GF_EXP[power - 255]
+
+
+def gf_mul(a, b):
+    if a == 0 or b == 0:
+        return 0
+    return GF_EXP[GF_LOG[a] + GF_LOG[b]]
+
+
+def gf_inv(a):
+    if a == 0:
+        raise ZeroDivisionError('0 has no inverse in GF(256)')
+    return GF_EXP[255 - GF_LOG[a]]
+
+
+# Row c maps every byte x to c * x, for bytes.translate or numpy indexing
+MUL_TABLES = [bytes(gf_mul(c, x) for x in range(256)) for c in range(256)]
+MUL_ARRAY = np.frombuffer(b''.join(MUL_TABLES), dtype=np.uint8).reshape(256, 256) if np is not None else None
+
+
+class ReedSolomon:
+    '''
+    Systematic Reed-Solomon code over GF(256): data_shards equally sized shards plus
+    parity_shards parity shards, any data_shards of which are enough to rebuild the rest.
+
+    Parity rows come from a Cauchy matrix, so every square submatrix of the generator is
+    invertible. Shards are combined with NumPy table lookups when NumPy is installed, and
+    with bytes.translate and big-integer XOR otherwise.
+    '''
+    def __init__(self, data_shards, parity_shards):
+        if data_shards < 1 or parity_shards < 0 or data_shards + parity_shards > 256:
+            raise ValueError(f"Unsupported code {data_shards}+{parity_shards}")
+        self.data_shards = data_shards
+        self.parity_shards = parity_shards
+        self.parity_rows = [[gf_inv((data_shards + row) ^ column) for column in range(data_shards)]
+                            for row in range(parity_shards)]
+
+
+    def row(self, index) -> List[int]:
+        '''Generator row of shard index: a unit row for data shards, a Cauchy row for parity'''
+        if index < self.data_shards:
+            return [int(column == index) for column in range(self.data_shards)]
+        return self.parity_rows[index - self.data_shards]
+
+
+    def encode(self, data: List[bytes]) -> List[bytes]:
+        '''The parity shards of data_shards equally sized data shards'''
+        return [self.combine(coefficients, data) for coefficients in self.parity_rows]
+
+
+    def reconstruct(self, shards: Dict[int, bytes], wanted: List[int]) -> Dict[int, bytes]:
+        '''Shards wanted, rebuilt from any data_shards known shards (index -> bytes)'''
+        if len(shards) < self.data_shards:
+            raise ValueError(f"Need {self.data_shards} shards to reconstruct, have {len(shards)}")
+        known = sorted(shards)[:self.data_shards]
+        decode = self.invert([self.row(index) for index in known]) # known shards -> data shards
+        sources = [shards[index] for index in known]
+        rebuilt = {}
+        for index in wanted:
+            if index in shards:
+                rebuilt[index] = shards[index]
+                continue
+            # The wanted row times the decode matrix maps the known shards straight to this one
+            row = self.row(index)
+            coefficients = [0] * self.data_shards
+            for data_index, factor in enumerate(row):
+                if factor:
+                    for column in range(self.data_shards):
+                        coefficients[column] ^= gf_mul(factor, decode[data_index][column])
+            rebuilt[index] = self.combine(coefficients, sources)
+        return rebuilt
+
+
+    @staticmethod
+    def combine(coefficients, shards) -> bytes:
+        '''Sum of coefficient * shard over GF(256), byte by byte'''
+        size = len(shards[0])
+        if np is not None:
+            result = np.zeros(size, dtype=np.uint8)
+            for coefficient, shard in zip(coefficients, shards):
+                if coefficient == 1:
+                    result ^= np.frombuffer(shard, dtype=np.uint8)
+                elif coefficient:
+                    result ^= MUL_ARRAY[coefficient][np.frombuffer(shard, dtype=np.uint8)]
+            return result.tobytes()
+
+        result = 0
+        for coefficient, shard in zip(coefficients, shards):
+            if coefficient == 1:
+                result ^= int.from_bytes(shard, 'little')
+            elif coefficient:
+                result ^= int.from_bytes(bytes(shard).translate(MUL_TABLES[coefficient]), 'little')
+        return result.to_bytes(size, 'little')
+
+
+    @staticmethod
+    def invert(matrix: List[List[int]]) -> List[List[int]]:
+        '''Gauss-Jordan inverse of a square matrix over GF(256)'''
+        size = len(matrix)
+        rows = [list(row) + [int(column == index) for column in range(size)] for index, row in enumerate(matrix)]
+        for column in range(size):
+            pivot = next((index for index in range(column, size) if rows[index][column]), None)
+            if pivot is None:
+                raise ValueError("Shard matrix is singular")
+            rows[column], rows[pivot] = rows[pivot], rows[column]
+            scale = gf_inv(rows[column][column])
+            rows[column] = [gf_mul(scale, entry) for entry in rows[column]]
+            for index in range(size):
+                factor = rows[index][column]
+                if index != column and factor:
+                    rows[index] = [entry ^ gf_mul(factor, pivot_entry) for entry, pivot_entry in zip(rows[index], rows[column])]
+        return [row[size:] for row in rows]
+
+
+
+def rebuild_stripe_member(stripe: Dict, index, fetch: Callable[[Dict], Optional[bytes]], max_workers=None) -> bytes:
+    '''
+    Rebuild one chunk of an erasure coded stripe from the others.
+
+    stripe is {'data_shards', 'parity_shards', 'shard_size', 'members'}, with members the stripe's
+    data chunks then its parity chunks, each {'chunk_id', 'chunk_size', ...} or None for data
+    chunks past the end of the file, which count as zeros. fetch(member) returns a chunk's bytes
+    or None. Data chunks are asked for first, and another member only when a fetch fails.
+    '''
+    code = ReedSolomon(stripe['data_shards'], stripe['parity_shards'])
+    shard_size = stripe['shard_size']
+    members = stripe['members']
+    shards = {position: bytes(shard_size) for position, member in enumerate(members) if member is None}
+    candidates = iter([position for position, member in enumerate(members) if member is not None and position != index])
+
+    with ThreadPoolExecutor(max_workers=max_workers or code.data_shards) as executor:
+        pending = {}
+        def launch():
+            position = next(candidates, None)
+            if position is not None:
+                pending[executor.submit(fetch, members[position])] = position
+            return position is not None
+
+        while len(shards) + len(pending) < code.data_shards and launch():
+            pass
+        while pending and len(shards) < code.data_shards:
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                position = pending.pop(future)
+                data = future.result()
+                if data is None:
+                    launch()
+                else:
+                    shards[position] = bytes(data).ljust(shard_size, b'\0')
+        for future in pending:
+            future.cancel()
+
+    if len(shards) < code.data_shards:
+        raise IOError(f"Only {len(shards)} of the {code.data_shards} chunks needed to rebuild {members[index]['chunk_id']} are readable")
+    return code.reconstruct(shards, [index])[index][:members[index]['chunk_size']]
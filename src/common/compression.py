@@ -0,0 +1,72 @@
+'''
+Per-chunk compression codecs.
+
+The Client compresses a chunk before uploading it when a quick test on a few samples says
+it is worth it, and names the codec in the upload request. ChunkServers store and serve the
+compressed bytes together with the codec's name, and the Client decompresses them after
+downloading. zlib and lzma are always available; lz4 and zstd are registered when their
+packages are installed, and register_codec adds any other.
+'''
+import lzma
+import zlib
+from typing import Callable, Dict, Optional, Tuple
+
+
+CODECS: Dict[str, Tuple[Callable[[bytes], bytes], Callable[[bytes], bytes]]] = {} # name -> (compress, decompress)
+
+SAMPLE_SIZE = 4096
+SAMPLES = 4
+MIN_SAVING = 0.1 # a chunk must shrink by this fraction to be stored compressed
+
+
+def register_codec(name, compress: Callable[[bytes], bytes], decompress: Callable[[bytes], bytes]):
+    CODECS[name] = (compress, decompress)
+
+
+register_codec('zlib', lambda data: zlib.compress(data, 6), zlib.decompress)
+register_codec('lzma', lambda data: lzma.compress(data, preset=1), lzma.decompress)
+
+try:
+    import lz4.frame
+    register_codec('lz4', lz4.frame.compress, lz4.frame.decompress)
+except ImportError:
+    pass
+
+try:
+    import zstandard
+    register_codec('zstd', lambda data: zstandard.ZstdCompressor(level=3).compress(data),
+                   lambda data: zstandard.ZstdDecompressor().decompress(data))
+except ImportError:
+    pass
+
+
+def compressible(data) -> bool:
+    '''
+    Cheap test for whether data is worth compressing: compress a few samples spread over it at
+    the fastest zlib level. Already compressed data (video, images, archives) fails it, so it
+    costs a few small compressions instead of compressing the whole chunk for nothing
+    '''
+    if len(data) <= SAMPLE_SIZE * SAMPLES:
+        sample = bytes(data)
+    else:
+        step = (len(data) - SAMPLE_SIZE) // (SAMPLES - 1)
+        sample = b''.join(data[i * step:i * step + SAMPLE_SIZE] for i in range(SAMPLES))
+    return len(zlib.compress(sample, 1)) <= len(sample) * (1 - MIN_SAVING)
+
+
+def encode(data, codec: Optional[str]) -> Tuple[bytes, Optional[str]]:
+    '''The bytes to store for a chunk and the codec they are compressed with, None if stored as is'''
+    if codec is None or not data or not compressible(data):
+        return data, None
+    compressed = CODECS[codec][0](data)
+    if len(compressed) > len(data) * (1 - MIN_SAVING):
+        return data, None
+    return compressed, codec
+
+
+def decode(data, codec: Optional[str]) -> bytes:
+    if codec is None:
+        return data
+    if codec not in CODECS:
+        raise ValueError(f"Chunk is compressed with {codec}, which is not installed")
+    return CODECS[codec][1](data)
@@ -0,0 +1,306 @@
+'''
+Wire protocol shared by the Client, Coordinator and ChunkServer.
+
+A framed message is a fixed size header followed by a JSON metadata object and
+an optional raw binary payload:
+
+    | magic (2) | version (1) | frame type (1) | metadata length (4) | payload length (8) |
+    | metadata (JSON, utf-8) | payload (raw bytes) |
+
+The legacy protocol (a JSON object terminated by "\\n\\n", with chunk data
+base64 encoded inside it) is still accepted by every server so that nodes
+started with --legacy_protocol keep working in a mixed cluster.
+'''
+import asyncio
+import json
+import socket
+import struct
+import zlib
+
+MAGIC = b'DF'
+WIRE_VERSION = 1
+LEGACY_VERSION = 0
+
+FRAME_REQUEST = 1
+FRAME_RESPONSE = 2
+
+HEADER = struct.Struct('!2sBBIQ')
+DELIMITER = b'\n\n'
+STREAM_BUFFER_SIZE = 1024 * 1024 # also the size of the writes a large payload is sent in, so a socket timeout bounds each block
+KEEP_ALIVE_TIMEOUT = 5.0 # seconds a server waits for the next request on a kept-alive connection
+
+
+class ProtocolError(Exception):
+    pass
+
+
+def encode_header(meta, payload_len=0, frame_type=FRAME_REQUEST) -> bytes:
+    body = json.dumps(meta).encode()
+    return HEADER.pack(MAGIC, WIRE_VERSION, frame_type, len(body), payload_len) + body
+
+
+def decode_header(header: bytes):
+    magic, version, frame_type, meta_len, payload_len = HEADER.unpack(header)
+    if magic != MAGIC:
+        raise ProtocolError(f'Bad frame magic {magic!r}')
+    if version != WIRE_VERSION:
+        raise ProtocolError(f'Unsupported wire protocol version {version}')
+    return frame_type, meta_len, payload_len
+
+
+def send_message(sock, meta, payload=b'', frame_type=FRAME_REQUEST):
+    header = encode_header(meta, len(payload), frame_type)
+    if len(payload) <= 64 * 1024:
+        # Small payloads go out in a single write to avoid a write-write-read stall
+        sock.sendall(header + bytes(payload))
+    else:
+        sock.sendall(header)
+        view = memoryview(payload)
+        for start in range(0, len(view), STREAM_BUFFER_SIZE):
+            sock.sendall(view[start:start + STREAM_BUFFER_SIZE])
+
+
+def send_file_message(sock, meta, file, size, frame_type=FRAME_REQUEST, offset=0):
+    '''Send a framed message whose payload is size bytes of an open file from offset, using sendfile where available'''
+    sock.sendall(encode_header(meta, size, frame_type))
+    if size == 0:
+        return # sendfile treats a zero count as "to the end of the file"
+    file.seek(offset)
+    sent = sock.sendfile(file, offset, size)
+    if sent != size:
+        raise ConnectionError(f'Sent {sent} of {size} payload bytes')
+
+
+def recv_exact(sock, n) -> bytearray:
+    '''Read exactly n bytes into a preallocated buffer'''
+    buffer = bytearray(n)
+    view = memoryview(buffer)
+    received = 0
+    while received < n:
+        count = sock.recv_into(view[received:], n - received)
+        if not count:
+            raise ConnectionError(f'Connection closed after {received} of {n} bytes')
+        received += count
+    return buffer
+
+
+def recv_checksummed(sock, n):
+    '''recv_exact that also returns the crc32 of the bytes, computed on each slice as it arrives'''
+    buffer = bytearray(n)
+    view = memoryview(buffer)
+    received = 0
+    checksum = 0
+    while received < n:
+        count = sock.recv_into(view[received:], n - received)
+        if not count:
+            raise ConnectionError(f'Connection closed after {received} of {n} bytes')
+        checksum = zlib.crc32(view[received:received + count], checksum)
+        received += count
+    return buffer, checksum
+
+
+def recv_message(sock):
+    '''
+    Read a framed header and its metadata, leaving the payload unread on the socket.
+    Returns (meta, payload_len), or None if the peer closed the connection cleanly.
+    '''
+    first = sock.recv(HEADER.size)
+    if not first:
+        return None
+    header = first if len(first) == HEADER.size else first + recv_exact(sock, HEADER.size - len(first))
+    _, meta_len, payload_len = decode_header(header)
+    meta = json.loads(recv_exact(sock, meta_len))
+    return meta, payload_len
+
+
+def recv_payload(sock, payload_len) -> bytearray:
+    return recv_exact(sock, payload_len)
+
+
+def recv_stream(sock, payload_len, consume, buffer_size=STREAM_BUFFER_SIZE):
+    '''
+    Read a payload through one reusable buffer, handing each filled slice to consume(view)
+    so the payload never has to be held in memory at once.
+    '''
+    buffer = bytearray(min(buffer_size, payload_len) or 1)
+    view = memoryview(buffer)
+    remaining = payload_len
+    while remaining:
+        count = sock.recv_into(view, min(remaining, len(buffer)))
+        if not count:
+            raise ConnectionError(f'Connection closed with {remaining} of {payload_len} bytes outstanding')
+        consume(view[:count])
+        remaining -= count
+
+
+def is_framed(sock):
+    '''
+    Peek at the first byte of a new connection to tell framed messages from legacy JSON.
+    Returns None if the peer closed the connection without sending anything.
+    '''
+    first = sock.recv(1, socket.MSG_PEEK)
+    if not first:
+        return None
+    return first == MAGIC[:1]
+
+
+def recv_legacy(sock, bufsize=64 * 1024):
+    '''Read a legacy JSON message ended by the delimiter, the end of the object, or EOF'''
+    data = bytearray()
+    while True:
+        part = sock.recv(bufsize)
+        if not part or legacy_message_complete(data, part):
+            break
+    return json.loads(data.replace(DELIMITER, b''))
+
+
+def legacy_message_complete(data: bytearray, part: bytes):
+    '''Append part to data and report whether a legacy JSON message is complete'''
+    search_from = max(len(data) - 1, 0)
+    data += part
+    if data.find(DELIMITER, search_from) != -1:
+        return True
+    if part.rstrip().endswith(b'}'):
+        # Some legacy senders do not append a delimiter, stop once the object is complete
+        try:
+            json.loads(data)
+            return True
+        except json.JSONDecodeError:
+            pass
+    return False
+
+
+def send_legacy(sock, meta):
+    sock.sendall(json.dumps(meta).encode() + DELIMITER)
+
+
+def recv_request(sock):
+    '''
+    Read the next request from either protocol.
+    Returns (request, payload_len, framed), or None if the peer sent nothing.
+    '''
+    framed = is_framed(sock)
+    if framed is None:
+        return None
+    if framed:
+        message = recv_message(sock)
+        if message is None:
+            return None
+        request, payload_len = message
+        return request, payload_len, True
+    return recv_legacy(sock), 0, False
+
+
+def send_response(sock, response, framed, payload=b''):
+    if framed:
+        send_message(sock, response, payload, FRAME_RESPONSE)
+    else:
+        send_legacy(sock, response)
+
+
+def call(sock, request, framed=True, payload=b'', response_timeout=None):
+    '''Send a request and read its response, returning (response, payload). response_timeout, if given, replaces the socket timeout once the request is sent'''
+    if not framed:
+        send_legacy(sock, request)
+        if response_timeout is not None:
+            sock.settimeout(response_timeout)
+        return recv_legacy(sock), b''
+    send_message(sock, request, payload)
+    if response_timeout is not None:
+        sock.settimeout(response_timeout)
+    message = recv_message(sock)
+    if message is None:
+        raise ConnectionError('Connection closed before a response was received')
+    response, payload_len = message
+    return response, recv_payload(sock, payload_len) if payload_len else b''
+
+
+def serve_connection(sock, dispatch, keep_alive_timeout=KEEP_ALIVE_TIMEOUT):
+    '''
+    Serve requests on a connection until the peer is done with it.
+    dispatch(request, payload_len, framed) handles one request and returns False if the
+    connection can no longer be reused (e.g. a payload was left partly read).
+    Framed requests that set keep_alive keep the connection open for the next request.
+    '''
+    while True:
+        try:
+            message = recv_request(sock)
+        except TimeoutError:
+            return # idle kept-alive connection expired
+        if message is None:
+            return
+        sock.settimeout(None)
+        request, payload_len, framed = message
+        in_sync = dispatch(request, payload_len, framed)
+        if not (framed and request.get('keep_alive') and in_sync is not False):
+            return
+        sock.settimeout(keep_alive_timeout)
+
+
+# asyncio stream counterparts, used by the event loop based servers
+
+async def read_request(reader: asyncio.StreamReader):
+    '''Read the next request from either protocol, returning (request, payload_len, framed) or None at EOF'''
+    first = await reader.read(1)
+    if not first:
+        return None
+    if first == MAGIC[:1]:
+        header = first + await reader.readexactly(HEADER.size - 1)
+        _, meta_len, payload_len = decode_header(header)
+        return json.loads(await reader.readexactly(meta_len)), payload_len, True
+
+    data = bytearray(first)
+    while True:
+        part = await reader.read(64 * 1024)
+        if not part or legacy_message_complete(data, part):
+            break
+    return json.loads(data.replace(DELIMITER, b'')), 0, False
+
+
+async def read_stream(reader: asyncio.StreamReader, payload_len, consume, buffer_size=STREAM_BUFFER_SIZE):
+    '''Read a payload in blocks of up to buffer_size, awaiting consume(block) for each one'''
+    remaining = payload_len
+    while remaining:
+        block = await reader.readexactly(min(remaining, buffer_size))
+        await consume(block)
+        remaining -= len(block)
+
+
+async def call_stream(reader: asyncio.StreamReader, writer: asyncio.StreamWriter, request, framed=True, payload=b''):
+    '''Send a request over an asyncio stream and read its response, returning (response, payload)'''
+    if framed:
+        writer.write(encode_header(request, len(payload)))
+        if payload:
+            writer.write(payload)
+    else:
+        writer.write(json.dumps(request).encode() + DELIMITER)
+    await writer.drain()
+    message = await read_request(reader)
+    if message is None:
+        raise ConnectionError('Connection closed before a response was received')
+    response, payload_len, _ = message
+    return response, await reader.readexactly(payload_len) if payload_len else b''
+
+
+def write_response(writer: asyncio.StreamWriter, response, framed, payload=b''):
+    if framed:
+        writer.write(encode_header(response, len(payload), FRAME_RESPONSE))
+        if payload:
+            writer.write(payload)
+    else:
+        writer.write(json.dumps(response).encode() + DELIMITER)
+
+
+async def serve_stream(reader: asyncio.StreamReader, writer: asyncio.StreamWriter, dispatch, keep_alive_timeout=KEEP_ALIVE_TIMEOUT):
+    '''asyncio version of serve_connection; dispatch is a coroutine function'''
+    message = await read_request(reader)
+    while message is not None:
+        request, payload_len, framed = message
+        in_sync = await dispatch(request, payload_len, framed)
+        await writer.drain()
+        if not (framed and request.get('keep_alive') and in_sync is not False):
+            return
+        try:
+            message = await asyncio.wait_for(read_request(reader), keep_alive_timeout)
+        except asyncio.TimeoutError:
+            return # idle kept-alive connection expired
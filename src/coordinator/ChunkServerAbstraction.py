@@ -1,10 +1,22 @@
 import json
+import time
+from src.common.protocol import LEGACY_VERSION
 
 class ChunkServerAbstraction:
-    def __init__(self, address, port, id):
+    def __init__(self, address, port, id, wire_protocol=LEGACY_VERSION):
         self.chnk_srv_addr = address
         self.chnk_srv_port = port
         self.chnk_srv_id = id
+        self.wire_protocol = wire_protocol # newest wire protocol version the server speaks
+
+        # Liveness and load, refreshed by every heartbeat and never persisted
+        self.missed_heartbeats = 0
+        self.last_heartbeat = None # time.monotonic() of the last answered heartbeat
+        self.free_disk = None # bytes
+        self.chunk_count = None
+        self.active_connections = None
+        self.throughput = None # bytes per second moved since the previous heartbeat
+        self.pending_placements = 0 # chunks placed on the server since its last heartbeat
 
     def __repr__(self):
         return f'address: {self.chnk_srv_addr}, port: {self.chnk_srv_port}, id: {self.chnk_srv_id}'
@@ -13,7 +25,21 @@ class ChunkServerAbstraction:
     def to_json(self):
         return json.dumps({'chnk_srv_addr': self.chnk_srv_addr, 
                             'chnk_srv_port': self.chnk_srv_port,
-                            'chnk_srv_id': self.chnk_srv_id})
+                            'chnk_srv_id': self.chnk_srv_id,
+                            'wire_protocol': self.wire_protocol})
     
     def get_location(self):
-        return (self.chnk_srv_addr, self.chnk_srv_port)
\ No newline at end of file
+        return (self.chnk_srv_addr, self.chnk_srv_port)
+
+    def get_peer_info(self):
+        return (self.chnk_srv_addr, self.chnk_srv_port, self.wire_protocol)
+
+    def update_stats(self, stats):
+        '''Record a successful heartbeat and the load statistics that came with it'''
+        self.missed_heartbeats = 0
+        self.last_heartbeat = time.monotonic()
+        self.pending_placements = 0 # reflected in the fresh statistics from here on
+        self.free_disk = stats.get('free_disk', self.free_disk)
+        self.chunk_count = stats.get('chunk_count', self.chunk_count)
+        self.active_connections = stats.get('active_connections', self.active_connections)
+        self.throughput = stats.get('throughput', self.throughput)
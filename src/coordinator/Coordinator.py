@@ -1,79 +1,106 @@
-import time
-from typing import Dict, Set, List
-from src.coordinator.File import File
+import asyncio
 from src.coordinator.ChunkServerAbstraction import ChunkServerAbstraction
+from src.coordinator.MetadataLog import MetadataLog
+from src.coordinator.PlacementPolicy import PLACEMENT_POLICIES
+from src.coordinator.ReplicationScheduler import ReplicationScheduler
 import socket
 from concurrent.futures import ThreadPoolExecutor
-import uuid 
+import uuid
 import json
-import collections
 import random
+from pathlib import Path
+from src.common import protocol
+from src.common.protocol import WIRE_VERSION, LEGACY_VERSION
+from src.common.ConnectionPool import AsyncConnectionPool
 
 class Coordinator:
-    def __init__(self, host='localhost', port=6000, max_workers=10):
+    '''
+    Coordinator running on a single asyncio event loop.
+
+    Metadata is owned by one writer task: handlers queue mutation records and await
+    their result, the writer logs and applies them in arrival order, and reads are
+    served straight from the metadata between mutations.
+    '''
+    def __init__(self, host='localhost', port=6000, max_workers=10, backlog=1024, metadata_dir=None,
+                 heartbeat_interval=10.0, heartbeat_timeout=3.0, max_missed_heartbeats=3, placement_policy='power_of_two'):
+        if placement_policy not in PLACEMENT_POLICIES:
+            raise ValueError(f"Unknown placement policy {placement_policy!r}, expected one of {', '.join(PLACEMENT_POLICIES)}")
 
         # Networking & threading
         self.host = host
         self.port = port
-        self.server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM) 
+        self.backlog = backlog
+        self.server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1) # rebind right after a restart
         self.server_socket.bind((self.host, self.port))
-        self.server_socket.listen(5) 
-        self.executor = ThreadPoolExecutor(max_workers=max_workers) 
+        self.server_socket.listen(self.backlog)
+        self.executor = ThreadPoolExecutor(max_workers=max_workers) # blocking work kept off the event loop
 
-        self.chunk_server_map: Dict[str, ChunkServerAbstraction] = {} #map chunkserver id's to the address and port of the chunkserver
-        self.chunk_map: Dict[str, List[str]] = collections.defaultdict(list) #map chunk ids to chunkserver id that hosts it 
-        self.file_map: Dict[str, File] = {} #map file_id to File obj
-        self.server_chunks_map: Dict[str, Set[str]] = collections.defaultdict(set) #map server id's to the chunks they host
+        # Metadata survives restarts through a write-ahead log and snapshots
+        self.metadata_log = MetadataLog(Path(metadata_dir) if metadata_dir else Path.home() / '512_coordinator_metadata')
+        self.metadata = self.metadata_log.load()
+        self.mutations: asyncio.Queue = None # (mutation, future) pairs for the metadata writer, created on the event loop
+
+        self.pool = AsyncConnectionPool() # persistent connections to ChunkServers
+        self.placement_policy = PLACEMENT_POLICIES[placement_policy]() # where new chunks and their replicas go
+
+        # Failure detection
+        self.heartbeat_interval = heartbeat_interval # seconds between heartbeat rounds
+        self.heartbeat_timeout = heartbeat_timeout # deadline for each probe
+        self.max_missed_heartbeats = max_missed_heartbeats # consecutive misses before a ChunkServer is declared failed
+        self.replication_scheduler = ReplicationScheduler(self.metadata, self.call_chunk_server, self.mutate) # restores lost replicas in the background
 
 
     def start(self):
-        self.executor.submit(self.send_heartbeat)
-        while True:
-            client_socket, addr = self.server_socket.accept()
-            print(f"connected to {addr}")
-            self.executor.submit(self.handle_request, client_socket)
+        asyncio.run(self.serve())
 
 
+    async def serve(self):
+        asyncio.get_running_loop().set_default_executor(self.executor)
+        self.mutations = asyncio.Queue()
+        self.server_socket.setblocking(False)
+        server = await asyncio.start_server(self.handle_connection, sock=self.server_socket, backlog=self.backlog)
+        async with server:
+            await asyncio.gather(server.serve_forever(), self.metadata_writer(), self.send_heartbeat(),
+                                 self.replication_scheduler.run())
 
-    def handle_request(self, client_socket):
-        try:
-            data = client_socket.recv(1024).decode().strip()
 
-            if not data:
-                print("Received empty request")
-                return
+    async def mutate(self, mutation):
+        '''Queue a metadata mutation for the writer task and wait until it has been applied'''
+        future = asyncio.get_running_loop().create_future()
+        await self.mutations.put((mutation, future))
+        return await future
+
+
+    async def metadata_writer(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            # Everything queued while the previous batch was being written shares one fsync
+            batch = [await self.mutations.get()]
+            while not self.mutations.empty():
+                batch.append(self.mutations.get_nowait())
 
             try:
-                request = json.loads(data)
-                print(f"Received request: {request}")
-            except json.JSONDecodeError:
-                print("Incomplete or large message detected, switching to buffered reading")
-                while True:
-                    part = client_socket.recv(1024).decode()
-                    if not part:  
-                        break
-                    data += part
-                    if "\n\n" in data:
-                        data = data.replace("\n\n", "")  
-                        break
-                request = json.loads(data)  
-                print(f"Buffered request")
-
-            # Dispatch request to the appropriate handler
-            if request.get("request_type") == "GET_CLIENT_ID":
-                self.handle_get_client_id(client_socket)
-            elif request.get("request_type") == "REGISTER_NEW_FILE":
-                self.handle_creating_new_file(request)
-            elif request.get("request_type") == "REGISTER_CHUNK_SERVER":
-                self.handle_new_chunk_server(request)
-            elif request.get("request_type") == "GET_CHUNK_SERVERS":
-                self.handle_getting_chunk_servers(request, client_socket)
-            elif request.get("request_type") == "GET_FILE_DATA":
-                self.handle_get_file(request, client_socket)
-            elif request.get('request_type') == "CHUNK_UPLOAD_SUCCESS":
-                self.handle_chunk_upload_success(request)
-            else:
-                print(f"Unknown request type: {request.get('request_type')}")
+                await loop.run_in_executor(self.executor, self.metadata_log.append, [mutation for mutation, _ in batch])
+            except Exception as e:
+                print(f"Error writing metadata log: {e}")
+                for _, future in batch:
+                    future.set_exception(e)
+                continue
+
+            for mutation, future in batch:
+                try:
+                    future.set_result(self.metadata.apply(mutation))
+                except Exception as e:
+                    print(f"Error applying metadata mutation {mutation.get('op')}: {e}")
+                    future.set_exception(e)
+
+
+    async def handle_connection(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        print(f"connected to {writer.get_extra_info('peername')}")
+        try:
+            await protocol.serve_stream(reader, writer, lambda request, payload_len, framed:
+                                        self.dispatch_request(request, writer, framed))
 
         except json.JSONDecodeError:
             print("Invalid JSON received")
@@ -82,199 +109,220 @@ class Coordinator:
             print(f"Error handling request: {e}")
 
         finally:
-            client_socket.close()  
-
-
-    def handle_get_file(self, request, client_socket):
+            writer.close()
+
+
+    async def dispatch_request(self, request, writer, framed):
+        print(f"Received request: {request}")
+
+        # Dispatch request to the appropriate handler
+        if request.get("request_type") == "GET_CLIENT_ID":
+            self.handle_get_client_id(writer, framed)
+        elif request.get("request_type") == "REGISTER_NEW_FILE":
+            await self.handle_creating_new_file(request)
+            self.acknowledge(writer, framed)
+        elif request.get("request_type") == "REGISTER_CHUNK_SERVER":
+            await self.handle_new_chunk_server(request)
+            self.acknowledge(writer, framed)
+        elif request.get("request_type") == "GET_CHUNK_SERVERS":
+            self.handle_getting_chunk_servers(request, writer, framed)
+        elif request.get("request_type") == "GET_FILE_DATA":
+            self.handle_get_file(request, writer, framed)
+        elif request.get('request_type') == "CHUNK_UPLOAD_SUCCESS":
+            await self.handle_chunk_upload_success(request)
+            self.acknowledge(writer, framed)
+        elif request.get('request_type') == "CHUNKS_STORED":
+            await self.handle_chunks_stored(request)
+            self.acknowledge(writer, framed)
+        elif request.get('request_type') == "CHUNKS_CORRUPT":
+            await self.handle_chunks_corrupt(request)
+            self.acknowledge(writer, framed)
+        elif request.get('request_type') == "BLOCK_REPORT":
+            await self.handle_block_report(request, writer, framed)
+        elif request.get('request_type') == "GET_REPLICATION_STATUS":
+            protocol.write_response(writer, self.replication_scheduler.status(), framed)
+        else:
+            print(f"Unknown request type: {request.get('request_type')}")
+            if framed:
+                protocol.write_response(writer, {'status': 'error', 'message': 'Unknown request type'}, framed)
+
+
+    def acknowledge(self, writer, framed):
+        # Legacy senders of one-way requests never read a reply
+        if framed:
+            protocol.write_response(writer, {'status': 'success'}, framed)
+
+
+    def handle_get_file(self, request, writer, framed=False):
         try:
-            file_id = request.get('file_id')
-            file = self.file_map[file_id]
-            chunks = []
-            for chunk_id in file.chunks_to_index.keys():
-                chunk_servers = []
-                for chunk_server_id in self.chunk_map[chunk_id]:
-                    chunk_servers.append((json.loads(self.chunk_server_map[chunk_server_id].to_json()))) #appends json location of each chunk_server that holds the chunk
-                chunk = {
-                    'chunk_id': chunk_id,
-                    'chunk_index': file.get_index(chunk_id),
-                    'chunk_server_locations': chunk_servers
-                }
-                chunks.append(chunk)
-
-            response = {
-                'file_id': file_id,
-                'chunks': chunks
-            }
-
-            response_data = json.dumps(response) + '\n\n'
-            client_socket.sendall(response_data.encode())
+            response = self.metadata.get_file_data(request.get('file_id'))
+            protocol.write_response(writer, response, framed)
             print(f"Returned file servers to client")
         except Exception as e:
             print(f'Error getting the file data in coordinator: {e}')
+            if framed:
+                protocol.write_response(writer, {'status': 'error', 'message': str(e)}, framed)
 
 
-    def handle_getting_chunk_servers(self, request, client_socket):
+    def handle_getting_chunk_servers(self, request, writer, framed=False):
         print("chunk server info requested")
-        chunk_servers = []
-        for _, chunk_server_abstraction in self.chunk_server_map.items():
-            chunk_servers.append(chunk_server_abstraction.to_json())
         response = {
-            'chunk_servers': chunk_servers
+            'chunk_servers': self.metadata.get_chunk_servers()
         }
-        response_data = json.dumps(response) + '\n\n'
-        client_socket.sendall(response_data.encode())
-        print(f"Returned chunk servers to client", response)
-
-        pass
-
-    def handle_creating_new_file(self, request):
-        metadata = request.get('chunk_metadata')
-        file_name = request.get('file_id')
-        new_file = File(file_name)
-        self.file_map[file_name] = new_file
-        for obj in metadata:
-            chunk_id, chunk_index, chunk_server_id = obj['chunk_id'], obj['chunk_index'], obj['chunk_server_id']
-            new_file.update_indexes(chunk_id, chunk_index) 
-
-           
-    def handle_chunk_upload_success(self, request):
-        chunk_id = request.get('chunk_id')
+        if request.get('num_chunks') is not None:
+            # A placement plan for the upload: [primary id, replica ids...] per chunk
+            # Servers that failed an earlier chain for the chunk are left out of its new one
+            excluded = {tuple(location) for location in request.get('exclude') or []}
+            chunk_servers = [server for server in self.metadata.chunk_server_map.values() if server.get_location() not in excluded]
+            stored_chunks = {server_id: len(chunk_ids) for server_id, chunk_ids in self.metadata.server_chunks_map.items()}
+            response['placement'] = self.placement_policy.plan(
+                chunk_servers, stored_chunks, request['num_chunks'],
+                request.get('chunk_size', 1024 * 1024), request.get('replication', 3)
+            ) if chunk_servers else []
+        protocol.write_response(writer, response, framed)
+        print(f"Returned {len(response['chunk_servers'])} chunk servers to client")
+
+
+    async def handle_creating_new_file(self, request):
+        await self.mutate({
+            'op': 'REGISTER_NEW_FILE',
+            'file_id': request.get('file_id'),
+            'chunk_metadata': [{'chunk_id': obj['chunk_id'], 'chunk_index': obj['chunk_index'], 'chunk_size': obj.get('chunk_size'),
+                                'chunk_server_id': obj.get('chunk_server_id')} # holder until the ChunkServer's own report arrives
+                               for obj in request.get('chunk_metadata')],
+            'erasure': request.get('erasure') # {data_shards, parity_shards, parity: [[chunk_id, ...] per stripe]} or None
+        })
+
+
+    async def handle_chunk_upload_success(self, request):
+        await self.mutate({
+            'op': 'CHUNK_STORED',
+            'chunk_id': request.get('chunk_id'),
+            'chunk_server_id': request.get('chunk_server_id')
+        })
+
+
+    async def handle_chunks_stored(self, request):
+        # A whole batch of notifications from one ChunkServer is a single mutation
+        await self.mutate({
+            'op': 'CHUNKS_STORED',
+            'chunk_ids': request.get('chunk_ids', []),
+            'chunk_server_id': request.get('chunk_server_id')
+        })
+
+
+    async def handle_chunks_corrupt(self, request):
+        '''A ChunkServer dropped chunks that failed their checksum; copy them back from healthy replicas'''
+        lost_chunks = await self.mutate({
+            'op': 'CHUNKS_CORRUPT',
+            'chunk_ids': request.get('chunk_ids', []),
+            'chunk_server_id': request.get('chunk_server_id')
+        })
+        print(f"{request.get('chunk_server_id')} dropped {len(lost_chunks)} corrupt chunks")
+        self.replication_scheduler.enqueue(lost_chunks)
+
+
+    async def handle_block_report(self, request, writer, framed=False):
+        '''Reconcile a (re)started ChunkServer's chunks in one mutation instead of re-replicating them'''
         chunk_server_id = request.get('chunk_server_id')
-        self.chunk_map[chunk_id].append(chunk_server_id)
-        self.server_chunks_map[chunk_server_id].add(chunk_id)
-       
+        try:
+            lost_chunks = await self.mutate({
+                'op': 'BLOCK_REPORT',
+                'chunk_server_id': chunk_server_id,
+                'chunk_ids': request.get('chunk_ids', [])
+            })
+        except Exception as e:
+            print(f'Error applying block report from {chunk_server_id}: {e}')
+            if framed:
+                protocol.write_response(writer, {'status': 'error', 'message': str(e)}, framed)
+            return
+
+        print(f"Block report from {chunk_server_id}: {len(request.get('chunk_ids', []))} chunks, {len(lost_chunks)} lost")
+        if framed:
+            protocol.write_response(writer, {'status': 'success', 'lost_chunks': len(lost_chunks)}, framed)
+        self.replication_scheduler.enqueue(lost_chunks)
 
-    def handle_get_client_id(self, client_socket):
+
+    def handle_get_client_id(self, writer, framed=False):
         """Generate a new UUID client ID and send it back to client"""
         client_id = str(uuid.uuid4())
         response = {"client_id": client_id}
-        client_socket.sendall(json.dumps(response).encode())
+        protocol.write_response(writer, response, framed)
         print(f"Generated and sent client ID: {client_id}")
 
 
-    def send_heartbeat(self):
+    async def send_heartbeat(self):
         while True:
-            chunk_server_ids = list(self.chunk_server_map.keys())
+            chunk_server_ids = list(self.metadata.chunk_server_map.keys())
             print('\nHeartbeat sent')
-            for server_id in chunk_server_ids:
-                other_servers = [id_ for id_ in chunk_server_ids if id_ != server_id]
-                if len(other_servers) >= 2:
-                    assigned_servers_ids = random.sample(other_servers, 2)
-                else:
-                    assigned_servers_ids = other_servers  # Use whatever is available
-
-                assigned_servers = [self.chunk_server_map[assigned_server].get_location() for assigned_server in assigned_servers_ids]
-                request = {
-                    'request_type': 'HEALTH_CHECK',
-                    'other_active_servers': assigned_servers
-                }
-                try:
-                    chunk_server_addr, chunk_server_port = self.chunk_server_map[server_id].get_location()
-                    chunk_server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-                    chunk_server_socket.connect((chunk_server_addr, chunk_server_port))
-                    chunk_server_socket.send((json.dumps(request) + '\n\n').encode())
-
-                    data = ""
-                    while True:
-                        part = chunk_server_socket.recv(1024).decode()
-                        if not part:  # Connection closed
-                            break
-                        data += part
-                        if "\n\n" in data:  # End of message
-                            data = data.replace("\n\n", "")  # Remove delimiter
-                            break
-
-                    response = json.loads(data)
-
-                    if response.get('status') != 'OK':
-                        self.handle_chunk_server_failure(server_id)
-
-                except Exception as e:
-                    print(f'A heartbeat has failed for server {server_id}: {e}')
-                    self.handle_chunk_server_failure(server_id)
-                finally:
-                    chunk_server_socket.close()
-
-            time.sleep(10)
-
-    def handle_new_chunk_server(self, request):
-        id = request.get('chunk_server_id')
-        address = request.get('host')
-        port = request.get('port')
-        self.chunk_server_map[id] = ChunkServerAbstraction(address, port, id)
-        print(self.chunk_server_map, "CHUNK SERVER MAP")
-        pass
-
-    def handle_chunk_server_failure(self, failed_server):
+            if self.replication_scheduler.queued or self.replication_scheduler.in_flight:
+                print(f'Re-replication: {self.replication_scheduler.status()}')
+            # Probe every ChunkServer at once so a hung server only costs its own deadline
+            await asyncio.gather(*(self.probe_chunk_server(server_id, chunk_server_ids) for server_id in chunk_server_ids))
+            await asyncio.sleep(self.heartbeat_interval)
+
+
+    async def probe_chunk_server(self, server_id, chunk_server_ids):
+        chunk_server_map = self.metadata.chunk_server_map
+        if server_id not in chunk_server_map:
+            return # removed since the round started
+        chunk_server = chunk_server_map[server_id]
+
+        other_servers = [id_ for id_ in chunk_server_ids if id_ != server_id and id_ in chunk_server_map]
+        if len(other_servers) >= 2:
+            assigned_servers_ids = random.sample(other_servers, 2)
+        else:
+            assigned_servers_ids = other_servers  # Use whatever is available
+
+        if chunk_server.wire_protocol >= WIRE_VERSION:
+            assigned_servers = [chunk_server_map[assigned_server].get_peer_info() for assigned_server in assigned_servers_ids]
+        else:
+            # Legacy servers expect plain (address, port) pairs
+            assigned_servers = [chunk_server_map[assigned_server].get_location() for assigned_server in assigned_servers_ids]
+        request = {
+            'request_type': 'HEALTH_CHECK',
+            'other_active_servers': assigned_servers
+        }
+        try:
+            response = await asyncio.wait_for(self.call_chunk_server(chunk_server, request), self.heartbeat_timeout)
+            if response.get('status') == 'OK':
+                recovered = chunk_server.missed_heartbeats > 0
+                chunk_server.update_stats(response.get('stats') or {})
+                if recovered:
+                    self.replication_scheduler.servers_available()
+                return
+            print(f'A heartbeat has failed for server {server_id}: {response}')
+        except Exception as e:
+            print(f'A heartbeat has failed for server {server_id}: {e!r}')
+
+        chunk_server.missed_heartbeats += 1
+        if chunk_server.missed_heartbeats >= self.max_missed_heartbeats and chunk_server_map.get(server_id) is chunk_server:
+            await self.handle_chunk_server_failure(server_id)
+
+    async def handle_new_chunk_server(self, request):
+        await self.mutate({
+            'op': 'REGISTER_CHUNK_SERVER',
+            'chunk_server_id': request.get('chunk_server_id'),
+            'host': request.get('host'),
+            'port': request.get('port'),
+            'wire_protocol': request.get('wire_protocol', LEGACY_VERSION)
+        })
+        print(self.metadata.chunk_server_map, "CHUNK SERVER MAP")
+        self.replication_scheduler.servers_available()
+
+    async def handle_chunk_server_failure(self, failed_server):
         '''
-        if a ChunkServer goes offline, map all the chunks it stored to another ChunkServer
+        if a ChunkServer goes offline, queue every chunk it stored for re-replication
         '''
         print(f"Handling failure of chunk server {failed_server}")
-        chunks_to_remap = list(self.server_chunks_map[failed_server])
-
-        for chunk_id in chunks_to_remap:
-            self.chunk_map[chunk_id].remove(failed_server)
-        
-        del self.server_chunks_map[failed_server]
-        del self.chunk_server_map[failed_server]
-
-        print(chunks_to_remap, 'CHUNKS TO REMAP')
-        
-        # Remap each chunk to a new server
-        for chunk_id in chunks_to_remap:
-            self.remap_chunk(chunk_id)
-        pass
-    
-    def remap_chunk(self, chunk_id):
-        '''
-        remaps chunk to another ChunkServer, called when ChunkServer goes offline
-        '''
-        try:
-            available_servers = [server_id for server_id in self.chunk_server_map if server_id not in self.chunk_map[chunk_id]]
-            print(available_servers, 'AVAILABLE SERVER(S)')
-            if not available_servers:
-                print(f"No available servers to replicate chunk {chunk_id}")
-                return
+        chunks_to_remap = await self.mutate({'op': 'CHUNK_SERVER_FAILED', 'chunk_server_id': failed_server})
 
-            # Select a random server to host the chunk
-            target_server_id = available_servers[0]
-            source_server_id = self.chunk_map[chunk_id][0]  # Assume at least one server hosts the chunk
-
-            source_server = self.chunk_server_map[source_server_id]
-            target_server = self.chunk_server_map[target_server_id]
-
-            target_address, target_port = target_server.get_location()
-            source_address, source_port = source_server.get_location()
-            
-            with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as source_socket:
-                source_socket.connect((source_address, source_port))
-                request = {
-                    "request_type": "REPLICATE_CHUNK",
-                    "chunk_id": chunk_id,
-                    "chnk_srv_addr": target_address,
-                    "chnk_srv_port": target_port
-                }
-                source_socket.sendall((json.dumps(request) + '\n\n').encode())
-                print(f"Replication request sent for chunk {chunk_id} from {source_server_id} to {target_server_id}")
-
-                data = ""
-                while True:
-                    part = source_socket.recv(1024).decode()
-                    if not part:
-                        break
-                    data += part
-                    if "\n\n" in data:
-                        data = data.replace("\n\n", "")
-                        break
-            
-            if data:
-                response = json.loads(data)
-                print(response)
-                if response.get("status") == "success":
-                    self.chunk_map[chunk_id].append(target_server_id)
-                    print(f"Successfully remapped chunk {chunk_id} to server {target_server_id}")
-                else:
-                    print(f"Failed to remap chunk {chunk_id}: {response.get('error')}")
+        print(f'{len(chunks_to_remap)} CHUNKS TO REMAP')
+        self.replication_scheduler.enqueue(chunks_to_remap)
 
-        except Exception as e:
-            print(f"Error remapping chunk {chunk_id}: {e}")
+
+    async def call_chunk_server(self, chunk_server: ChunkServerAbstraction, request):
+        '''Send a request to a ChunkServer in the protocol it registered with and return its response'''
+        response, _ = await self.pool.call(chunk_server.get_location(), request,
+                                           framed=chunk_server.wire_protocol >= WIRE_VERSION)
+        return response
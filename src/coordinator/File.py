@@ -3,9 +3,23 @@ class File:
     def __init__(self, id):
         self.id = id
         self.chunks_to_index = {} # map chunk_ids to the chunk_index
+        self.chunk_sizes = {} # map chunk_ids to their size in bytes, when the uploader reported it
+        self.erasure = None # (data chunks, parity chunks) per stripe if the file is erasure coded instead of replicated
+        self.parity_chunks = [] # parity chunk ids of each stripe, in stripe order
 
-    def update_indexes(self, chunk_id, chunk_index):
+    def update_indexes(self, chunk_id, chunk_index, chunk_size=None):
         self.chunks_to_index[chunk_id] = chunk_index
+        if chunk_size is not None:
+            self.chunk_sizes[chunk_id] = chunk_size
+
+    def data_chunks(self):
+        return sorted(self.chunks_to_index, key=self.chunks_to_index.get)
+
+    def stripe_index(self, chunk_id):
+        '''The stripe an erasure coded chunk, data or parity, belongs to'''
+        if chunk_id in self.chunks_to_index:
+            return self.chunks_to_index[chunk_id] // self.erasure[0]
+        return next(index for index, parity in enumerate(self.parity_chunks) if chunk_id in parity)
 
     def get_index(self, chunk_id):
         if chunk_id not in self.chunks_to_index:
@@ -0,0 +1,276 @@
+from typing import Dict, Set, List
+import collections
+import json
+from src.coordinator.File import File
+from src.coordinator.ChunkServerAbstraction import ChunkServerAbstraction
+from src.common.protocol import LEGACY_VERSION
+
+
+class Metadata:
+    '''
+    Coordinator metadata: which files exist, which chunks make them up and which ChunkServers hold each chunk.
+
+    All changes go through apply() with a mutation record ({'op': ..., ...}) so that a single
+    writer can order them; everything else only reads.
+    '''
+    def __init__(self):
+        self.chunk_server_map: Dict[str, ChunkServerAbstraction] = {} #map chunkserver id's to the address and port of the chunkserver
+        self.chunk_map: Dict[str, List[str]] = collections.defaultdict(list) #map chunk ids to chunkserver id that hosts it
+        self.file_map: Dict[str, File] = {} #map file_id to File obj
+        self.server_chunks_map: Dict[str, Set[str]] = collections.defaultdict(set) #map server id's to the chunks they host
+        self.coded_chunks: Dict[str, str] = {} #map the data and parity chunks of erasure coded files to their file id
+
+
+    def apply(self, mutation):
+        op = mutation['op']
+        if op == 'REGISTER_NEW_FILE':
+            return self.register_new_file(mutation['file_id'], mutation['chunk_metadata'], mutation.get('erasure'))
+        elif op == 'REGISTER_CHUNK_SERVER':
+            return self.register_chunk_server(mutation['chunk_server_id'], mutation['host'], mutation['port'],
+                                              mutation.get('wire_protocol', LEGACY_VERSION))
+        elif op == 'CHUNK_STORED':
+            return self.add_chunk_replica(mutation['chunk_id'], mutation['chunk_server_id'])
+        elif op == 'CHUNKS_STORED':
+            return self.add_chunk_replicas(mutation['chunk_ids'], mutation['chunk_server_id'])
+        elif op == 'CHUNKS_CORRUPT':
+            return self.remove_chunk_replicas(mutation['chunk_ids'], mutation['chunk_server_id'])
+        elif op == 'CHUNK_SERVER_FAILED':
+            return self.remove_chunk_server(mutation['chunk_server_id'])
+        elif op == 'BLOCK_REPORT':
+            return self.apply_block_report(mutation['chunk_server_id'], mutation['chunk_ids'])
+        raise ValueError(f'Unknown metadata mutation {op}')
+
+
+    def register_new_file(self, file_id, chunk_metadata, erasure=None):
+        new_file = File(file_id)
+        self.file_map[file_id] = new_file
+        for obj in chunk_metadata:
+            new_file.update_indexes(obj['chunk_id'], obj['chunk_index'], obj.get('chunk_size'))
+            # The uploader's ChunkServer acknowledged the chunk, so readers can use it before its batched CHUNKS_STORED arrives
+            uploaded_to = obj.get('chunk_server_id')
+            if uploaded_to in self.chunk_server_map and not self.chunk_map.get(obj['chunk_id']):
+                self.add_chunk_replica(obj['chunk_id'], uploaded_to)
+        if erasure:
+            new_file.erasure = (erasure['data_shards'], erasure['parity_shards'])
+            new_file.parity_chunks = [list(parity) for parity in erasure['parity']]
+            self.index_coded_file(new_file)
+
+
+    def index_coded_file(self, file: File):
+        for chunk_id in file.chunks_to_index:
+            self.coded_chunks[chunk_id] = file.id
+        for parity in file.parity_chunks:
+            for chunk_id in parity:
+                self.coded_chunks[chunk_id] = file.id
+
+
+    def wanted_replicas(self, chunk_id, replication):
+        '''Copies a chunk should have: one for the chunks of erasure coded files, whose parity protects them'''
+        return 1 if chunk_id in self.coded_chunks else replication
+
+
+    def stripe_of(self, chunk_id):
+        '''The stripe an erasure coded chunk belongs to, see stripe()'''
+        file = self.file_map[self.coded_chunks[chunk_id]]
+        return self.stripe(file, file.stripe_index(chunk_id))
+
+
+    def stripe(self, file: File, stripe_index):
+        '''
+        One stripe of an erasure coded file: its data chunks, padded with None past the end of the
+        file, then its parity chunks, each with its size and the ChunkServers holding it
+        '''
+        data_shards, parity_shards = file.erasure
+        data = file.data_chunks()[stripe_index * data_shards:(stripe_index + 1) * data_shards]
+        shard_size = max(file.chunk_sizes[chunk_id] for chunk_id in data)
+        members = [self.chunk_entry(chunk_id, file.chunk_sizes[chunk_id]) for chunk_id in data]
+        members += [None] * (data_shards - len(data))
+        members += [self.chunk_entry(chunk_id, shard_size) for chunk_id in file.parity_chunks[stripe_index]]
+        return {'data_shards': data_shards, 'parity_shards': parity_shards, 'shard_size': shard_size, 'members': members}
+
+
+    def chunk_entry(self, chunk_id, chunk_size):
+        return {'chunk_id': chunk_id, 'chunk_size': chunk_size, 'chunk_server_locations': self.chunk_locations(chunk_id)}
+
+
+    def chunk_locations(self, chunk_id):
+        #json location of each chunk_server that holds the chunk
+        return [json.loads(self.chunk_server_map[chunk_server_id].to_json()) for chunk_server_id in self.chunk_map.get(chunk_id, [])]
+
+
+    def register_chunk_server(self, chunk_server_id, host, port, wire_protocol=LEGACY_VERSION):
+        self.chunk_server_map[chunk_server_id] = ChunkServerAbstraction(host, port, chunk_server_id, wire_protocol)
+
+
+    def add_chunk_replica(self, chunk_id, chunk_server_id):
+        if chunk_server_id not in self.chunk_map[chunk_id]:
+            self.chunk_map[chunk_id].append(chunk_server_id)
+        self.server_chunks_map[chunk_server_id].add(chunk_id)
+
+
+    def add_chunk_replicas(self, chunk_ids, chunk_server_id):
+        for chunk_id in chunk_ids:
+            self.add_chunk_replica(chunk_id, chunk_server_id)
+
+
+    def remove_chunk_replicas(self, chunk_ids, chunk_server_id):
+        '''Forget the replicas a ChunkServer no longer holds, returning the chunks that lost one'''
+        held = self.server_chunks_map.get(chunk_server_id, set())
+        lost_chunks = []
+        for chunk_id in chunk_ids:
+            if chunk_id in held:
+                held.discard(chunk_id)
+                lost_chunks.append(chunk_id)
+            holders = self.chunk_map.get(chunk_id)
+            if holders and chunk_server_id in holders:
+                holders.remove(chunk_server_id)
+        return lost_chunks
+
+
+    def remove_chunk_server(self, chunk_server_id):
+        '''Forget a failed ChunkServer, returning the chunks that lost a replica'''
+        lost_chunks = list(self.server_chunks_map.pop(chunk_server_id, ()))
+        for chunk_id in lost_chunks:
+            if chunk_server_id in self.chunk_map[chunk_id]:
+                self.chunk_map[chunk_id].remove(chunk_server_id)
+        self.chunk_server_map.pop(chunk_server_id, None)
+        return lost_chunks
+
+
+    def apply_block_report(self, chunk_server_id, chunk_ids):
+        '''
+        Make the replica map agree with the full list of chunks a ChunkServer reports holding.
+        Returns the chunks the server was thought to hold but no longer does.
+        '''
+        if chunk_server_id not in self.chunk_server_map:
+            raise ValueError(f'Block report from unregistered chunk server {chunk_server_id}')
+        reported = set(chunk_ids)
+        held = self.server_chunks_map.get(chunk_server_id, set())
+
+        lost_chunks = list(held - reported)
+        for chunk_id in lost_chunks:
+            holders = self.chunk_map.get(chunk_id)
+            if holders and chunk_server_id in holders:
+                holders.remove(chunk_server_id)
+        for chunk_id in reported - held:
+            self.chunk_map[chunk_id].append(chunk_server_id)
+
+        if reported:
+            self.server_chunks_map[chunk_server_id] = reported
+        else:
+            self.server_chunks_map.pop(chunk_server_id, None)
+        return lost_chunks
+
+
+    def to_snapshot(self):
+        '''
+        Compact, marshal-friendly form of the metadata. Chunk ids are stored once, under their
+        file and without the file id prefix they share, and ChunkServers are referenced by index.
+        server_chunks_map is not stored since it is the inverse of chunk_map.
+        '''
+        server_ids = list(self.chunk_server_map.keys() | self.server_chunks_map.keys())
+        server_index = {server_id: index for index, server_id in enumerate(server_ids)}
+        servers = [(server.chnk_srv_id, server.chnk_srv_addr, server.chnk_srv_port, server.wire_protocol)
+                   for server in self.chunk_server_map.values()]
+
+        files = []
+        filed_chunks = set()
+        for file_id, file in self.file_map.items():
+            prefix = f'{file_id}_'
+            shared_prefix = all(chunk_id.startswith(prefix) for chunk_id in file.chunks_to_index) and \
+                all(chunk_id.startswith(prefix) for parity in file.parity_chunks for chunk_id in parity)
+            strip = len(prefix) if shared_prefix else 0
+            chunks = [(chunk_id[strip:], chunk_index, tuple(server_index[server_id] for server_id in self.chunk_map.get(chunk_id, ())))
+                      for chunk_id, chunk_index in file.chunks_to_index.items()]
+            filed_chunks.update(file.chunks_to_index)
+            # Sizes in chunk order, kept apart from the chunk tuples so files without sizes cost nothing
+            sizes = [file.chunk_sizes.get(chunk_id) for chunk_id in file.chunks_to_index] if file.chunk_sizes else None
+            if file.erasure:
+                # (data shards, parity shards, parity chunks of each stripe) after the sizes
+                parity = [[(chunk_id[strip:], tuple(server_index[server_id] for server_id in self.chunk_map.get(chunk_id, ())))
+                           for chunk_id in stripe] for stripe in file.parity_chunks]
+                filed_chunks.update(chunk_id for stripe in file.parity_chunks for chunk_id in stripe)
+                files.append((file_id, shared_prefix, chunks, sizes, (*file.erasure, parity)))
+            else:
+                files.append((file_id, shared_prefix, chunks, sizes))
+
+        # Chunks reported as stored whose file has not been registered (yet)
+        loose_chunks = [(chunk_id, tuple(server_index[server_id] for server_id in server_ids_))
+                        for chunk_id, server_ids_ in self.chunk_map.items() if chunk_id not in filed_chunks and server_ids_]
+
+        return {'server_ids': server_ids, 'servers': servers, 'files': files, 'loose_chunks': loose_chunks}
+
+
+    @classmethod
+    def from_snapshot(cls, snapshot):
+        metadata = cls()
+        server_ids = snapshot['server_ids']
+        for server_id, host, port, wire_protocol in snapshot['servers']:
+            metadata.register_chunk_server(server_id, host, port, wire_protocol)
+
+        chunk_map = metadata.chunk_map
+        server_chunks = [set() for _ in server_ids] # built by index alongside chunk_map, then keyed by id
+        for file_entry in snapshot['files']:
+            file_id, shared_prefix, chunks = file_entry[:3]
+            file = File(file_id)
+            chunks_to_index = file.chunks_to_index
+            prefix = f'{file_id}_' if shared_prefix else ''
+            for chunk_suffix, chunk_index, servers in chunks:
+                chunk_id = prefix + chunk_suffix
+                chunks_to_index[chunk_id] = chunk_index
+                if servers:
+                    chunk_map[chunk_id] = [server_ids[index] for index in servers]
+                    for index in servers:
+                        server_chunks[index].add(chunk_id)
+            sizes = file_entry[3] if len(file_entry) > 3 else None # absent from older snapshots
+            if sizes:
+                file.chunk_sizes = {chunk_id: size for chunk_id, size in zip(chunks_to_index, sizes) if size is not None}
+            if len(file_entry) > 4:
+                data_shards, parity_shards, parity = file_entry[4]
+                file.erasure = (data_shards, parity_shards)
+                for stripe in parity:
+                    file.parity_chunks.append([prefix + chunk_suffix for chunk_suffix, _ in stripe])
+                    for chunk_suffix, servers in stripe:
+                        if servers:
+                            chunk_map[prefix + chunk_suffix] = [server_ids[index] for index in servers]
+                            for index in servers:
+                                server_chunks[index].add(prefix + chunk_suffix)
+                metadata.index_coded_file(file)
+            metadata.file_map[file_id] = file
+
+        for chunk_id, servers in snapshot['loose_chunks']:
+            chunk_map[chunk_id] = [server_ids[index] for index in servers]
+            for index in servers:
+                server_chunks[index].add(chunk_id)
+
+        for server_id, chunk_ids in zip(server_ids, server_chunks):
+            if chunk_ids:
+                metadata.server_chunks_map[server_id] = chunk_ids
+        return metadata
+
+
+    def get_file_data(self, file_id):
+        file = self.file_map[file_id]
+        chunks = []
+        for chunk_id in file.chunks_to_index.keys():
+            chunk = {
+                'chunk_id': chunk_id,
+                'chunk_index': file.get_index(chunk_id),
+                'chunk_size': file.chunk_sizes.get(chunk_id),
+                'chunk_server_locations': self.chunk_locations(chunk_id)
+            }
+            chunks.append(chunk)
+
+        file_data = {
+            'file_id': file_id,
+            'chunks': chunks
+        }
+        if file.erasure:
+            # Where every stripe's chunks are, so readers can rebuild a chunk they cannot fetch
+            file_data['erasure'] = {'data_shards': file.erasure[0], 'parity_shards': file.erasure[1],
+                                    'stripes': [self.stripe(file, index) for index in range(len(file.parity_chunks))]}
+        return file_data
+
+
+    def get_chunk_servers(self):
+        return [chunk_server_abstraction.to_json() for chunk_server_abstraction in self.chunk_server_map.values()]
@@ -0,0 +1,148 @@
+import gc
+import json
+import marshal
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from src.coordinator.Metadata import Metadata
+
+SNAPSHOT_MAGIC = b'DFSNAP1\n'
+
+
+class MetadataLog:
+    '''
+    Write-ahead log of Coordinator metadata mutations plus periodic snapshots.
+
+    Mutations are appended as JSON lines to numbered log segments and fsynced once per
+    batch. When a segment reaches snapshot_every records it is closed, and a background
+    thread folds the closed segments into a new marshal snapshot, so the live metadata is
+    never serialized on the event loop. Startup loads the snapshot and replays the log tail.
+    '''
+    def __init__(self, metadata_dir: Path, snapshot_every=100_000):
+        self.metadata_dir = Path(metadata_dir)
+        self.metadata_dir.mkdir(parents=True, exist_ok=True)
+        self.snapshot_path = self.metadata_dir / 'snapshot.bin'
+        self.snapshot_every = snapshot_every
+
+        self.segment = None # open log segment
+        self.segment_seq = 0
+        self.segment_records = 0
+        self.checkpointer = ThreadPoolExecutor(max_workers=1) # one checkpoint at a time
+
+
+    def segment_path(self, seq) -> Path:
+        return self.metadata_dir / f'wal.{seq:010d}.log'
+
+
+    def segment_seqs(self):
+        return sorted(int(path.name.split('.')[1]) for path in self.metadata_dir.glob('wal.*.log'))
+
+
+    def load(self) -> Metadata:
+        '''Rebuild metadata from the latest snapshot and the log segments written after it'''
+        start = time.monotonic()
+        # Millions of new containers would otherwise trigger repeated full collections
+        gc.disable()
+        try:
+            metadata, covered_seq = self.read_snapshot()
+            segment_seqs = self.segment_seqs()
+            replayed = 0
+            for seq in segment_seqs:
+                if seq > covered_seq:
+                    replayed += self.replay_segment(metadata, seq)
+        finally:
+            gc.enable()
+        gc.freeze() # the loaded metadata is long lived, keep it out of future collections
+
+        # Never append to a segment that may end in a torn write
+        last_seq = max(segment_seqs + [covered_seq])
+        self.segment_seq = last_seq + 1
+        self.segment = open(self.segment_path(self.segment_seq), 'ab')
+        if replayed:
+            self.checkpointer.submit(self.checkpoint, last_seq)
+
+        print(f"Loaded metadata for {len(metadata.file_map)} files and {len(metadata.chunk_map)} chunks "
+              f"(replayed {replayed} log records) in {time.monotonic() - start:.2f}s")
+        return metadata
+
+
+    def append(self, mutations):
+        '''Durably append a batch of mutations with a single fsync'''
+        self.segment.write(''.join(json.dumps(mutation, separators=(',', ':')) + '\n' for mutation in mutations).encode())
+        self.segment.flush()
+        os.fsync(self.segment.fileno())
+        self.segment_records += len(mutations)
+        if self.segment_records >= self.snapshot_every:
+            self.rotate()
+
+
+    def rotate(self):
+        self.segment.close()
+        closed_seq = self.segment_seq
+        self.segment_seq += 1
+        self.segment_records = 0
+        self.segment = open(self.segment_path(self.segment_seq), 'ab')
+        self.checkpointer.submit(self.checkpoint, closed_seq)
+
+
+    def checkpoint(self, upto_seq):
+        '''Fold closed log segments up to upto_seq into a new snapshot, then drop them'''
+        try:
+            start = time.monotonic()
+            metadata, covered_seq = self.read_snapshot()
+            if covered_seq >= upto_seq:
+                return
+            for seq in self.segment_seqs():
+                if covered_seq < seq <= upto_seq:
+                    self.replay_segment(metadata, seq)
+            self.write_snapshot(metadata, upto_seq)
+            for seq in self.segment_seqs():
+                if seq <= upto_seq:
+                    self.segment_path(seq).unlink()
+            print(f"Wrote metadata snapshot through log segment {upto_seq} in {time.monotonic() - start:.2f}s")
+        except Exception as e:
+            print(f"Error writing metadata snapshot: {e}")
+
+
+    def replay_segment(self, metadata: Metadata, seq):
+        replayed = 0
+        with open(self.segment_path(seq), 'rb') as segment:
+            for line in segment:
+                try:
+                    mutation = json.loads(line)
+                except json.JSONDecodeError:
+                    print(f"Ignoring torn record at the end of log segment {seq}")
+                    break
+                try:
+                    metadata.apply(mutation)
+                except Exception as e:
+                    print(f"Error replaying {mutation.get('op')}: {e}")
+                replayed += 1
+        return replayed
+
+
+    def read_snapshot(self):
+        '''Returns (metadata, last log segment included in the snapshot)'''
+        if not self.snapshot_path.exists():
+            return Metadata(), 0
+        with open(self.snapshot_path, 'rb') as snapshot_file:
+            if snapshot_file.read(len(SNAPSHOT_MAGIC)) != SNAPSHOT_MAGIC:
+                raise ValueError(f'{self.snapshot_path} is not a metadata snapshot')
+            covered_seq, snapshot = marshal.loads(snapshot_file.read())
+        return Metadata.from_snapshot(snapshot), covered_seq
+
+
+    def write_snapshot(self, metadata: Metadata, covered_seq):
+        temp_path = self.snapshot_path.with_suffix('.tmp')
+        with open(temp_path, 'wb') as snapshot_file:
+            snapshot_file.write(SNAPSHOT_MAGIC)
+            marshal.dump((covered_seq, metadata.to_snapshot()), snapshot_file)
+            snapshot_file.flush()
+            os.fsync(snapshot_file.fileno())
+        os.replace(temp_path, self.snapshot_path)
+        directory = os.open(self.metadata_dir, os.O_RDONLY)
+        try:
+            os.fsync(directory)
+        finally:
+            os.close(directory)
@@ -0,0 +1,99 @@
+import collections
+import itertools
+import random
+from abc import ABC, abstractmethod
+from typing import Dict, List
+from src.coordinator.ChunkServerAbstraction import ChunkServerAbstraction
+
+
+class PlacementPolicy(ABC):
+    '''
+    Decide which ChunkServers store each chunk of an upload: a primary followed by its replica targets.
+
+    Subclasses implement choose(); plan() keeps the targets of one chunk distinct and counts what
+    the upload has already been given, so a single large upload spreads out by itself.
+    '''
+    def __init__(self, reserved_disk=64 * 1024 * 1024):
+        self.reserved_disk = reserved_disk # free bytes a ChunkServer keeps back
+
+
+    def plan(self, chunk_servers: List[ChunkServerAbstraction], stored_chunks: Dict[str, int], num_chunks, chunk_size, replication=3):
+        '''Returns one list of ChunkServer ids per chunk, primary first'''
+        candidates = self.eligible(chunk_servers, chunk_size)
+        width = min(replication, len(candidates))
+        assigned = collections.Counter() # chunks of this upload given to each server
+        placement = []
+        for _ in range(num_chunks):
+            targets = []
+            for _ in range(width):
+                server = self.choose([server for server in candidates if server not in targets] if targets else candidates,
+                                     assigned, stored_chunks, chunk_size)
+                targets.append(server)
+                assigned[server.chnk_srv_id] += 1
+            placement.append([server.chnk_srv_id for server in targets])
+
+        for server in candidates:
+            server.pending_placements += assigned[server.chnk_srv_id]
+        return placement
+
+
+    def eligible(self, chunk_servers: List[ChunkServerAbstraction], chunk_size):
+        '''Servers answering heartbeats with room for another chunk, or everyone if that leaves nobody'''
+        eligible = [server for server in chunk_servers
+                    if server.missed_heartbeats == 0 and
+                    (server.free_disk is None or server.free_disk - server.pending_placements * chunk_size >= chunk_size + self.reserved_disk)]
+        return eligible or list(chunk_servers)
+
+
+    @abstractmethod
+    def choose(self, candidates: List[ChunkServerAbstraction], assigned, stored_chunks, chunk_size) -> ChunkServerAbstraction:
+        '''One of candidates for the next target of a chunk'''
+
+
+    @staticmethod
+    def load(server: ChunkServerAbstraction, assigned):
+        # Transfers in flight at the last heartbeat plus everything placed on the server since
+        return (server.active_connections or 0) + server.pending_placements + assigned[server.chnk_srv_id]
+
+
+
+class PowerOfTwoChoices(PlacementPolicy):
+    '''Sample two servers and take the less loaded one, breaking ties by fewer stored chunks'''
+    def choose(self, candidates, assigned, stored_chunks, chunk_size):
+        if len(candidates) <= 2:
+            sample = candidates
+        else:
+            sample = random.sample(candidates, 2)
+        return min(sample, key=lambda server: (self.load(server, assigned), stored_chunks.get(server.chnk_srv_id, 0)))
+
+
+
+class FreeSpaceWeighted(PlacementPolicy):
+    '''Pick servers at random in proportion to the free space they will have left'''
+    def choose(self, candidates, assigned, stored_chunks, chunk_size):
+        known = [server.free_disk for server in candidates if server.free_disk is not None]
+        default = sum(known) // len(known) if known else 1 # servers that have not reported yet count as average
+        weights = []
+        for server in candidates:
+            free_disk = server.free_disk if server.free_disk is not None else default
+            weights.append(max(free_disk - (server.pending_placements + assigned[server.chnk_srv_id]) * chunk_size, 1))
+        return random.choices(candidates, weights=weights)[0]
+
+
+
+class RoundRobin(PlacementPolicy):
+    '''Cycle through the servers in registration order, ignoring load'''
+    def __init__(self, reserved_disk=64 * 1024 * 1024):
+        super().__init__(reserved_disk)
+        self.counter = itertools.count()
+
+    def choose(self, candidates, assigned, stored_chunks, chunk_size):
+        return candidates[next(self.counter) % len(candidates)]
+
+
+
+PLACEMENT_POLICIES = {
+    'power_of_two': PowerOfTwoChoices,
+    'free_space': FreeSpaceWeighted,
+    'round_robin': RoundRobin
+}
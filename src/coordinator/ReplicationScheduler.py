@@ -0,0 +1,224 @@
+import asyncio
+import collections
+import heapq
+import itertools
+import random
+import time
+from src.coordinator.Metadata import Metadata
+
+
+class ReplicationScheduler:
+    '''
+    Background re-replication of under-replicated chunks.
+
+    Chunks wait in a priority queue ordered by how many replicas they have left, so the
+    chunks closest to being lost are copied first. Copies run in parallel, each from the
+    least busy holder to the least busy other ChunkServer, and no ChunkServer takes part
+    in more than max_copies_per_server copies at a time. A failed copy is retried after an
+    exponentially growing backoff, and chunks with no ChunkServer to copy to are parked until
+    a ChunkServer registers or recovers instead of being given up on.
+
+    Chunks of erasure coded files are kept at a single replica. One that is lost is rebuilt
+    from the rest of its stripe by a ChunkServer that holds no other chunk of that stripe.
+    '''
+    def __init__(self, metadata: Metadata, call_chunk_server, mutate, replication=3, max_copies=32,
+                 max_copies_per_server=4, max_attempts=3, copy_timeout=120.0, scan_limit=256, retry_backoff=1.0):
+        self.metadata = metadata
+        self.call_chunk_server = call_chunk_server # coroutine (ChunkServerAbstraction, request) -> response
+        self.mutate = mutate # coroutine applying a metadata mutation
+        self.replication = replication # replicas every chunk should have
+        self.max_copies = max_copies # copies in flight across the cluster
+        self.max_copies_per_server = max_copies_per_server # copies a single ChunkServer sends or receives at once
+        self.max_attempts = max_attempts
+        self.copy_timeout = copy_timeout
+        self.scan_limit = scan_limit # queued chunks looked at per pass when their servers are busy
+        self.retry_backoff = retry_backoff # seconds before the first retry of a failed copy, doubled for each later one
+
+        self.queue = [] # heap of (replicas left, sequence, chunk_id)
+        self.queued = set()
+        self.attempts = collections.Counter() # chunk_id -> failed copies so far
+        self.not_before = {} # chunk_id -> time.monotonic() before which a failed copy is not retried
+        self.parked = set() # chunks waiting for a ChunkServer to copy them to
+        self.copies = collections.Counter() # server_id -> copies in flight
+        self.sequence = itertools.count()
+        self.wakeup: asyncio.Event = None # created on the event loop
+        self.tasks = set()
+
+        self.in_flight = 0
+        self.completed = 0
+        self.failed = 0
+
+
+    def enqueue(self, chunk_ids):
+        for chunk_id in chunk_ids:
+            if chunk_id in self.queued:
+                continue
+            self.parked.discard(chunk_id)
+            replicas = len(self.metadata.chunk_map.get(chunk_id, ()))
+            if replicas >= self.metadata.wanted_replicas(chunk_id, self.replication):
+                continue
+            self.queued.add(chunk_id)
+            heapq.heappush(self.queue, (replicas, next(self.sequence), chunk_id))
+        if self.wakeup is not None:
+            self.wakeup.set()
+
+
+    def servers_available(self):
+        '''A ChunkServer registered or answered heartbeats again: retry the chunks that had nowhere to go'''
+        if self.parked:
+            parked, self.parked = self.parked, set()
+            self.enqueue(parked)
+
+
+    def status(self):
+        return {
+            'queued': len(self.queue),
+            'parked': len(self.parked),
+            'in_flight': self.in_flight,
+            'completed': self.completed,
+            'failed': self.failed
+        }
+
+
+    async def run(self):
+        self.wakeup = asyncio.Event()
+        while True:
+            await self.wakeup.wait()
+            self.wakeup.clear()
+            self.dispatch()
+
+
+    def dispatch(self):
+        '''Start copies for the most urgent chunks whose servers have capacity'''
+        busy = []
+        now = time.monotonic()
+        next_retry = None
+        while self.queue and self.in_flight < self.max_copies and len(busy) < self.scan_limit:
+            entry = heapq.heappop(self.queue)
+            chunk_id = entry[2]
+            retry_at = self.not_before.get(chunk_id, 0)
+            if retry_at > now:
+                # Backing off after a failed copy; look again once the backoff is over
+                busy.append(entry)
+                next_retry = retry_at if next_retry is None else min(next_retry, retry_at)
+                continue
+            pair = self.pick_pair(chunk_id)
+            if pair is None:
+                busy.append(entry)
+            elif pair:
+                task = asyncio.create_task(self.copy(chunk_id, *pair))
+                self.tasks.add(task)
+                task.add_done_callback(self.tasks.discard)
+        for entry in busy:
+            heapq.heappush(self.queue, entry)
+        if next_retry is not None:
+            asyncio.get_running_loop().call_later(next_retry - now, self.wakeup.set)
+
+
+    def pick_pair(self, chunk_id):
+        '''
+        (source id, target id) for the next copy of a chunk, None if every candidate is busy,
+        or () if the chunk cannot or need not be copied. The source is None for an erasure
+        coded chunk to rebuild from its stripe.
+        '''
+        chunk_server_map = self.metadata.chunk_server_map
+        holders = [server_id for server_id in self.metadata.chunk_map.get(chunk_id, ()) if server_id in chunk_server_map]
+        targets = [server_id for server_id, server in chunk_server_map.items()
+                   if server_id not in holders and server.missed_heartbeats == 0]
+        if len(holders) >= self.metadata.wanted_replicas(chunk_id, self.replication):
+            self.finish(chunk_id)
+            return ()
+        if not holders and chunk_id not in self.metadata.coded_chunks:
+            print(f"Cannot re-replicate chunk {chunk_id}: no replica left to copy from")
+            self.finish(chunk_id, failed=True)
+            return ()
+        if not targets:
+            print(f"Parking chunk {chunk_id} until a ChunkServer is available to copy it to")
+            self.queued.discard(chunk_id)
+            self.parked.add(chunk_id)
+            return ()
+        if not holders:
+            # Keep the stripe's chunks on distinct ChunkServers where there are enough of them
+            stripe_servers = {location['chnk_srv_id'] for member in self.metadata.stripe_of(chunk_id)['members']
+                              if member is not None for location in member['chunk_server_locations']}
+            target = self.least_busy([server_id for server_id in targets if server_id not in stripe_servers]) or \
+                self.least_busy(targets)
+            return None if target is None else (None, target)
+
+        source = self.least_busy(holders)
+        target = self.least_busy(targets)
+        if source is None or target is None:
+            return None
+        return source, target
+
+
+    def least_busy(self, server_ids):
+        available = [server_id for server_id in server_ids if self.copies[server_id] < self.max_copies_per_server]
+        if not available:
+            return None
+        fewest = min(self.copies[server_id] for server_id in available)
+        return random.choice([server_id for server_id in available if self.copies[server_id] == fewest])
+
+
+    async def copy(self, chunk_id, source_id, target_id):
+        self.copies[source_id] += 1
+        self.copies[target_id] += 1
+        self.in_flight += 1
+        try:
+            chunk_server_map = self.metadata.chunk_server_map
+            if source_id is None:
+                # The target reads the rest of the stripe and decodes the chunk itself
+                request = {
+                    "request_type": "REBUILD_CHUNK",
+                    "chunk_id": chunk_id,
+                    "stripe": self.metadata.stripe_of(chunk_id)
+                }
+                response = await asyncio.wait_for(self.call_chunk_server(chunk_server_map[target_id], request), self.copy_timeout)
+            else:
+                target_server = chunk_server_map[target_id]
+                target_address, target_port = target_server.get_location()
+                request = {
+                    "request_type": "REPLICATE_CHUNK",
+                    "chunk_id": chunk_id,
+                    "chnk_srv_addr": target_address,
+                    "chnk_srv_port": target_port,
+                    "wire_protocol": target_server.wire_protocol
+                }
+                response = await asyncio.wait_for(self.call_chunk_server(chunk_server_map[source_id], request), self.copy_timeout)
+            if response.get("status") != "success":
+                raise RuntimeError(response.get('message') or response.get('error'))
+            await self.mutate({'op': 'CHUNK_STORED', 'chunk_id': chunk_id, 'chunk_server_id': target_id})
+            print(f"{'Rebuilt' if source_id is None else 'Re-replicated'} chunk {chunk_id} from {source_id or 'its stripe'} to {target_id}")
+            self.completed += 1
+            self.attempts.pop(chunk_id, None)
+            self.not_before.pop(chunk_id, None)
+            succeeded = True
+
+        except Exception as e:
+            print(f"Error re-replicating chunk {chunk_id} from {source_id} to {target_id}: {e!r}")
+            self.attempts[chunk_id] += 1
+            self.not_before[chunk_id] = time.monotonic() + self.retry_backoff * 2 ** (self.attempts[chunk_id] - 1)
+            succeeded = False
+
+        finally:
+            self.copies[source_id] -= 1
+            self.copies[target_id] -= 1
+            self.in_flight -= 1
+            self.wakeup.set()
+
+        if not succeeded and self.attempts[chunk_id] >= self.max_attempts:
+            self.finish(chunk_id, failed=True)
+        else:
+            # Back in line until the chunk has all its replicas
+            self.queued.discard(chunk_id)
+            self.enqueue([chunk_id])
+            if chunk_id not in self.queued:
+                self.finish(chunk_id)
+
+
+    def finish(self, chunk_id, failed=False):
+        self.queued.discard(chunk_id)
+        self.attempts.pop(chunk_id, None)
+        self.not_before.pop(chunk_id, None)
+        if failed:
+            self.failed += 1
@@ -0,0 +1,18 @@
+from src.client.ReplicaSelector import ReplicaSelector
+
+
+def test_failing_server_moves_to_the_back():
+    selector = ReplicaSelector()
+    for _ in range(10):
+        selector.record('dead', 0.001, ok=False)
+        selector.record('good', 0.01)
+    servers = [{'chnk_srv_id': 'dead'}, {'chnk_srv_id': 'good'}]
+    for _ in range(20):
+        assert [server['chnk_srv_id'] for server in selector.rank(servers)] == ['good', 'dead']
+
+
+def test_failures_do_not_stretch_the_hedge_delay():
+    selector = ReplicaSelector(min_samples=1)
+    selector.record('good', 0.02)
+    selector.record('dead', 5.0, ok=False)
+    assert selector.hedge_delay() == 0.02
@@ -0,0 +1,13 @@
+import shutil
+
+from src.chunk_server.Volume import Volume, VolumeSet
+
+
+def test_unreadable_volume_is_failed_and_left_out_of_free_disk(tmp_path):
+    volumes = [Volume(tmp_path / name / 'chunks', 'cs', scrub_bytes_per_second=0) for name in ('a', 'b')]
+    failed = []
+    volume_set = VolumeSet(volumes, on_failure=failed.append)
+    shutil.rmtree(tmp_path / 'b')
+    assert volume_set.free_disk() == volumes[0].free_disk()
+    assert failed == [volumes[1]]
+    assert volume_set.healthy() == [volumes[0]]